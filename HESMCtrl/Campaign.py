@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measurement campaigns: sweeps over amplitude, frequency, offset and repeats
+(and electrodes) with one session to the HP33120A and the DS1054Z
+"""
+
+def parse_list(value, convert=float):
+	"""
+	'1.0, 2, 5' -> [1.0, 2.0, 5.0]
+	"""
+	return [convert(item.strip()) for item in value.split(',') if item.strip()]
+
+def get_campaign_settings(csfile='campaign_settings.txt'):
+	"""
+	read the sweep definition of a campaign
+	- Amplitudes = voltage amplitudes of the Freq. Gen. (list of float) - V
+	- Frequencies = driving frequencies (list of float) - Hz
+	- Offsets = voltage offsets (list of float) - V
+	- Repeats = measurements per point (int)
+	- ElectrKeys = pad keys to measure one after the other (list of str) - optional
+	- Journal = file of the finished points (str) - optional
+	all other settings are taken from the measurement settings file
+	"""
+	cs = {'electrkeys':[], 'repeats':1, 'journal':'campaign_journal.txt'}
+	f = open(csfile,'r')
+	for line in f:
+		if line.strip().startswith('#') or ':' not in line:
+			continue
+		value = line.split(':',1)[1].strip()
+		if 'Amplitudes' in line:
+			cs.update({'amps':parse_list(value)})
+		elif 'Frequencies' in line:
+			cs.update({'freqs':parse_list(value)})
+		elif 'Offsets' in line:
+			cs.update({'offsets':parse_list(value)})
+		elif 'Repeats' in line:
+			cs.update({'repeats':int(float(value))})
+		elif 'ElectrKeys' in line:
+			cs.update({'electrkeys':parse_list(value, str)})
+		elif 'Journal' in line:
+			cs.update({'journal':value})
+	f.close()
+	return cs
+
+def campaign_points(cs, ms):
+	"""
+	list of all points (dicts of name, electrkey, amp, freq, offs, repeat) of a campaign,
+	name = sample name of the settings, electrodes change slowest (manual contacting), 
+	repeats fastest
+	"""
+	electrkeys = cs['electrkeys'] or [ms['electrkey']]
+	points = []
+	for electrkey in electrkeys:
+		for offs in cs.get('offsets', [ms['offs']]):
+			for amp in cs.get('amps', [ms['amp']]):
+				for freq in cs.get('freqs', [ms['freq']]):
+					for repeat in range(1, cs['repeats']+1):
+						points.append({'name':ms['name'], 'electrkey':electrkey, 'amp':amp, 'freq':freq, 
+									   'offs':offs, 'repeat':repeat})
+	return points
+
+def point_key(point):
+	"""
+	unique key of a campaign point for the journal (sample name and electrode included,
+	several samples can share a journal)
+	"""
+	return '%(name)s|%(electrkey)s|A%(amp)g|f%(freq)g|O%(offs)g|R%(repeat)i' % point
+
+def point_settings(ms, point):
+	"""
+	measurement settings of a campaign point
+	"""
+	msp = dict(ms)
+	msp.update({'electrkey':point['electrkey'], 'amp':point['amp'], 'freq':point['freq'], 'offs':point['offs']})
+	if ms.get('auto_scale_CHAN1', False):
+		msp['scale_divider_CHAN1'] = point['amp']/3.
+	return msp
+
+def read_journal(journal):
+	"""
+	keys of the finished points in the journal file (one JSON object per line),
+	failed points (entries with 'error') are not finished
+	"""
+	import json
+	from os.path import exists
+	done = {}
+	if not exists(journal):
+		return done
+	for line in open(journal,'r'):
+		try:
+			entry = json.loads(line)
+		except ValueError:
+			continue	# line of an interrupted write
+		if 'error' in entry:
+			continue
+		done[entry['key']] = entry
+	return done
+
+def append_journal(journal, entry):
+	import json, os
+	with open(journal,'a') as f:
+		f.write(json.dumps(entry) + '\n')
+		f.flush()
+		os.fsync(f.fileno())
+
+def prompt_electrode(electrkey):
+	"""
+	on_electrode callback of run_campaign asking to contact the electrode (interactive runs)
+	"""
+	input('... contact electrode %s and press enter' % electrkey)
+
+def is_point_error(err):
+	"""
+	errors of a single point (no trigger, unusable data): the point is journaled
+	as failed and the campaign goes on, all other errors (instrument link lost, 
+	programming errors) abort the campaign
+	"""
+	from HESMCtrl.DS1054ZCtrl import AcquisitionTimeout
+	return isinstance(err, (AcquisitionTimeout, ValueError, ArithmeticError))
+
+def failure_entry(point, filename, err):
+	"""
+	journal entry of a failed point (with the traceback of err)
+	"""
+	import traceback
+	return {'key':point_key(point), 'filename':filename, 'error':repr(err),
+			'traceback':''.join(traceback.format_exception(type(err), err, err.__traceback__))}
+
+def run_campaign(cs, ms, FG=None, SCOPE=None, on_electrode=None):
+	"""
+	measures, evaluates and saves (save_all) all points of the campaign cs
+	with the measurement settings ms, the instruments are connected once
+	points in the journal are skipped (resume after an interruption)
+	on_electrode(electrkey) = called before the first point of every electrode
+	(e.g. prompt_electrode for interactive runs), None = no prompt (unattended)
+	a failed point is journaled with its traceback, the campaign goes on after 
+	point errors only (see is_point_error), the others are raised
+	returns the list of journal entries of the measured points
+	"""
+	from time import perf_counter
+	import matplotlib.pyplot as plt
+	from HESMCtrl.Measurement import (connect_instruments, measure_hysteresis, get_date_time, print_line,
+									  sample_settings, sample_filename)
+	from HESMCtrl.Evaluation import calculate_hysteresis_samples, plot_data
+	from HESMCtrl.OSOperations import save_all
+
+	points = campaign_points(cs, ms)
+	done = read_journal(cs['journal'])
+	todo = [point for point in points if point_key(point) not in done]
+	print_line()
+	print('Campaign: %i points, %i finished, %i to measure' % (len(points), len(points)-len(todo), len(todo)))
+	if not todo:
+		return []
+
+	# one session for the whole campaign
+	FG, SCOPE = connect_instruments(FG, SCOPE)
+
+	entries = []
+	electrkey = None
+	t_start = perf_counter()
+	for n, point in enumerate(todo):
+		if point['electrkey'] != electrkey:
+			electrkey = point['electrkey']
+			if on_electrode is not None:
+				on_electrode(electrkey)
+
+		print_line()
+		print('Campaign point %i/%i: %s' % (n+1, len(todo), point_key(point)))
+		t_point = perf_counter()
+		msp = point_settings(ms, point)
+		date_time = get_date_time()
+		filename = sample_filename(date_time, msp, 'CHAN2', point['repeat'])
+		try:
+			data = measure_hysteresis(filename, msp, FG=FG, SCOPE=SCOPE)
+			# every sample (CHAN2 + optional CHAN3/CHAN4) is saved on its own
+			samples = calculate_hysteresis_samples(data, msp, filename, periods=msp.get('periods', False))
+			for channel, (sample, result) in samples.items():
+				msc = sample_settings(msp, channel)
+				samplename = sample_filename(date_time, msp, channel, point['repeat'])
+				fig = plot_data(sample, msc, samplename)
+				save_all(sample, result, fig, samplename, mode='measure')
+				plt.close(fig)
+			result = samples['CHAN2'][1]
+		except KeyboardInterrupt:
+			FG.off()
+			raise
+		except Exception as err:
+			# journaled as failed --> measured again when the campaign is resumed
+			print('... point failed: %r' % err)
+			append_journal(cs['journal'], failure_entry(point, filename, err))
+			try:
+				FG.off()
+			except Exception:
+				pass
+			if not is_point_error(err):
+				raise
+			continue
+
+		entry = {'key':point_key(point), 'filename':filename, 'PR':float(result['PR']),
+				 'EC':float(result['EC']), 'seconds':perf_counter() - t_point}
+		if len(samples) > 1:
+			entry['samples'] = dict((channel, {'PR':float(result['PR']), 'EC':float(result['EC'])})
+									for channel, (sample, result) in samples.items())
+		append_journal(cs['journal'], entry)
+		entries.append(entry)
+
+		elapsed = perf_counter() - t_start
+		print('... campaign: %i/%i points, %.1f measurements/h' % (n+1, len(todo), len(entries)/elapsed*3600))
+
+	FG.off()
+	print_line()
+	print('Campaign finished: %i points in %.1f min' % (len(entries), (perf_counter() - t_start)/60))
+	return entries
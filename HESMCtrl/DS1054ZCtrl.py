@@ -7,11 +7,13 @@ The class :py:mod:`ds1054z.DS1054Z` - Easy communication with your scope
 
 import logging
 import re
+import socket
 import time
 import sys
 import struct
 import decimal
 
+import numpy as np
 import vxi11
 
 logger = logging.getLogger(__name__)
@@ -21,6 +23,508 @@ try:
 except AttributeError:
     clock = time.time
 
+TRANSPORT_ERRORS = (IOError, OSError, EOFError, vxi11.vxi11.Vxi11Exception)
+
+PREAMBLE_KEYS = ('fmt', 'typ', 'pnts', 'cnt', 'xinc', 'xorig', 'xref', 'yinc', 'yorig', 'yref')
+
+class AcquisitionState(object):
+    """
+    Cached state of the scope belonging to a single acquisition.
+
+    Every value starts out unknown (``None``) and is filled in by
+    :py:class:`DS1054Z` the first time it has to query it. Until the
+    driver invalidates the state (by starting, stopping or re-scaling
+    the acquisition) the cached values are reused instead of asking
+    the scope again.
+
+    :ivar running: result of :py:attr:`DS1054Z.running`
+    :ivar single: a single trigger acquisition (:py:meth:`DS1054Z.single`) is pending,
+        it stops by itself, so ``running = True`` is not cached for it
+    :ivar waveform_mode: the ``:WAVeform:MODE`` last set (``'NORM'``, ``'MAX'`` or ``'RAW'``)
+    :ivar memory_depth: the total number of samples in the deep memory
+    :ivar preambles: preamble dicts keyed by ``(channel, mode)``
+    :ivar current_preamble: preamble dict of the waveform read last
+    :ivar waveform_setup: the ``:WAVeform:`` settings sent (SOURce, FORMat, MODE, STARt, STOP)
+    """
+
+    def __init__(self):
+        self.running = None
+        self.single = False
+        self.waveform_mode = None
+        self.memory_depth = None
+        self.preambles = {}
+        self.current_preamble = None
+        self.waveform_setup = {}
+
+    @staticmethod
+    def mode_key(mode):
+        """ normalizes 'NORMal', 'NORM', 'MAXimum', 'RAW' ... to 'NORM', 'MAX', 'RAW' """
+        mode = mode.upper()
+        return 'NORM' if mode.startswith('NOR') else mode[:3]
+
+class TimeAxis(object):
+    """
+    The sample timestamps of a waveform: ``xorig + i * xinc`` for ``i < pnts``.
+
+    Behaves like a read-only sequence of floats, but nothing is allocated
+    until the values are requested. Indexing with an integer returns a
+    float, slicing and :py:meth:`to_array` return a :py:class:`numpy.ndarray`.
+    Use :py:attr:`increment` if only the sample spacing is needed.
+
+    >>> axis = TimeAxis(2e-5, -1.456e-2, 1200)
+    >>> axis[1] - axis[0] == axis.increment
+    True
+    """
+
+    def __init__(self, xinc, xorig, pnts):
+        self.xinc = xinc
+        self.xorig = xorig
+        self.pnts = int(pnts)
+
+    @classmethod
+    def from_preamble(cls, wp, pnts=None):
+        """ Creates the time axis from a preamble dict (and an optional number of points) """
+        return cls(wp['xinc'], wp['xorig'], wp['pnts'] if pnts is None else pnts)
+
+    @property
+    def increment(self):
+        """ time between subsequent samples (in seconds) """
+        return self.xinc
+
+    def __len__(self):
+        return self.pnts
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.xinc * np.arange(*index.indices(self.pnts)) + self.xorig
+        if index < 0:
+            index += self.pnts
+        if not 0 <= index < self.pnts:
+            raise IndexError('time axis index out of range')
+        return self.xinc * index + self.xorig
+
+    def __iter__(self):
+        return iter(self.to_array().tolist())
+
+    def __array__(self, dtype=None, copy=None):
+        return self.to_array(dtype=dtype or np.float64)
+
+    def __repr__(self):
+        return 'TimeAxis(xinc={0!r}, xorig={1!r}, pnts={2!r})'.format(self.xinc, self.xorig, self.pnts)
+
+    def to_array(self, dtype=np.float64):
+        """
+        :return: all sample timestamps (in seconds)
+        :rtype: numpy.ndarray
+        """
+        return (self.xinc * np.arange(self.pnts) + self.xorig).astype(dtype, copy=False)
+
+class WaveformCapture(object):
+    """
+    The waveforms of several channels read from one acquisition,
+    as returned by :py:meth:`DS1054Z.capture()`.
+
+    The raw BYTE data and the preamble of every channel are kept,
+    the voltages are decoded on first access and cached:
+
+    >>> block = scope.capture(['CHAN1', 'CHAN2'])
+    >>> vset, vref = block['CHAN1'], block['CHAN2']
+
+    :ivar time: the :py:class:`TimeAxis` shared by all channels
+    :ivar channels: the channel names in the order they were read
+    :ivar raw: the waveform bytes of every channel
+    :ivar preambles: the preamble dict of every channel
+    :ivar masks: the ``mask_begin_num`` of every channel
+    """
+
+    def __init__(self, time, channels, raw, preambles, masks, dtype=np.float64):
+        self.time = time
+        self.channels = list(channels)
+        self.raw = raw
+        self.preambles = preambles
+        self.masks = masks
+        self.dtype = dtype
+        self._samples = {}
+
+    def __len__(self):
+        return len(self.time)
+
+    def __contains__(self, channel):
+        return channel in self.raw
+
+    def __getitem__(self, channel):
+        if type(channel) == int:
+            channel = 'CHAN' + str(channel)
+        samples = self._samples.get(channel)
+        if samples is None:
+            wp = self.preambles[channel]
+            samples = DS1054Z.decode_waveform_bytes(self.raw[channel], wp['yinc'], wp['yorig'], wp['yref'],
+                                                    mask_begin_num=self.masks[channel], dtype=self.dtype)
+            self._samples[channel] = samples
+        return samples
+
+    def codes(self, channel):
+        """
+        :return: the undecoded BYTE values (ADC codes) of a channel
+        :rtype: numpy.ndarray of uint8
+        """
+        return np.frombuffer(self.raw[channel], dtype=np.uint8)
+
+class ReadoutError(IOError):
+    """
+    Raised by :py:class:`ChunkedReadout` when a chunk could not be read
+    after all retries. The partially filled readout is available as the
+    ``readout`` attribute and can be continued with its ``read()`` method.
+    """
+
+    def __init__(self, msg, readout):
+        super(ReadoutError, self).__init__(msg)
+        self.readout = readout
+
+class AcquisitionTimeout(IOError):
+    """
+    Raised by :py:meth:`DS1054Z.wait_for_acquisition` when the scope did
+    not report a completed acquisition within the timeout.
+    """
+
+class ChunkedReadout(object):
+    """
+    Reads the waveform of one channel from the deep memory in chunks.
+
+    Every chunk is copied straight to its final offset in a preallocated
+    buffer (a :py:obj:`bytearray` by default, any writable buffer like a
+    :py:class:`numpy.memmap` can be passed as ``out``).
+
+    The chunk size starts at :py:attr:`MAX_CHUNK` and follows the measured
+    throughput so a single transfer takes about ``chunk_time`` seconds.
+    If a transfer fails, the chunk size is halved and the chunk is read
+    again, up to ``retries`` times. After that a :py:class:`ReadoutError`
+    is raised; calling :py:meth:`read` again resumes at the last good chunk.
+
+    Instead of filling a buffer, every chunk can be handed to a
+    ``consumer(offset, chunk)`` (e.g. a :py:class:`WaveformBinner`),
+    then no buffer is allocated at all.
+
+    The waveform source and mode have to be set up already, see
+    :py:meth:`DS1054Z.get_waveform_bytes`.
+
+    :ivar done: number of bytes read so far
+    :ivar throughput: smoothed transfer rate in bytes per second
+    """
+
+    MAX_CHUNK = 250000
+    MIN_CHUNK = 1000
+
+    def __init__(self, scope, pnts, out=None, progress=None, chunk_time=None, retries=3, consumer=None):
+        self.scope = scope
+        self.pnts = pnts
+        self.consumer = consumer
+        if consumer is not None:
+            self.buffer = None
+        else:
+            self.buffer = bytearray(pnts) if out is None else out
+        self.progress = progress
+        self.chunk_time = chunk_time if chunk_time else 0.25 * getattr(scope, 'timeout', 10)
+        self.retries = retries
+        self.chunk_size = self.MAX_CHUNK
+        self.throughput = None
+        self.done = 0
+
+    @property
+    def finished(self):
+        return self.done >= self.pnts
+
+    def read(self):
+        """
+        Reads the remaining chunks.
+
+        :return: the filled buffer (None if the chunks went to the consumer)
+        """
+        view = None if self.buffer is None else memoryview(self.buffer).cast('B')
+        failures = 0
+        while not self.finished:
+            size = min(self.chunk_size, self.pnts - self.done)
+            t_start = clock()
+            try:
+                chunk = self._read_chunk(size)
+            except TRANSPORT_ERRORS as exc:
+                failures += 1
+                logger.warning('chunk at {0} failed ({1}), retrying'.format(self.done, exc))
+                self._recover()
+                self.chunk_size = max(self.MIN_CHUNK, self.chunk_size // 2)
+                if failures > self.retries:
+                    raise ReadoutError('reading chunk at {0} of {1} failed: {2}'.format(self.done, self.pnts, exc), self)
+                continue
+            self._adapt(size, clock() - t_start)
+            failures = 0
+            if view is None:
+                self.consumer(self.done, chunk)
+            else:
+                view[self.done:self.done + size] = chunk
+            self.done += size
+            if self.progress:
+                self.progress(self.done, self.pnts)
+        return self.buffer
+
+    def _read_chunk(self, size):
+        """ :return: the next ``size`` waveform bytes (a view into the received block) """
+        scope = self.scope
+        start = self.done + 1
+        commands = scope._waveform_setup_commands(STARt=start, STOP=start + size - 1)
+        block = scope.query_raw_batch(commands, ":WAVeform:DATA?")
+        offset, length = DS1054Z.ieee_block_span(block)
+        # the header may announce more bytes than arrived (truncated block)
+        length = min(length, len(block) - offset)
+        if length != size:
+            raise IOError('expected {0} bytes, received {1}'.format(size, length))
+        return memoryview(block)[offset:offset + size]
+
+    def _recover(self):
+        """ resyncs the link and makes sure STARt/STOP are sent again """
+        setup = self.scope.acquisition_state.waveform_setup
+        setup.pop('STARt', None)
+        setup.pop('STOP', None)
+        try:
+            self.scope.clear()
+        except (AttributeError,) + TRANSPORT_ERRORS:
+            pass
+
+    def _adapt(self, size, seconds):
+        rate = size / max(seconds, 1e-6)
+        self.throughput = rate if self.throughput is None else 0.5 * (self.throughput + rate)
+        self.chunk_size = int(max(self.MIN_CHUNK, min(self.MAX_CHUNK, self.throughput * self.chunk_time)))
+
+class WaveformBinner(object):
+    """
+    Boxcar decimation of BYTE waveform data arriving in chunks,
+    to be used as the ``consumer`` of a :py:class:`ChunkedReadout`.
+
+    The ``pnts`` samples are split into consecutive bins of
+    ``bin_size = pnts // bins`` samples (the less than ``bin_size``
+    samples left over at the end are dropped), so every bin covers the
+    same time span. For every bin only the sum, the minimum and the
+    maximum of the ADC codes are kept: the memory needed does not depend
+    on ``pnts`` and a bin may be spread over several chunks.
+
+    Averaging ``bin_size`` codes resolves fractions of a code, the mean
+    has up to ``log2(bin_size)/2`` bits more than the 8 bit ADC
+    (if the noise dithers the codes).
+
+    :ivar bins: the number of bins (can be larger than requested if ``bins`` does not divide ``pnts``)
+    :ivar bin_size: the number of samples per bin
+    :ivar sum: sum of the codes of every bin
+    :ivar min: smallest code of every bin
+    :ivar max: largest code of every bin
+    """
+
+    def __init__(self, pnts, bins):
+        self.pnts = int(pnts)
+        self.bin_size = max(1, self.pnts // int(bins))
+        self.bins = self.pnts // self.bin_size
+        self.sum = np.zeros(self.bins, dtype=np.int64)
+        self.min = np.full(self.bins, 255, dtype=np.uint8)
+        self.max = np.zeros(self.bins, dtype=np.uint8)
+
+    def __call__(self, offset, chunk):
+        """
+        Adds the codes ``chunk`` starting at sample ``offset``.
+        """
+        codes = np.frombuffer(chunk, dtype=np.uint8)
+        end = min(offset + len(codes), self.bins * self.bin_size)
+        if end <= offset:
+            return
+        codes = codes[:end - offset]
+        first, last = offset // self.bin_size, (end - 1) // self.bin_size + 1
+        # start of every bin within the chunk, the first one may have begun in the chunk before
+        starts = np.arange(first, last) * self.bin_size - offset
+        starts[0] = 0
+        self.sum[first:last] += np.add.reduceat(codes, starts, dtype=np.int64)
+        np.minimum(self.min[first:last], np.minimum.reduceat(codes, starts), out=self.min[first:last])
+        np.maximum(self.max[first:last], np.maximum.reduceat(codes, starts), out=self.max[first:last])
+
+    def time_axis(self, wp):
+        """
+        :param dict wp: the preamble of the binned waveform
+        :return: the centers of the bins
+        :rtype: TimeAxis
+        """
+        return TimeAxis(wp['xinc'] * self.bin_size, wp['xorig'] + wp['xinc'] * (self.bin_size - 1) / 2., self.bins)
+
+    def decode(self, yinc, yorig, yref, dtype=np.float64):
+        """
+        Converts the bins to voltages, see :py:meth:`DS1054Z.decode_waveform_bytes`.
+
+        :return: (mean, minimum, maximum) voltage of every bin
+        :rtype: tuple of numpy.ndarray
+        """
+        mean = self.sum.astype(dtype)
+        mean /= self.bin_size
+        result = []
+        for codes in (mean, self.min.astype(dtype), self.max.astype(dtype)):
+            codes -= yorig + yref
+            codes *= yinc
+            result.append(codes)
+        return tuple(result)
+
+class BinnedCapture(object):
+    """
+    The binned deep memory of several channels,
+    as returned by :py:meth:`DS1054Z.capture_binned()`.
+
+    Indexing returns the mean voltage of every bin like
+    :py:class:`WaveformCapture`, the extremes are available by
+    :py:meth:`min` and :py:meth:`max`:
+
+    >>> block = scope.capture_binned(['CHAN1', 'CHAN2'], bins=5000)
+    >>> vref, vref_min, vref_max = block['CHAN2'], block.min('CHAN2'), block.max('CHAN2')
+
+    :ivar time: the :py:class:`TimeAxis` of the bin centers
+    :ivar channels: the channel names in the order they were read
+    :ivar binners: the :py:class:`WaveformBinner` of every channel
+    :ivar preambles: the preamble dict of every channel
+    """
+
+    def __init__(self, time, channels, binners, preambles, dtype=np.float64):
+        self.time = time
+        self.channels = list(channels)
+        self.binners = binners
+        self.preambles = preambles
+        self.dtype = dtype
+        self._samples = {}
+
+    def __len__(self):
+        return len(self.time)
+
+    def __contains__(self, channel):
+        return channel in self.binners
+
+    @property
+    def bin_size(self):
+        """ number of samples averaged per bin """
+        return self.binners[self.channels[0]].bin_size
+
+    def _decoded(self, channel):
+        if type(channel) == int:
+            channel = 'CHAN' + str(channel)
+        samples = self._samples.get(channel)
+        if samples is None:
+            wp = self.preambles[channel]
+            samples = self.binners[channel].decode(wp['yinc'], wp['yorig'], wp['yref'], dtype=self.dtype)
+            self._samples[channel] = samples
+        return samples
+
+    def __getitem__(self, channel):
+        return self._decoded(channel)[0]
+
+    def min(self, channel):
+        """ :return: the smallest voltage in every bin """
+        return self._decoded(channel)[1]
+
+    def max(self, channel):
+        """ :return: the largest voltage in every bin """
+        return self._decoded(channel)[2]
+
+class Vxi11Transport(object):
+    """
+    The VXI-11 link :py:class:`DS1054Z` inherits from :py:class:`vxi11.Instrument`.
+    This is the default transport.
+    """
+
+    def __init__(self, scope):
+        self.scope = scope
+
+    def write_raw(self, data):
+        super(DS1054Z, self.scope).write_raw(data)
+
+    def read_raw(self, num=-1):
+        return super(DS1054Z, self.scope).read_raw(num)
+
+    def query_raw(self, data, num=-1):
+        self.write_raw(data)
+        return self.read_raw(num)
+
+    def clear(self):
+        super(DS1054Z, self.scope).clear()
+
+    def close(self):
+        super(DS1054Z, self.scope).close()
+
+class SocketTransport(object):
+    """
+    Plain SCPI over a TCP socket (the DS1000Z listens on port 5555).
+
+    The connection is kept open and read through a buffered file object.
+    Answers starting with ``#`` are read as IEEE binary blocks of the
+    announced length, all other answers up to the newline. The newline
+    following a block is skipped when the next answer is read.
+
+    >>> scope = DS1054Z('192.168.1.2', transport='socket')
+    """
+
+    PORT = 5555
+
+    def __init__(self, host, port=None, timeout=10):
+        self.host = host
+        self.port = port or self.PORT
+        self.timeout = timeout
+        self.sock = None
+        self.rfile = None
+        self.block_terminator_pending = False
+
+    def open(self):
+        if self.sock is not None:
+            return
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.sock.makefile('rb', 65536)
+
+    def close(self):
+        if self.sock is None:
+            return
+        self.rfile.close()
+        self.sock.close()
+        self.sock = None
+        self.rfile = None
+        self.block_terminator_pending = False
+
+    def write_raw(self, data):
+        self.open()
+        if not data.endswith(b'\n'):
+            data += b'\n'
+        self.sock.sendall(data)
+
+    def _read_exactly(self, num):
+        data = self.rfile.read(num)
+        if data is None or len(data) < num:
+            raise EOFError('connection closed after {0} of {1} bytes'.format(len(data or b''), num))
+        return data
+
+    def read_raw(self, num=-1):
+        self.open()
+        first = self._read_exactly(1)
+        if self.block_terminator_pending:
+            self.block_terminator_pending = False
+            if first == b'\n':
+                first = self._read_exactly(1)
+        if first != b'#':
+            line = first + self.rfile.readline()
+            if not line.endswith(b'\n'):
+                raise EOFError('connection closed while reading an answer')
+            return line
+        n_digits = self._read_exactly(1)
+        length = self._read_exactly(int(n_digits.decode('ascii')))
+        data = self._read_exactly(int(length.decode('ascii')))
+        self.block_terminator_pending = True
+        return first + n_digits + length + data
+
+    def query_raw(self, data, num=-1):
+        self.write_raw(data)
+        return self.read_raw(num)
+
+    def clear(self):
+        """ drops the connection, unread answers are discarded with it """
+        self.close()
+
 class DS1054Z(vxi11.Instrument):
     """
     This class represents the oscilloscope.
@@ -29,11 +533,18 @@ class DS1054Z(vxi11.Instrument):
     :ivar vendor:  should be ``'RIGOL TECHNOLOGIES'``
     :ivar serial:  e.g. ``'DS1ZA118171631'``
     :ivar firmware: e.g. ``'00.04.03.SP1'``
+    :ivar transport: the link used for :py:meth:`write_raw` and :py:meth:`read_raw`
+    :ivar metrics: a :py:class:`HESMCtrl.Metrics.InstrumentMetrics` recording every exchange, or None
+
+    The keyword argument ``transport`` selects the link to the scope:
+    ``'vxi11'`` (default), ``'socket'`` (raw SCPI on TCP port 5555)
+    or an instance of :py:class:`Vxi11Transport` / :py:class:`SocketTransport`.
     """
 
     IDN_PATTERN = r'^RIGOL TECHNOLOGIES,DS1\d\d\dZ( Plus)?,'
     ENCODING = 'utf-8'
     H_GRID = 12
+    V_GRID = 8
     SAMPLES_ON_DISPLAY = 1200
     DISPLAY_DATA_BYTES = 100000
     SCALE_MANTISSAE = (1, 2, 5)
@@ -44,10 +555,18 @@ class DS1054Z(vxi11.Instrument):
     MIN_PROBE_RATIO = 0.01
     MAX_PROBE_RATIO = 1000
     CHANNEL_LIST = ("CHAN1", "CHAN2", "CHAN3", "CHAN4", "MATH")
+    PIPELINE_COMMANDS = True
 
     def __init__(self, host, *args, **kwargs):
         self.start = clock()
+        transport = kwargs.pop('transport', 'vxi11')
         super(DS1054Z, self).__init__(host, *args, **kwargs)
+        if transport == 'vxi11':
+            transport = Vxi11Transport(self)
+        elif transport == 'socket':
+            transport = SocketTransport(host, timeout=self.timeout)
+        self.transport = transport
+        self.metrics = None
         idn = self.idn
         match = re.match(self.IDN_PATTERN, idn)
         if not match:
@@ -62,6 +581,7 @@ class DS1054Z(vxi11.Instrument):
         self.serial = idn[2]
         self.firmware = idn[3]
         self.mask_begin_num = None
+        self.acquisition_state = AcquisitionState()
         self.possible_probe_ratio_values = self._populate_possible_values('PROBE_RATIO')
         self.possible_timebase_scale_values = self._populate_possible_values('TIMEBASE_SCALE')
         self.possible_channel_scale_values = self._populate_possible_values('CHANNEL_SCALE')
@@ -76,21 +596,45 @@ class DS1054Z(vxi11.Instrument):
         logger.info('{0:.3f} - {1}'.format(self.clock(), msg))
 
     def write_raw(self, cmd, *args, **kwargs):
-        self.log_timing('starting write')
-        logger.debug('sending: ' + repr(cmd))
-        super(DS1054Z, self).write_raw(cmd, *args, **kwargs)
-        self.log_timing('finishing write')
+        logging_enabled = logger.isEnabledFor(logging.INFO)
+        if logging_enabled:
+            self.log_timing('starting write')
+            logger.debug('sending: ' + repr(cmd))
+        if self.metrics is None:
+            self.transport.write_raw(cmd, *args, **kwargs)
+        else:
+            t_start = clock()
+            self.transport.write_raw(cmd, *args, **kwargs)
+            self.metrics.record_write(cmd, clock() - t_start)
+        if logging_enabled:
+            self.log_timing('finishing write')
 
     def read_raw(self, *args, **kwargs):
-        self.log_timing('starting read')
-        data = super(DS1054Z, self).read_raw(*args, **kwargs)
-        self.log_timing('finished reading {0} bytes'.format(len(data)))
-        if len(data) > 200:
-            logger.debug('received a long answer: {0} ... {1}'.format(format_hex(data[0:10]), format_hex(data[-10:])))
+        logging_enabled = logger.isEnabledFor(logging.INFO)
+        if logging_enabled:
+            self.log_timing('starting read')
+        if self.metrics is None:
+            data = self.transport.read_raw(*args, **kwargs)
         else:
-            logger.debug('received: ' + repr(data))
+            t_start = clock()
+            data = self.transport.read_raw(*args, **kwargs)
+            self.metrics.record_read(len(data), clock() - t_start)
+        if logging_enabled:
+            self.log_timing('finished reading {0} bytes'.format(len(data)))
+            if len(data) > 200:
+                logger.debug('received a long answer: {0} ... {1}'.format(format_hex(data[0:10]), format_hex(data[-10:])))
+            else:
+                logger.debug('received: ' + repr(data))
         return data
 
+    def clear(self):
+        """ Clears the link to the scope (device clear or reconnect). """
+        self.transport.clear()
+
+    def close(self):
+        """ Closes the link to the scope. """
+        self.transport.close()
+
     def query(self, message, *args, **kwargs):
         """
         Write a message to the scope and read back the answer.
@@ -112,6 +656,72 @@ class DS1054Z(vxi11.Instrument):
         data = message.encode(self.ENCODING)
         return self.ask_raw(data, *args, **kwargs)
 
+    def invalidate_acquisition_state(self):
+        """
+        Forget all values cached in :py:attr:`acquisition_state`.
+
+        This is done automatically by the methods of this class changing
+        the acquisition (:py:meth:`run`, :py:meth:`stop`, :py:meth:`single`,
+        :py:attr:`timebase_scale`, :py:meth:`set_channel_scale`, ...).
+        Call it yourself if the scope settings were changed otherwise
+        (e.g. on the front panel).
+        """
+        self.acquisition_state = AcquisitionState()
+
+    def write_batch(self, commands):
+        """
+        Sends several commands to the scope.
+
+        If :py:attr:`PIPELINE_COMMANDS` is set, the commands are joined by
+        semicolons into a single message, saving a round trip per command.
+
+        :param commands: SCPI commands (with leading colon)
+        :type commands: list of str
+        """
+        if not commands:
+            return
+        if self.PIPELINE_COMMANDS:
+            self.write(';'.join(commands))
+        else:
+            for command in commands:
+                self.write(command)
+
+    def query_batch(self, commands, message):
+        """
+        Sends several commands followed by a query and returns the answer.
+        The commands are prepended to the query message if
+        :py:attr:`PIPELINE_COMMANDS` is set.
+        """
+        if self.PIPELINE_COMMANDS and commands:
+            return self.query(';'.join(list(commands) + [message]))
+        self.write_batch(commands)
+        return self.query(message)
+
+    def query_raw_batch(self, commands, message):
+        """
+        Same as :py:meth:`query_batch` but the answer is returned as bytes.
+        """
+        if self.PIPELINE_COMMANDS and commands:
+            return self.query_raw(';'.join(list(commands) + [message]))
+        self.write_batch(commands)
+        return self.query_raw(message)
+
+    def _waveform_setup_commands(self, **settings):
+        """
+        Returns the ``:WAVeform:`` commands needed to apply the given settings
+        (SOURce, FORMat, MODE, STARt, STOP), omitting those already sent
+        during the current acquisition.
+        """
+        setup = self.acquisition_state.waveform_setup
+        commands = []
+        for key in ('SOURce', 'FORMat', 'MODE', 'STARt', 'STOP'):
+            if key in settings and setup.get(key) != settings[key]:
+                commands.append(':WAVeform:{0} {1}'.format(key, settings[key]))
+                setup[key] = settings[key]
+        if 'MODE' in settings:
+            self.acquisition_state.waveform_mode = AcquisitionState.mode_key(settings['MODE'])
+        return commands
+
     def _interpret_channel(self, channel):
         """ wrapper to allow specifying channels by their name (str) or by their number (int) """
         if type(channel) == int:
@@ -120,7 +730,20 @@ class DS1054Z(vxi11.Instrument):
 
     @property
     def running(self):
-        return self.query(':TRIGger:STATus?') in ('TD', 'WAIT', 'RUN', 'AUTO')
+        running = self.query(':TRIGger:STATus?') in ('TD', 'WAIT', 'RUN', 'AUTO')
+        self.acquisition_state.running = running
+        return running
+
+    def _running_cached(self):
+        """
+        :py:attr:`running`, queried only once per acquisition.
+        While a single trigger acquisition is pending, the scope is asked
+        again until it has stopped by itself.
+        """
+        state = self.acquisition_state
+        if state.running is None or (state.running and state.single):
+            return self.running
+        return state.running
 
     @property
     def waveform_preamble(self):
@@ -140,7 +763,14 @@ class DS1054Z(vxi11.Instrument):
         :return: (fmt, typ, pnts, cnt, xinc, xorig, xref, yinc, yorig, yref)
         :rtype: tuple of float and int values
         """
-        values = self.query(":WAVeform:PREamble?")
+        return self.parse_waveform_preamble(self.query(":WAVeform:PREamble?"))
+
+    @staticmethod
+    def parse_waveform_preamble(values):
+        """
+        Converts the answer of ``:WAVeform:PREamble?`` to a tuple,
+        see :py:attr:`waveform_preamble`.
+        """
         #
         # From the Programming Guide:
         # format: <format>,<type>,<points>,<count>,<xincrement>,<xorigin>,<xreference>,<yincrement>,<yorigin>,<yreference>
@@ -175,8 +805,35 @@ class DS1054Z(vxi11.Instrument):
         :return: {'fmt', 'typ', 'pnts', 'cnt', 'xinc', 'xorig', 'xref', 'yinc', 'yorig', 'yref'}
         :rtype: dict
         """
-        keys = 'fmt, typ, pnts, cnt, xinc, xorig, xref, yinc, yorig, yref'.split(', ')
-        return dict(zip(keys, self.waveform_preamble))
+        return dict(zip(PREAMBLE_KEYS, self.waveform_preamble))
+
+    def _waveform_preamble_cached(self, channel, mode, commands=()):
+        """
+        The preamble dict of the given channel and waveform mode,
+        queried only once per acquisition.
+
+        The commands setting the waveform source and mode are sent
+        together with the preamble query (or alone if it is cached).
+        """
+        state = self.acquisition_state
+        key = (channel, AcquisitionState.mode_key(mode))
+        wp = state.preambles.get(key)
+        if wp is None:
+            values = self.query_batch(commands, ":WAVeform:PREamble?")
+            wp = dict(zip(PREAMBLE_KEYS, self.parse_waveform_preamble(values)))
+            state.preambles[key] = wp
+        else:
+            self.write_batch(commands)
+        state.current_preamble = wp
+        return wp
+
+    def _current_preamble(self):
+        """ The preamble dict of the waveform read last (queried if unknown) """
+        wp = self.acquisition_state.current_preamble
+        if wp is None:
+            wp = self.waveform_preamble_dict
+            self.acquisition_state.current_preamble = wp
+        return wp
 
     def get_waveform_samples(self, channel, mode='NORMal'):
         """
@@ -197,27 +854,68 @@ class DS1054Z(vxi11.Instrument):
         horizontally so that it starts or ends inside the screen area,
         the missing data points are being set to float('nan') in the list.
 
+        This is the list flavour of :py:meth:`get_waveform_array()`.
+
         :param channel: The channel name (like 'CHAN1' or 1).
         :type channel: int or str
         :param str mode: can be 'NORMal', 'MAX', or 'RAW'
         :return: voltage samples
         :rtype: list of float values
         """
+        return self.get_waveform_array(channel, mode=mode).tolist()
+
+    def get_waveform_array(self, channel, mode='NORMal', dtype=np.float64):
+        """
+        Returns the waveform voltage samples of the specified channel
+        as a :py:class:`numpy.ndarray`.
+
+        Same as :py:meth:`get_waveform_samples()` but the byte buffer is
+        decoded without building intermediate Python lists, which matters
+        when reading the deep memory (12M/24M samples) in RAW mode.
 
+        :param channel: The channel name (like 'CHAN1' or 1).
+        :type channel: int or str
+        :param str mode: can be 'NORMal', 'MAX', or 'RAW'
+        :param dtype: floating point type of the result (float64 or float32)
+        :return: voltage samples
+        :rtype: numpy.ndarray
+        """
         buff = self.get_waveform_bytes(channel, mode=mode)
-        fmt, typ, pnts, cnt, xinc, xorig, xref, yinc, yorig, yref = self.waveform_preamble
-        samples = list(struct.unpack(str(len(buff))+'B', buff))
-        samples = [(val - yorig - yref)*yinc for val in samples]
-        if self.mask_begin_num:
-            at_begin = self.mask_begin_num[0]
-            num = self.mask_begin_num[1]
+        wp = self._current_preamble()
+        return DS1054Z.decode_waveform_bytes(buff, wp['yinc'], wp['yorig'], wp['yref'],
+                                             mask_begin_num=self.mask_begin_num, dtype=dtype)
+
+    @staticmethod
+    def decode_waveform_bytes(buff, yinc, yorig, yref, mask_begin_num=None, dtype=np.float64):
+        """
+        Converts BYTE waveform data to voltages: ``(raw - yorig - yref) * yinc``.
+
+        The buffer is wrapped with :py:func:`numpy.frombuffer` (no copy),
+        the conversion works in-place on a single output array.
+        Samples marked as padding by ``mask_begin_num`` are set to NaN.
+
+        :param buff: waveform data as returned by :py:meth:`get_waveform_bytes()`
+        :type buff: bytes, bytearray or memoryview
+        :param float yinc: vertical increment from the waveform preamble
+        :param int yorig: vertical origin from the waveform preamble
+        :param int yref: vertical reference from the waveform preamble
+        :param mask_begin_num: ``(at_begin, num)`` or None, see :py:attr:`mask_begin_num`
+        :param dtype: floating point type of the result
+        :return: voltage samples
+        :rtype: numpy.ndarray
+        """
+        samples = np.frombuffer(buff, dtype=np.uint8).astype(dtype)
+        samples -= yorig + yref
+        samples *= yinc
+        if mask_begin_num:
+            at_begin, num = mask_begin_num
             if at_begin:
-                samples = [float('nan')] * num + samples[num:]
+                samples[:num] = np.nan
             else:
-                samples = samples[:-num] + [float('nan')] * num
+                samples[len(samples)-num:] = np.nan
         return samples
 
-    def get_waveform_bytes(self, channel, mode='NORMal'):
+    def get_waveform_bytes(self, channel, mode='NORMal', progress=None):
         """
         Get the waveform data for a specific channel as :py:obj:`bytes`.
         (In most cases you would want to use the higher level
@@ -235,19 +933,20 @@ class DS1054Z(vxi11.Instrument):
 
         In case the internal memory will be read, the data request will
         automatically be split into chunks if it's impossible to read
-        all bytes at once.
+        all bytes at once (see :py:class:`ChunkedReadout`).
 
         :param channel: The channel name (like CHAN1, ...). Alternatively specify the channel by its number (as integer).
         :type channel: int or str
         :param str mode: can be NORMal, MAXimum, or RAW
+        :param progress: called as ``progress(bytes_done, bytes_total)`` after every chunk of the internal memory
         :return: The waveform data
-        :rtype: bytes
+        :rtype: bytes or bytearray
         """
         channel = self._interpret_channel(channel)
-        if mode.upper().startswith('NORM') or (self.running and mode.upper().startswith('MAX')):
+        if mode.upper().startswith('NORM') or (mode.upper().startswith('MAX') and self._running_cached()):
             return self._get_waveform_bytes_screen(channel, mode=mode)
         else:
-            return self._get_waveform_bytes_internal(channel, mode=mode)
+            return self._get_waveform_bytes_internal(channel, mode=mode, progress=progress)
 
     def _get_waveform_bytes_screen(self, channel, mode='NORMal'):
         """
@@ -256,10 +955,8 @@ class DS1054Z(vxi11.Instrument):
         """
         channel = self._interpret_channel(channel)
         assert mode.upper().startswith('NOR') or mode.upper().startswith('MAX')
-        self.write(":WAVeform:SOURce " + channel)
-        self.write(":WAVeform:FORMat BYTE")
-        self.write(":WAVeform:MODE " + mode)
-        wp = self.waveform_preamble_dict
+        commands = self._waveform_setup_commands(SOURce=channel, FORMat='BYTE', MODE=mode)
+        wp = self._waveform_preamble_cached(channel, mode, commands)
         pnts = wp['pnts']
         starting_at = 1
         stopping_at = self.SAMPLES_ON_DISPLAY
@@ -273,13 +970,13 @@ class DS1054Z(vxi11.Instrument):
             """
             self.write(":WAVeform:STARt {0}".format(self.SAMPLES_ON_DISPLAY))
             self.write(":WAVeform:STARt 1")
+            self.acquisition_state.waveform_setup['STARt'] = None
             if int(self.query(":WAVeform:STARt?")) != 1:
                 starting_at = self.SAMPLES_ON_DISPLAY - pnts + 1
             else:
                 stopping_at = pnts
-        self.write(":WAVeform:STARt {0}".format(starting_at))
-        self.write(":WAVeform:STOP {0}".format(stopping_at))
-        tmp_buff = self.query_raw(":WAVeform:DATA?")
+        commands = self._waveform_setup_commands(STARt=starting_at, STOP=stopping_at)
+        tmp_buff = self.query_raw_batch(commands, ":WAVeform:DATA?")
         buff = DS1054Z.decode_ieee_block(tmp_buff)
         assert len(buff) == pnts
         if pnts < self.SAMPLES_ON_DISPLAY:
@@ -297,31 +994,194 @@ class DS1054Z(vxi11.Instrument):
             self.mask_begin_num = None
         return buff
 
-    def _get_waveform_bytes_internal(self, channel, mode='RAW'):
+    def _get_waveform_bytes_internal(self, channel, mode='RAW', progress=None, out=None, consumer=None):
         """
         This function returns the waveform bytes from the scope if you desire
         to read the bytes corresponding to the internal (deep) memory.
+        (Nothing is returned if the chunks are passed to a consumer,
+        see :py:class:`ChunkedReadout`.)
         """
         channel = self._interpret_channel(channel)
         assert mode.upper().startswith('MAX') or mode.upper().startswith('RAW')
-        if self.running:
+        if self._running_cached():
             self.stop()
-        self.write(":WAVeform:SOURce " + channel)
-        self.write(":WAVeform:FORMat BYTE")
-        self.write(":WAVeform:MODE " + mode)
-        wp = self.waveform_preamble_dict
-        pnts = wp['pnts']
-        buff = b""
-        max_byte_len = 250000
-        pos = 1
-        while len(buff) < pnts:
-            self.write(":WAVeform:STARt {0}".format(pos))
-            end_pos = min(pnts, pos+max_byte_len-1)
-            self.write(":WAVeform:STOP {0}".format(end_pos))
-            tmp_buff = self.query_raw(":WAVeform:DATA?")
-            buff += DS1054Z.decode_ieee_block(tmp_buff)
-            pos += max_byte_len
-        return buff
+        commands = self._waveform_setup_commands(SOURce=channel, FORMat='BYTE', MODE=mode)
+        wp = self._waveform_preamble_cached(channel, mode, commands)
+        self.mask_begin_num = None
+        return ChunkedReadout(self, wp['pnts'], out=out, progress=progress, consumer=consumer).read()
+
+    def capture(self, channels=("CHAN1", "CHAN2"), mode='NORMal', dtype=np.float64):
+        """
+        Reads the waveforms of several channels from the current acquisition.
+
+        The ``:WAVeform:`` settings common to all channels (FORMat, MODE,
+        STARt, STOP) are sent only once, for the following channels only
+        the source is switched. Commands are pipelined with the queries
+        (see :py:meth:`write_batch`), so a screen capture of two channels
+        takes four round trips.
+
+        :param channels: The channel names (like CHAN1, ...) or numbers.
+        :type channels: list of int or str
+        :param str mode: can be NORMal, MAXimum, or RAW
+        :param dtype: floating point type of the decoded voltages
+        :return: the waveforms with their shared time axis
+        :rtype: WaveformCapture
+        """
+        channels = [self._interpret_channel(channel) for channel in channels]
+        raw, preambles, masks = {}, {}, {}
+        for channel in channels:
+            raw[channel] = self.get_waveform_bytes(channel, mode=mode)
+            preambles[channel] = self.acquisition_state.current_preamble
+            masks[channel] = self.mask_begin_num
+        return WaveformCapture(self.waveform_time_axis, channels, raw, preambles, masks, dtype=dtype)
+
+    @staticmethod
+    def screen_deflection(codes, yinc, yref):
+        """
+        Clipping and range usage of BYTE waveform data (ADC codes).
+
+        :return: (number of clipped samples (code 0 or 255),
+                  largest deflection from the screen center in volts)
+        :rtype: (int, float)
+        """
+        codes = np.frombuffer(codes, dtype=np.uint8) if isinstance(codes, (bytes, bytearray)) else np.asarray(codes)
+        clipped = int(np.count_nonzero((codes == 0) | (codes == 255)))
+        if not len(codes):
+            return clipped, 0.0
+        deflection = max(int(codes.max()) - yref, yref - int(codes.min())) * yinc
+        return clipped, deflection
+
+    def autorange(self, channels, fill=0.8, max_iterations=2, clip_factor=5.):
+        """
+        Sets the vertical scale of the channels from single screen
+        captures (pre-shots) of the current signal: the smallest value
+        of :py:attr:`possible_channel_scale_values` showing the largest
+        deflection within ``fill`` of the screen height.
+
+        A clipped channel is scaled up by ``clip_factor`` and measured again,
+        so at most ``max_iterations`` captures are taken.
+
+        :param channels: The channel names (like CHAN1, ...) or numbers.
+        :param float fill: used fraction of the screen height (+- 4 div)
+        :param int max_iterations: maximum number of pre-shots
+        :param float clip_factor: scale factor for clipped channels
+        :return: the new scale of every channel
+        :rtype: dict
+        """
+        pending = [self._interpret_channel(channel) for channel in channels]
+        scales = {}
+        for iteration in range(max_iterations):
+            self.single()
+            self.tforce()
+            self.wait_for_acquisition()
+            block = self.capture(pending, mode='NORMal')
+            clipped_channels = []
+            for channel in pending:
+                wp = block.preambles[channel]
+                clipped, deflection = self.screen_deflection(block.codes(channel), wp['yinc'], wp['yref'])
+                probe_ratio = self.get_probe_ratio(channel)
+                possible = [val * probe_ratio for val in self.possible_channel_scale_values]
+                if clipped:
+                    # the real amplitude is unknown
+                    target = self.get_channel_scale(channel) * clip_factor
+                else:
+                    target = deflection / (self.V_GRID / 2. * fill)
+                larger = [val for val in possible if val >= target * (1 - 1e-9)]
+                scales[channel] = min(larger) if larger else max(possible)
+                if clipped and larger:
+                    clipped_channels.append(channel)
+                self.set_channel_scale(channel, scales[channel])
+                logger.info('autorange %s: %s clipped samples, deflection %g V -> scale %g V',
+                            channel, clipped, deflection, scales[channel])
+            pending = clipped_channels
+            if not pending:
+                break
+        if pending:
+            logger.warning('autorange: %s still clipped after %i pre-shots', ', '.join(pending), max_iterations)
+        return scales
+
+    def capture_to_file(self, path, channels=("CHAN1", "CHAN2"), mode='RAW', progress=None):
+        """
+        Streams the deep memory of several channels into a memory-mapped file.
+
+        The waveform bytes are written chunk by chunk into ``<path>.npy``
+        (a ``(channels, points)`` uint8 array), the preambles go to
+        ``<path>.json``. Nothing but the current chunk is held in memory.
+        The scope will be stopped first.
+
+        Open the capture later with
+        :py:func:`HESMCtrl.OSOperations.open_raw_capture`.
+
+        :param str path: file name without extension
+        :param channels: The channel names (like CHAN1, ...) or numbers.
+        :type channels: list of int or str
+        :param str mode: can be RAW or MAXimum
+        :param progress: called as ``progress(bytes_done, bytes_total)`` after every chunk
+        :return: the capture (opened for writing)
+        :rtype: HESMCtrl.OSOperations.RawCaptureFile
+        """
+        from HESMCtrl.OSOperations import create_raw_capture
+        channels = [self._interpret_channel(channel) for channel in channels]
+        if self._running_cached():
+            self.stop()
+        preambles = {}
+        for channel in channels:
+            commands = self._waveform_setup_commands(SOURce=channel, FORMat='BYTE', MODE=mode)
+            preambles[channel] = self._waveform_preamble_cached(channel, mode, commands)
+        pnts = set(wp['pnts'] for wp in preambles.values())
+        assert len(pnts) == 1, 'channels differ in number of points: {0}'.format(pnts)
+        capture = create_raw_capture(path, channels, preambles)
+        total = len(channels) * len(capture)
+        for i, channel in enumerate(channels):
+            channel_progress = None
+            if progress:
+                offset = i * len(capture)
+                channel_progress = lambda done, pnts: progress(offset + done, total)
+            self._get_waveform_bytes_internal(channel, mode=mode, progress=channel_progress,
+                                              out=capture.codes(channel))
+        capture.flush(complete=True)
+        return capture
+
+    def capture_binned(self, channels=("CHAN1", "CHAN2"), bins=5000, mode='RAW', progress=None, dtype=np.float64):
+        """
+        Reads the deep memory of several channels and decimates it on
+        the fly into ``bins`` points with the mean, minimum and maximum
+        of every bin (see :py:class:`WaveformBinner`).
+
+        Every chunk is binned right after it has been received, the full
+        waveform (up to 24M samples) is never held in memory.
+        The scope will be stopped first.
+
+        :param channels: The channel names (like CHAN1, ...) or numbers.
+        :type channels: list of int or str
+        :param int bins: number of points of the binned waveforms
+        :param str mode: can be RAW or MAXimum
+        :param progress: called as ``progress(bytes_done, bytes_total)`` after every chunk
+        :param dtype: floating point type of the decoded voltages
+        :return: the binned waveforms with the time axis of the bin centers
+        :rtype: BinnedCapture
+        """
+        channels = [self._interpret_channel(channel) for channel in channels]
+        if self._running_cached():
+            self.stop()
+        binners, preambles = {}, {}
+        total = None
+        for i, channel in enumerate(channels):
+            commands = self._waveform_setup_commands(SOURce=channel, FORMat='BYTE', MODE=mode)
+            wp = self._waveform_preamble_cached(channel, mode, commands)
+            preambles[channel] = wp
+            binners[channel] = WaveformBinner(wp['pnts'], bins)
+            channel_progress = None
+            if progress:
+                total = total or len(channels) * wp['pnts']
+                offset = i * wp['pnts']
+                channel_progress = lambda done, pnts: progress(offset + done, total)
+            self._get_waveform_bytes_internal(channel, mode=mode, progress=channel_progress,
+                                              consumer=binners[channel])
+        binned = set((binner.bins, binner.bin_size) for binner in binners.values())
+        assert len(binned) == 1, 'channels differ in number of points: {0}'.format(binned)
+        time = binners[channels[0]].time_axis(preambles[channels[0]])
+        return BinnedCapture(time, channels, binners, preambles, dtype=dtype)
 
     def _populate_possible_values(self, which):
         """
@@ -367,6 +1227,7 @@ class DS1054Z(vxi11.Instrument):
     @timebase_offset.setter
     def timebase_offset(self, new_offset):
         self.write(":TIMebase:MAIN:OFFSet {0}".format(new_offset))
+        self.invalidate_acquisition_state()
 
     @property
     def timebase_scale(self):
@@ -390,11 +1251,35 @@ class DS1054Z(vxi11.Instrument):
     def timebase_scale(self, new_timebase):
         new_timebase = min(self.possible_timebase_scale_values, key=lambda x:abs(x-new_timebase))
         self.write(":TIMebase:MAIN:SCALe {0}".format(new_timebase))
+        self.invalidate_acquisition_state()
 
     @property
     def sample_rate(self):
         return float(self.query(':ACQuire:SRATe?'))
 
+    @property
+    def waveform_time_axis(self):
+        """
+        The timestamps that belong to the waveform samples accessed
+        beforehand as a :py:class:`TimeAxis`.
+
+        Access this property only after fetching your waveform data,
+        otherwise the values will not be correct.
+
+        Uses the preamble cached in :py:attr:`acquisition_state`
+        while the acquisition did not change.
+
+        :return: sample timestamps (in seconds)
+        :rtype: TimeAxis
+        """
+        wp = self._current_preamble()
+        state = self.acquisition_state
+        if state.waveform_mode is None:
+            state.waveform_mode = AcquisitionState.mode_key(self.query(':WAVeform:MODE?'))
+        if state.waveform_mode == 'NORM' or self._running_cached():
+            return TimeAxis.from_preamble(wp, pnts=self.SAMPLES_ON_DISPLAY)
+        return TimeAxis.from_preamble(wp)
+
     @property
     def waveform_time_values(self):
         """
@@ -404,16 +1289,12 @@ class DS1054Z(vxi11.Instrument):
         Access this property only after fetching your waveform data,
         otherwise the values will not be correct.
 
-        Will be fetched every time you access this property.
+        This is the list flavour of :py:attr:`waveform_time_axis`.
 
         :return: sample timestamps (in seconds)
         :rtype: list of float
         """
-        wp = self.waveform_preamble_dict
-        tv = []
-        for i in range(self.memory_depth_curr_waveform):
-            tv.append(wp['xinc'] * i + wp['xorig'])
-        return tv
+        return self.waveform_time_axis.to_array().tolist()
 
     @property
     def waveform_time_values_decimal(self):
@@ -431,7 +1312,7 @@ class DS1054Z(vxi11.Instrument):
         :return: sample timestamps (in seconds)
         :rtype: list of :py:obj:`Decimal`
         """
-        wp = self.waveform_preamble_dict
+        wp = self._current_preamble()
         xinc_fmt = list('{0:.6e}'.format(wp['xinc']).partition('e'))
         xinc_fmt[0] = xinc_fmt[0].rstrip('0')
         xinc_fmt = ''.join(xinc_fmt)
@@ -480,12 +1361,21 @@ class DS1054Z(vxi11.Instrument):
 
         Named after ``decode_ieee_block()`` in python-ivi
         """
+        n_header_bytes, n_data_bytes = DS1054Z.ieee_block_span(ieee_bytes)
+        return ieee_bytes[n_header_bytes:n_header_bytes + n_data_bytes]
+
+    @staticmethod
+    def ieee_block_span(ieee_bytes):
+        """
+        Returns the position of the data in a IEEE binary data block
+        as ``(offset, length)`` without copying it.
+        """
         if sys.version_info >= (3, 0):
             n_header_bytes = int(chr(ieee_bytes[1]))+2
         else:
             n_header_bytes = int(ieee_bytes[1])+2
-        n_data_bytes = int(ieee_bytes[2:n_header_bytes].decode('ascii'))
-        return ieee_bytes[n_header_bytes:n_header_bytes + n_data_bytes]
+        n_data_bytes = int(bytes(ieee_bytes[2:n_header_bytes]).decode('ascii'))
+        return n_header_bytes, n_data_bytes
 
     @property
     def idn(self):
@@ -498,22 +1388,105 @@ class DS1054Z(vxi11.Instrument):
     def stop(self):
         """ Stop acquisition """
         self.write(":STOP")
+        self.invalidate_acquisition_state()
+        self.acquisition_state.running = False
 
     def run(self):
         """ Start acquisition """
         self.write(":RUN")
+        self.invalidate_acquisition_state()
+        self.acquisition_state.running = True
 
     def single(self):
         """ Set the oscilloscope to the single trigger mode. """
         self.write(":SINGle")
+        self.invalidate_acquisition_state()
+        self.acquisition_state.single = True
 
     def tforce(self):
         """ Generate a trigger signal forcefully. """
         self.write(":TFORce")
+        single = self.acquisition_state.single
+        self.invalidate_acquisition_state()
+        self.acquisition_state.single = single
+
+    def wait_for_acquisition(self, screens=1, timeout=None, poll_interval=0.002,
+                             max_poll_interval=0.2, backoff=1.5):
+        """
+        Blocks until the current acquisition is complete instead of
+        sleeping for a fixed time.
+
+        * Single trigger mode (:py:meth:`single`): returns as soon as
+          ``:TRIGger:STATus?`` reports ``STOP``.
+        * Running scope (:py:meth:`run`): waits until ``screens`` full
+          screens (at least the averaging count ``cnt`` of the waveform
+          preamble) can have been recorded since the call, then returns as
+          soon as ``:TRIGger:STATus?`` reports triggered acquisitions
+          (anything but ``WAIT``). The scope keeps running (and averaging),
+          call :py:meth:`stop` to freeze its data for the readout.
+        * Stopped scope: returns immediately.
+
+        The acquisition settings and the running state are not changed.
+
+        If the running state is not known (e.g. after
+        :py:meth:`invalidate_acquisition_state`), the scope is asked.
+
+        The trigger status is polled with an interval starting at
+        ``poll_interval`` which grows by ``backoff`` up to ``max_poll_interval``.
+        The polling restarts with the short interval when the acquisition
+        is expected to finish (half a screen after the call or ``t_min``).
+
+        :param int screens: number of screens a running scope has to record
+        :param float timeout: maximum time to wait in seconds, default:
+            10 s plus twice the expected acquisition time
+        :return: time waited in seconds
+        :rtype: float
+        :raises AcquisitionTimeout: if the acquisition is not complete within ``timeout``
+        """
+        t_start = clock()
+        screen_time = self.timebase_scale * self.H_GRID
+        # a pending single shot reports to be running until it has stopped
+        running = False if self.acquisition_state.single else self._running_cached()
+        if running:
+            screens = max(screens, self.waveform_preamble_dict['cnt'])
+            t_min = screens * screen_time
+        else:
+            t_min = 0.
+        if timeout is None:
+            timeout = 10. + 2 * (t_min + screen_time)
+        # no need to ask before the physically required time has passed
+        if t_min > 0:
+            time.sleep(max(t_min - (clock() - t_start), 0.))
+        t_expected = clock() - t_start + (0. if running else screen_time / 2)
+        interval = poll_interval
+        while True:
+            status = self.query(':TRIGger:STATus?')
+            elapsed = clock() - t_start
+            if status == 'STOP':
+                self.acquisition_state.running = False
+                self.acquisition_state.single = False
+                return elapsed
+            if running and status != 'WAIT':
+                # the screens have been recorded and the scope is triggering
+                return elapsed
+            if elapsed > timeout:
+                raise AcquisitionTimeout('acquisition not complete after {0:.2f} s '
+                                         '(trigger status {1})'.format(elapsed, status))
+            if elapsed < t_expected:
+                delay = min(interval, t_expected - elapsed)
+                interval = min(interval * backoff, max_poll_interval)
+                if elapsed + delay >= t_expected:
+                    interval = poll_interval
+            else:
+                delay = min(interval, max(timeout - elapsed, 0.))
+                interval = min(interval * backoff, max_poll_interval)
+            time.sleep(delay)
 
     def set_waveform_mode(self, mode='NORMal'):
         """ Changing the waveform mode """
         self.write('WAVeform:MODE ' + mode)
+        self.acquisition_state.waveform_mode = AcquisitionState.mode_key(mode)
+        self.acquisition_state.waveform_setup['MODE'] = mode
 
     @property
     def memory_depth_curr_waveform(self):
@@ -524,9 +1497,13 @@ class DS1054Z(vxi11.Instrument):
 
         Needed by :py:attr:`waveform_time_values`.
 
-        This property will be updated every time you access it.
+        The waveform mode and running state are taken from
+        :py:attr:`acquisition_state` if already known.
         """
-        if self.query(':WAVeform:MODE?').startswith('NORM') or self.running:
+        state = self.acquisition_state
+        if state.waveform_mode is None:
+            state.waveform_mode = AcquisitionState.mode_key(self.query(':WAVeform:MODE?'))
+        if state.waveform_mode == 'NORM' or self._running_cached():
             return self.SAMPLES_ON_DISPLAY
         else:
             return self.memory_depth_internal_total
@@ -552,11 +1529,13 @@ class DS1054Z(vxi11.Instrument):
         The total number of samples in the **raw (=deep) memory** of the oscilloscope.
         If it's running, the scope will be stopped temporarily when accessing this value.
 
-        This property will be updated every time you access it.
+        The value is cached in :py:attr:`acquisition_state`.
         """
+        if self.acquisition_state.memory_depth is not None:
+            return self.acquisition_state.memory_depth
         mdep = self.query(":ACQuire:MDEPth?")
         if mdep == "AUTO":
-            curr_running = self.running
+            curr_running = self._running_cached()
             curr_mode = self.query(':WAVeform:MODE?')
             if curr_running:
                 self.stop()
@@ -569,7 +1548,8 @@ class DS1054Z(vxi11.Instrument):
                 mdep = self.waveform_preamble_dict['pnts']
             if curr_running:
                 self.run()
-        return int(float(mdep))
+        self.acquisition_state.memory_depth = int(float(mdep))
+        return self.acquisition_state.memory_depth
 
     @property
     def memory_depth(self):
@@ -588,7 +1568,7 @@ class DS1054Z(vxi11.Instrument):
         This will set the memory depth to 12M data points.
         Please note that changing the memory_depth is only possible when
         the oscilloscope is :py:attr:`running`.
-        Otherwise, setting this property will raise an exception.
+        Otherwise, setting this property will raise a RuntimeError.
         In addition, not all values are valid in all cases.
         This depends on the number of channels currently in use (including the trigger!).
         Please read the property back after setting it,
@@ -608,7 +1588,7 @@ class DS1054Z(vxi11.Instrument):
     @memory_depth.setter
     def memory_depth(self, mdepth):
         if not self.running:
-            raise NameError("Cannot set memory depth when not running.")
+            raise RuntimeError("Cannot set memory depth when not running.")
         if type(mdepth) in (float, int):
             # determin closest memory depth:
             new_mdepth = min(self.possible_memory_depth_values, key=lambda x:abs(x-mdepth))
@@ -616,6 +1596,9 @@ class DS1054Z(vxi11.Instrument):
             new_mdepth = mdepth
         assert new_mdepth == 'AUTO' or new_mdepth in self.possible_memory_depth_values
         self.write(":ACQuire:MDEPth {0}".format(new_mdepth))
+        self.invalidate_acquisition_state()
+        # caches the running state of the new acquisition
+        self.acquisition_state.running = self._running_cached()
         #assert self.query(":ACQuire:MDEPth?") == new_mdepth
 
     @property
@@ -648,6 +1631,8 @@ class DS1054Z(vxi11.Instrument):
         """
         channel = self._interpret_channel(channel)
         self.write(':{0}:DISPlay {1}'.format(channel, int(enable)))
+        # the memory depth depends on the number of enabled channels
+        self.invalidate_acquisition_state()
 
     def display_only_channel(self, channel):
         """
@@ -656,6 +1641,7 @@ class DS1054Z(vxi11.Instrument):
         channel = self._interpret_channel(channel)
         for ch in self.CHANNEL_LIST:
             self.write(':{0}:DISPlay {1}'.format(ch, int(ch == channel)))
+        self.invalidate_acquisition_state()
 
     def get_probe_ratio(self, channel):
         """
@@ -679,6 +1665,7 @@ class DS1054Z(vxi11.Instrument):
         ratio = min(self.possible_probe_ratio_values, key=lambda x:abs(x-ratio))
         channel = self._interpret_channel(channel)
         self.write(":{0}:PROBe {1}".format(channel, ratio))
+        self.invalidate_acquisition_state()
 
 
     def get_channel_offset(self, channel):
@@ -710,6 +1697,7 @@ class DS1054Z(vxi11.Instrument):
         """
         channel = self._interpret_channel(channel)
         self.write(":{0}:OFFSet {1}".format(channel, volts))
+        self.invalidate_acquisition_state()
 
     def get_channel_scale(self, channel):
         """
@@ -742,6 +1730,7 @@ class DS1054Z(vxi11.Instrument):
             possible_channel_scale_values = [val * probe_ratio for val in self.possible_channel_scale_values]
             volts = min(possible_channel_scale_values, key=lambda x:abs(x-volts))
         self.write(":{0}:SCALe {1}".format(channel, volts))
+        self.invalidate_acquisition_state()
 
     def get_channel_measurement(self, channel, item, type="CURRent"):
         """
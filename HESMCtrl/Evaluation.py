@@ -3,13 +3,41 @@
 """
 Evaluate data to reconstruct ferroelectric hysteresis
 """
-def get_PR(data, include_instr_err=False):
+def nearest_to_zero(x, counts=(20,)):
+	"""
+	positions of the values of x closest to 0 for every count in counts,
+	one partial sort (partition, O(n)) instead of a full argsort,
+	along the last axis for stacked data (N, samples)
+	same positions as the stable argsort()[:count]: ties in the order of the samples, NaN last
+	returns {count: positions}
+	"""
+	from numpy import abs, arange, asarray, isnan, lexsort, nonzero, partition, searchsorted
+	a = abs(asarray(x, dtype=float))
+	n = a.shape[-1]
+	a2 = a.reshape(-1, n)
+	kth = [min(count, n) - 1 for count in counts]
+	bounds = partition(a2, kth, axis=-1)
+	positions = {}
+	for count, k in zip(counts, kth):
+		# the few candidates up to the count-th value, sorted by (row, value, sample)
+		bound = bounds[:,k:k+1]
+		row, col = nonzero((a2 <= bound) | isnan(bound))
+		order = lexsort((a2[row, col], row))
+		row, col = row[order], col[order]
+		first = searchsorted(row, arange(len(a2)))
+		positions[count] = col[first[:,None] + arange(k+1)].reshape(a.shape[:-1] + (k+1,))
+	return positions
+
+def get_PR(data, include_instr_err=False, index=None):
 	"""
 	calculates remanent polarization and error
 	option to include instrumental error of approx. 11%
+	index = positions of the 20 values closest to E=0 (see nearest_to_zero), if known
 	"""
 	from numpy import mean, std
-	PRs = abs(data.iloc[(data['E']-0).abs().argsort()[:20]].P)
+	if index is None:
+		index = nearest_to_zero(data['E'])[20]
+	PRs = abs(data['P'].to_numpy()[index])
 	PR = mean(PRs)		 	 	# mean of 20 values close to E=0
 	PR_error = std(PRs)	 	 	# 1sigma of theses values = statistical error
 	if include_instr_err == True:
@@ -25,116 +53,681 @@ def get_EC(data):
 	determines coercive field 
 	"""
 	from numpy import mean
-	EC = mean(abs(data.iloc[(data['P']-0).abs().argsort()[:20]].E))
+	EC = mean(abs(data['E'].to_numpy()[nearest_to_zero(data['P'])[20]]))
 	
 	return EC
 
-def calculate_hysteresis(data,ms,filename):
+def branch_direction(drive, lag=None):
 	"""
-	Reconstruct hysteresis shape from measured date (time, Vset, Vref)
-	and measurement settings dict
+	+1 on the rising, -1 on the falling branches of the drive signal (Vset or E),
+	0 at the turning points, from the difference of the samples lag positions before and after
+	(default: 1% of the data, bridges the flat steps of the 8 bit ADC),
+	along the last axis for stacked data (N, samples)
+	"""
+	from numpy import asarray, sign, empty_like, zeros_like
+	drive = asarray(drive, dtype=float)
+	n = drive.shape[-1]
+	if n < 3:
+		return zeros_like(drive)
+	if lag is None:
+		lag = max(1, n // 100)
+	lag = min(lag, n // 2)
+	diff = empty_like(drive)
+	diff[...,lag:n-lag] = drive[...,2*lag:] - drive[...,:n-2*lag]
+	diff[...,:lag] = drive[...,lag:2*lag] - drive[...,:1]
+	diff[...,n-lag:] = drive[...,n-1:] - drive[...,n-2*lag:n-lag]
+	return sign(diff)
+
+def zero_crossings(x, y, direction):
+	"""
+	values of y where x crosses 0 (linear interpolation between the samples),
+	x, y, direction (see branch_direction) of stacked data (N, samples) or of one measurement
+	returns (row, y at the crossing, direction at the crossing) of all crossings
 	"""
+	from numpy import atleast_2d, asarray, nonzero, isfinite
+	x, y = atleast_2d(asarray(x, dtype=float)), atleast_2d(asarray(y, dtype=float))
+	direction = atleast_2d(direction)
+	finite = isfinite(x[:,:-1]) & isfinite(x[:,1:])
+	row, i = nonzero(((x[:,:-1] < 0) != (x[:,1:] < 0)) & finite)
+	x0, x1, y0, y1 = x[row,i], x[row,i+1], y[row,i], y[row,i+1]
+	values = y0 + x0 / (x0 - x1) * (y1 - y0)
+	return row, values, direction[row,i]
+
+def grouped_mean_err(row, values, n_rows):
+	"""
+	mean and standard error of the values of every row (bincount),
+	NaN for rows without values (error: with less than 2 values)
+	"""
+	from numpy import bincount, sqrt, errstate
+	count = bincount(row, minlength=n_rows)
+	with errstate(invalid='ignore', divide='ignore'):
+		mean = bincount(row, values, minlength=n_rows) / count
+		var = bincount(row, (values - mean[row])**2, minlength=n_rows) / (count - 1)
+		return mean, sqrt(var / count)
+
+def loop_metrics(E, P, drive=None):
+	"""
+	metrics of the hysteresis loop in one pass over the data,
+	separated into rising and falling branches (direction of drive, default E):
+	- PR_pos, PR_neg = P at E = 0 on the falling / rising branches
+	- EC_pos, EC_neg = E at P = 0 on the rising / falling branches
+	- ebias = |max(E)| - |min(E)| (asymmetry of the field)
+	- imprint = (EC_pos + EC_neg) / 2 (horizontal shift of the loop)
+	- *_err = standard error of the crossings of all periods (NaN if there is only one)
+	stacked data (N, samples) gives arrays of N values
+	"""
+	from numpy import asarray, atleast_2d, nanmax, nanmin, sqrt
+	E, P = asarray(E, dtype=float), asarray(P, dtype=float)
+	E2, P2 = atleast_2d(E), atleast_2d(P)
+	n_rows = E2.shape[0]
+	direction = branch_direction(E2 if drive is None else atleast_2d(asarray(drive, dtype=float)))
 	
-	from numpy import pi, mean
-	from scipy.integrate import cumtrapz
-	import pandas as pd
+	metrics = {}
+	row, values, branch = zero_crossings(E2, P2, direction)
+	for key, select in (('PR_pos', branch < 0), ('PR_neg', branch > 0)):
+		metrics[key], metrics[key+'_err'] = grouped_mean_err(row[select], values[select], n_rows)
+	row, values, branch = zero_crossings(P2, E2, direction)
+	for key, select in (('EC_pos', branch > 0), ('EC_neg', branch < 0)):
+		metrics[key], metrics[key+'_err'] = grouped_mean_err(row[select], values[select], n_rows)
+	metrics['ebias'] = abs(nanmax(E2, axis=-1)) - abs(nanmin(E2, axis=-1))
+	metrics['imprint'] = (metrics['EC_pos'] + metrics['EC_neg']) / 2
+	metrics['imprint_err'] = sqrt(metrics['EC_pos_err']**2 + metrics['EC_neg_err']**2) / 2
+	if E.ndim == 1:
+		metrics = dict((key, float(value[0])) for key, value in metrics.items())
+	return metrics
+
+def get_time_increment(time):
+	"""
+	returns the sample spacing of a time column
+	or of a DS1054Z TimeAxis (without building the full axis)
+	"""
+	try:
+		return time.increment
+	except AttributeError:
+		return time[1]-time[0]
+
+def cumulative_trapezoid(y, x=None, dx=1.0, axis=-1, initial=None, out=None):
+	"""
+	cumulative integral of y (trapezoidal rule) along axis, same results as
+	scipy.integrate.cumulative_trapezoid (bit by bit, the same operations in the same order)
+	- x = sample points (same shape as y), None = constant spacing dx 
+	  (scalar or broadcastable, e.g. one xinc per row: shape (N, 1))
+	- initial = value inserted at the start (result has the length of y), None = one value less
+	- out = preallocated result array, may share the memory of y (y itself or y[...,1:] if initial is None)
+	NaN gaps: intervals next to a NaN sample add 0, the integral goes on after the gap,
+	the result is NaN at the NaN samples
+	"""
+	from numpy import asarray, empty, add, multiply, divide, diff, isnan, moveaxis, shares_memory
+	y = asarray(y, dtype=float)
+	yv = moveaxis(y, axis, -1)
+	n = yv.shape[-1]
+	shape = yv.shape[:-1] + (n if initial is not None else max(n-1, 0),)
+	if out is None:
+		outv = empty(shape)
+		out = moveaxis(outv, -1, axis)
+	else:
+		outv = moveaxis(out, axis, -1)
+		if outv.shape != shape:
+			raise ValueError('out has shape %s, expected %s' % (out.shape, moveaxis(empty(shape), -1, axis).shape))
+	body = outv[...,1:] if initial is not None else outv
 	
-	print('--------------------------')
-	print('Evaluation ...')
-	print('... calculating hysteresis')
+	def integrate(gaps):
+		add(yv[...,1:], yv[...,:-1], out=body)
+		if x is None:
+			multiply(dx, body, out=body)
+		else:
+			multiply(diff(moveaxis(asarray(x, dtype=float), axis, -1), axis=-1), body, out=body)
+		divide(body, 2.0, out=body)
+		if gaps:
+			body[isnan(body)] = 0.
+		add.accumulate(body, axis=-1, out=body)
 	
-	# prepare results
-	result = pd.Series({'Vamp':ms['amp']})
-	result['frequency'] = ms['freq']
-	result['thickness'] = ms['thickness']
-	result['area'] = ms['area']
-	result['areaerr'] = ms['areaerr']
+	if shares_memory(out, y):
+		# y is overwritten, find the NaN samples first
+		nan_samples = isnan(yv)
+		gaps = bool(nan_samples.any())
+		integrate(gaps)
+	else:
+		# a NaN is carried to the end of the integral, integrate again without gaps then
+		integrate(False)
+		gaps = body.size > 0 and bool(isnan(body[...,-1]).any())
+		if gaps:
+			nan_samples = isnan(yv)
+			integrate(True)
+	if initial is not None:
+		outv[...,0] = initial
+	if gaps:
+		outv[...,-body.shape[-1]:][nan_samples[...,1:]] = float('nan')
+		if initial is not None:
+			outv[...,0][nan_samples[...,0]] = float('nan')
+	return out
+
+def get_raw_capture_data(path,ms,max_points=None,vset='CHAN1',vref='CHAN2'):
+	"""
+	time, Vset and Vref DataFrame from a deep memory capture file
+	(see DS1054Z.capture_to_file), opened via mmap
+	max_points = read only every n-th sample to stay below this number of points
+	"""
+	from pandas import DataFrame
+	from HESMCtrl.OSOperations import open_raw_capture
 	
-	# calculate difference voltage betwen Vset and Vref
-	data['Vdiff'] = data.Vset - data.Vref
+	capture = open_raw_capture(path)
+	step = 1
+	if max_points:
+		step = max(1, -(-len(capture) // max_points))
+	return DataFrame({'time':capture.time(step=step),
+					'Vset':capture.voltages(vset, step=step) * ms['ampfactor'],
+					'Vref':capture.voltages(vref, step=step)})
+
+def get_binned_capture_data(block,ms,vset='CHAN1',vrefs=('CHAN2',)):
+	"""
+	time, Vset and Vref DataFrame from a binned deep memory capture 
+	(see DS1054Z.capture_binned): mean of every bin + its min/max 
+	(columns Vset_min, Vset_max, Vref_min, Vref_max)
+	vrefs = Vref channels, CHAN3/CHAN4 get the columns Vref_CHAN3 ... (see Measurement.vref_column)
+	"""
+	from pandas import DataFrame
+	from HESMCtrl.Measurement import vref_column
 	
-	#calculate displacement current 
-	data['I'] = data.Vref / ms['rref']
+	data = DataFrame({'time':block.time.to_array(),
+					'Vset':block[vset] * ms['ampfactor'],
+					'Vset_min':block.min(vset) * ms['ampfactor'],
+					'Vset_max':block.max(vset) * ms['ampfactor']})
+	for channel in vrefs:
+		column = vref_column(channel)
+		data[column] = block[channel]
+		data[column+'_min'] = block.min(channel)
+		data[column+'_max'] = block.max(channel)
+	return data
 
-	#calc and center electric field from Vset and sample thickness d (+save)
-	data['E'] = data.Vdiff / ms['thickness']
-	E_bias = abs(max(data.E))-abs(min(data.E))
-	print('... E_bias: %f MV/m ; %f V'%(E_bias/1e6,E_bias*ms['thickness']))
-	if ms['correct_Ebias'] == True:
-		print('... correct Ebias')
-		if E_bias < 0:
-			data['E'] = data.E + abs(E_bias)
+# settings of calculate_hysteresis / evaluate_hysteresis (with defaults of optional ones)
+EVAL_SETTINGS = {'amp':None, 'freq':None, 'thickness':None, 'area':None, 'areaerr':None, 
+				 'rref':None, 'rreferr':None, 'vreferr':None, 'cap':0., 'tand':0., 
+				 'correct_Ebias':False, 'correct_LossI':False, 'custom_curr_offs':0.}
+
+def settings_vectors(ms, n_rows):
+	"""
+	per-row settings vectors (arrays of n_rows) of evaluate_hysteresis from
+	one settings dict (values scalar or one per row) or a list of settings dicts
+	"""
+	from numpy import asarray, broadcast_to
+	vectors = {}
+	for key, default in EVAL_SETTINGS.items():
+		if isinstance(ms, dict):
+			value = ms.get(key, default)
 		else:
-			data['E'] = data.E - abs(E_bias)
-	result['ebias'] = E_bias
+			value = [msr.get(key, default) for msr in ms]
+		dtype = bool if isinstance(default, bool) else float
+		vectors[key] = broadcast_to(asarray(value, dtype=dtype), (n_rows,))
+	return vectors
+
+def hysteresis_field(Vset, Vref, sv):
+	"""
+	difference voltage, electric field and its (corrected) bias of stacked data (N, samples)
+	sv = settings vectors (see settings_vectors)
+	returns (Vdiff, E, E_bias)
+	"""
+	from numpy import nanmax, nanmin, where
+	Vdiff = Vset - Vref
+	E = Vdiff / sv['thickness'][:,None]
+	E_bias = abs(nanmax(E, axis=1)) - abs(nanmin(E, axis=1))
+	E = E - where(sv['correct_Ebias'], E_bias, 0.)[:,None]
+	return Vdiff, E, E_bias
+
+def hysteresis_current(Vref, sv, increment, start_index=50, periods=2):
+	"""
+	displacement current (loss current and offset removed) of stacked data (N, samples),
+	the offset is the mean of the given number of periods starting at 
+	sample start_index (or custom_curr_offs)
+	increment = sample spacing of every row
+	returns (I, I_Loss, offset)
+	"""
+	from numpy import arange, pi, isnan, where, errstate
+	col = lambda key: sv[key][:,None]
+	I = Vref / col('rref')
+	I_Loss = Vref * 2 * pi * col('freq') * col('cap') * col('tand')
+	I = I - where(col('correct_LossI'), I_Loss, 0.)
 	
-	# correct loss current before removing offset	
-	if ms['correct_LossI'] == True:
-		print('... correct loss current')
-		try:
-			data['I_Loss'] = data.Vref * 2 * pi * ms['freq'] * ms['cap'] * ms['tand']
-			data['I'] = data.I - data.I_Loss
-			print('... ILoss/IP: %e'%(mean(data.I_Loss)/mean(data.I)))
-		except ValueError:
-			print('Some values missing! (Capacity, tan d ?)')
-	
-	# calc offset current from mean of 1 period
-	if ms['custom_curr_offs'] == 0:
-		
-		# TEST: get start index from first zero transition of current signal
-		# index_DataFrame = data.iloc[(data['I']-0.0).abs().argsort()[:20]]	# extract index from nearest values to zero
-		# start_index = index_DataFrame.index.min()
-		
-		start_index = 50
-		
-		increment = data.time[1]-data.time[0]
-		steps = int(1./ ms['freq'] / increment * 2)
-		offset = mean(data.I[start_index:steps+start_index])
+	steps = (1. / sv['freq'] / increment * periods).astype(int)
+	index = arange(I.shape[1])
+	window = (index >= start_index) & (index < (steps + start_index)[:,None]) & ~isnan(I)
+	with errstate(invalid='ignore'):
+		offset = where(window, I, 0.).sum(axis=1) / window.sum(axis=1)
+	offset = where(sv['custom_curr_offs'] == 0, offset, sv['custom_curr_offs'])
+	return I - offset[:,None], I_Loss, offset
+
+def hysteresis_polarization(I, E, sv, time=None, dt=None):
+	"""
+	charge (integrated current) and polarization of stacked data (N, samples), 
+	P aligned around Pmin/Pmax and around 0 (16 values closest to E = 0)
+	integrated over time or with the constant spacing dt (one per row)
+	returns (Q, P, PNull, positions of the 16/20 values closest to E = 0 (see nearest_to_zero))
+	"""
+	from numpy import nanmax, nanmin, take_along_axis
+	if dt is None:
+		Q = cumulative_trapezoid(I, time, axis=1, initial=0)
 	else:
-		print('... auto offset current disabled')
-		try:
-			offset = ms['custom_curr_offs']
-		except ValueError:
-			print('current offset value missing!')
-		
-	# remove offset current
-	data['I'] = data.I - offset
+		Q = cumulative_trapezoid(I, dx=dt[:,None], axis=1, initial=0)
+	
+	# polarization, aligned around Pmin and Pmax
+	P = Q / sv['area'][:,None]
+	Pdiff = abs(nanmin(P, axis=1)) - abs(nanmax(P, axis=1))
+	P = P + Pdiff[:,None]/2
+	
+	# align P around 0 (16 values: 8+ and 8-)
+	near_E = nearest_to_zero(E, (16, 20))
+	P_near_E = take_along_axis(P, near_E[16], axis=1)
+	PNull = (P_near_E.max(axis=1) + P_near_E.min(axis=1)) / 2
+	return Q, P - PNull[:,None], PNull, near_E
 
-	# charge by integrating current
-	data['Q'] = cumtrapz(data.I,data.time,initial=0)
+def polarization_error(P, Vref, sv, Vref_err=None):
+	"""
+	error of the polarization of stacked data (N, samples)
+	(+ standard error of Vref from averaging, see Measurement.CycleAccumulator)
+	"""
+	from numpy import isnan, where, errstate
+	vreferr = sv['vreferr'][:,None]
+	if Vref_err is not None:
+		vreferr = vreferr + where(isnan(Vref_err), 0., Vref_err)
+	with errstate(divide='ignore', invalid='ignore'):
+		return (vreferr / Vref + (sv['rreferr']/sv['rref'] + sv['areaerr']/sv['area'])[:,None]) * P
 
-	# polarization
-	data['P'] = data.Q / ms['area']
+def hysteresis_results(E, P, Vset, sv, E_bias, PNull, near_E):
+	"""
+	results table (one row per measurement) of stacked data (N, samples):
+	PR (20 values closest to E = 0), EC (20 values closest to P = 0) and 
+	the branch resolved metrics (Pr+/Pr-, Ec+/Ec-, imprint, see loop_metrics)
+	"""
+	from numpy import take_along_axis
+	from pandas import DataFrame
+	# columns collected first, a DataFrame is built once
+	result = {'Vamp':sv['amp'], 'frequency':sv['freq'], 'thickness':sv['thickness'], 
+			  'area':sv['area'], 'areaerr':sv['areaerr'], 'ebias':E_bias, 'pnull':PNull}
+	PRs = abs(take_along_axis(P, near_E[20], axis=1))
+	result['PR'] = PRs.mean(axis=1)
+	result['PRerr'] = PRs.std(axis=1)
+	result['EC'] = abs(take_along_axis(E, nearest_to_zero(P)[20], axis=1)).mean(axis=1)
+	metrics = loop_metrics(E, P, Vset)
+	for key in ('PR_pos', 'PR_neg', 'EC_pos', 'EC_neg', 'imprint'):
+		result[key], result[key+'_err'] = metrics[key], metrics[key+'_err']
+	return DataFrame(result)
 
-	# align P around Pmin and Pmax
-	maxP = max(data.P)
-	minP = min(data.P)
-	Pdiff = abs(minP)-abs(maxP)
-	data['P'] = data.P + Pdiff/2
-		
-	# aling P around 0		16 because 8+ und 8-
-	PNull = mean([max(data.iloc[(data['E']-0).abs().argsort()[:16]].P),min(data.iloc[(data['E']-0).abs().argsort()[:16]].P)])
-	if PNull < 0:
-		data['P'] = data.P + abs(PNull)
-	else:
-		data['P'] = data.P - abs(PNull)
-	result['pnull'] = PNull
+def evaluate_hysteresis(time, Vset, Vref, ms, Vref_err=None, dt=None, offset_window=(50, 2)):
+	"""
+	Reconstruct the hysteresis of N measurements at once
+	time, Vset, Vref = stacked data (N, samples) (one measurement: (samples,))
+	ms = settings (see settings_vectors), e.g. {'rref':array of N, 'area':..., ...}
+	Vref_err = standard error of Vref from averaging (N, samples) - optional
+	dt = sample spacing (scalar or one per row), None = from time
+	offset_window = (start index, number of periods) of the offset current mean
+	rows may be padded with NaN at the end (see evaluate_periods)
+	returns (dict of the arrays Vdiff, I, I_Loss, E, Q, P, P_error (N, samples), 
+			 DataFrame of the results (one row per measurement))
+	"""
+	from numpy import asarray, atleast_2d, broadcast_to
+	
+	Vset = atleast_2d(asarray(Vset, dtype=float))
+	Vref = atleast_2d(asarray(Vref, dtype=float))
+	time = atleast_2d(asarray(time, dtype=float))
+	n_rows = Vset.shape[0]
+	sv = settings_vectors(ms, n_rows)
+	if dt is not None:
+		dt = broadcast_to(asarray(dt, dtype=float), (n_rows,))
+	increment = time[:,1] - time[:,0] if dt is None else dt
+	
+	Vdiff, E, E_bias = hysteresis_field(Vset, Vref, sv)
+	I, I_Loss, offset = hysteresis_current(Vref, sv, increment, *offset_window)
+	Q, P, PNull, near_E = hysteresis_polarization(I, E, sv, time, dt)
+	P_error = polarization_error(P, Vref, sv, Vref_err)
+	result = hysteresis_results(E, P, Vset, sv, E_bias, PNull, near_E)
+	
+	arrays = {'Vdiff':Vdiff, 'I':I, 'I_Loss':I_Loss, 'E':E, 'Q':Q, 'P':P, 'P_error':P_error}
+	return arrays, result
+
+def period_bounds(Vset, lag=None, tolerance=0.1):
+	"""
+	positions of the maxima (turning points) of the drive signal Vset (one measurement),
+	consecutive maxima enclose one full period
+	(periods differing by more than tolerance from the median length are dropped, e.g. burst gaps)
+	returns (start, end) positions of the full periods
+	"""
+	from numpy import asarray, flatnonzero, argmax, diff, median, abs
+	Vset = asarray(Vset, dtype=float)
+	direction = branch_direction(Vset, lag)
+	if lag is None:
+		lag = max(1, len(Vset) // 100)
+	# rising --> falling (samples at the turning points without direction are skipped)
+	moving = flatnonzero(direction != 0)
+	turns = moving[flatnonzero((direction[moving][:-1] > 0) & (direction[moving][1:] < 0))]
+	maxima = []
+	for turn in turns:
+		lo, hi = max(turn - lag, 0), min(turn + lag + 1, len(Vset))
+		maxima.append(lo + argmax(Vset[lo:hi]))
+	if len(maxima) < 2:
+		return []
+	starts, ends = asarray(maxima[:-1]), asarray(maxima[1:])
+	lengths = ends - starts
+	full = abs(lengths - median(lengths)) <= tolerance * median(lengths)
+	return list(zip(starts[full], ends[full]))
+
+def stack_periods(bounds, *columns):
+	"""
+	stacks the periods (start, end) of every column into an array (n_periods, longest period),
+	every period includes its end point (the start of the next one), shorter ones are padded with NaN
+	"""
+	from numpy import asarray, arange, minimum, nan, where
+	starts = asarray([start for start, end in bounds])
+	lengths = asarray([end - start + 1 for start, end in bounds])
+	offsets = arange(lengths.max())
+	valid = offsets < lengths[:,None]
+	stacked = []
+	for column in columns:
+		column = asarray(column, dtype=float)
+		index = minimum(starts[:,None] + offsets, len(column) - 1)
+		stacked.append(where(valid, column[index], nan))
+	return stacked
 
-	# calc error of polarization
-	data['P_error'] = (ms['vreferr'] / data.Vref + ms['rreferr']/ms['rref'] + ms['areaerr']/ms['area']) * data.P
+def evaluate_periods(time, Vset, Vref, ms, Vref_err=None, dt=None):
+	"""
+	cycle resolved evaluation of one multi-period trace: the trace is split into
+	its full periods (see period_bounds) and all periods are evaluated at once
+	(see evaluate_hysteresis, the offset current is the mean of each period)
+	returns (results table (one row per period, with start/end time), 
+			 summary: number of periods, mean, std (scatter between the periods) 
+			 and standard error of PR, EC and the branch metrics)
+	"""
+	from numpy import asarray, sqrt, nan, isfinite
+	from pandas import Series
+	
+	time = asarray(time, dtype=float)
+	bounds = period_bounds(Vset)
+	summary = {'periods':float(len(bounds))}
+	if not bounds:
+		return None, Series(summary)
+	columns = [time, Vset, Vref] + ([] if Vref_err is None else [Vref_err])
+	stacked = stack_periods(bounds, *columns)
+	arrays, result = evaluate_hysteresis(stacked[0], stacked[1], stacked[2], ms, 
+										 Vref_err=None if Vref_err is None else stacked[3], 
+										 dt=dt, offset_window=(0, 1))
+	result.insert(0, 'start', [time[start] for start, end in bounds])
+	result.insert(1, 'end', [time[end] for start, end in bounds])
+	
+	for key in ('PR', 'EC', 'PR_pos', 'PR_neg', 'EC_pos', 'EC_neg', 'imprint'):
+		values = result[key].to_numpy()
+		values = values[isfinite(values)]
+		if key in ('PR', 'EC'):
+			values = abs(values)
+		n = len(values)
+		summary[key] = values.mean() if n else nan
+		summary[key+'_std'] = values.std(ddof=1) if n > 1 else nan
+		summary[key+'_sem'] = summary[key+'_std'] / sqrt(n) if n > 1 else nan
+	return result, Series(summary)
 
-	# get EC and PR --> 3 sigma
-	PR, PR_error = get_PR(data)
-	result['PR'], result['PRerr'] = PR, PR_error
-	result['EC'] = get_EC(data)
+def calculate_hysteresis(data,ms,filename,time_axis=None,verbose=True,periods=False):
+	"""
+	Reconstruct hysteresis shape from measured date (time, Vset, Vref)
+	and measurement settings dict (see evaluate_hysteresis)
+	time_axis = DS1054Z TimeAxis of the data (optional), 
+	the data is integrated with its constant increment then
+	verbose = False suppresses the console output (e.g. when evaluating every averaging cycle)
+	periods = True adds the cycle resolved evaluation (see evaluate_periods) to the result:
+	periods, PR_periods(_std), EC_periods(_std)
+	binned data (see get_binned_capture_data) also gets the current range 
+	of every bin (I_min, I_max)
+	"""
+	
+	from numpy import mean
+	
+	log = print if verbose else lambda *args: None
+	
+	log('--------------------------')
+	log('Evaluation ...')
+	log('... calculating hysteresis')
+	
+	Vref_err = data.Vref_err.to_numpy() if 'Vref_err' in data else None
+	dt = None if time_axis is None else time_axis.increment
+	arrays, results = evaluate_hysteresis(data.time.to_numpy(), data.Vset.to_numpy(), data.Vref.to_numpy(), 
+										  ms, Vref_err=Vref_err, dt=dt)
+	result = results.iloc[0].copy()
 	
-	print('... PR: (%f +- %f) yC/cm2'%(abs(result['PR'])*100,abs(result['PRerr'])*100))
-#	print('...     (%.2f)'%(PR_error/PR*100))
-	#print('Vdiff: %f V'%(data.Vdiff.max()))
+	for key in ('Vdiff', 'I', 'E'):
+		data[key] = arrays[key][0]
+	log('... E_bias: %f MV/m ; %f V'%(result['ebias']/1e6,result['ebias']*ms['thickness']))
+	if ms['correct_Ebias'] == True:
+		log('... correct Ebias')
+	if ms['correct_LossI'] == True:
+		log('... correct loss current')
+		data['I_Loss'] = arrays['I_Loss'][0]
+		log('... ILoss/IP: %e'%(mean(data.I_Loss)/mean(data.Vref/ms['rref'] - data.I_Loss)))
+	if ms['custom_curr_offs'] != 0:
+		log('... auto offset current disabled')
+	for key in ('Q', 'P', 'P_error'):
+		data[key] = arrays[key][0]
+	
+	# current range within the bins of high resolution data
+	if 'Vref_min' in data:
+		data['I_min'] = data.I + (data.Vref_min - data.Vref) / ms['rref']
+		data['I_max'] = data.I + (data.Vref_max - data.Vref) / ms['rref']
+	
+	# cycle resolved evaluation: scatter between the periods of the trace
+	table = None
+	if periods:
+		table, summary = evaluate_periods(data.time.to_numpy(), data.Vset.to_numpy(), data.Vref.to_numpy(), 
+										  ms, Vref_err=Vref_err, dt=dt)
+		result['periods'] = summary['periods']
+		if table is not None:
+			for key in ('PR', 'EC'):
+				result[key+'_periods'], result[key+'_periods_std'] = summary[key], summary[key+'_std']
+	
+	# adaptive averaging (see Measurement.ConvergenceMonitor)
+	if 'convergence' in data.attrs:
+		trace = data.attrs['convergence']
+		result['cycles'] = trace[-1]['cycle']
+		result['PRerr_stat'] = trace[-1]['PR_sem']
+		result['convergence'] = ';'.join('%(cycle)i:%(elapsed).2f:%(PR)g:%(PR_sem)g' % entry for entry in trace)
+	
+	log('... PR: (%f +- %f) yC/cm2'%(abs(result['PR'])*100,abs(result['PRerr'])*100))
+	log('... PR+/PR-: %f / %f yC/cm2 ; EC+/EC-: %f / %f MV/m ; imprint: %f MV/m'%(result['PR_pos']*100,
+		result['PR_neg']*100,result['EC_pos']/1e6,result['EC_neg']/1e6,result['imprint']/1e6))
+	if table is not None:
+		log('... %i periods: PR (%f +- %f) yC/cm2 ; EC (%f +- %f) MV/m'%(result['periods'],result['PR_periods']*100,
+			result['PR_periods_std']*100,result['EC_periods']/1e6,result['EC_periods_std']/1e6))
 	
 	return data, result
 
-def plot_data(data,ms,filename):
+class HysteresisLoop():
+	"""
+	one measurement stored compact: the BYTE codes (uint8) of Vset and Vref and 
+	the scope preamble values (yinc, yorig, yref, xinc, xorig) only,
+	voltages and derived quantities (Vdiff, I, I_Loss, E, Q, P, P_error, result) 
+	are calculated on first access and kept (stage functions of evaluate_hysteresis)
+	configure() changes settings and drops only the quantities depending on them
+	(e.g. correct_LossI: I, Q, P, P_error and result, but not E)
+	>>> loop = HysteresisLoop.from_capture(block, ms)
+	>>> loop.result['PR'], loop.P
+	>>> loop.configure(correct_Ebias=True)
+	>>> data = loop.to_dataframe()		# columns of calculate_hysteresis
+	>>> table, summary = loop.periods		# cycle resolved evaluation, calculated on first access
+	"""
+	# stage: (settings, stages) it is calculated from
+	STAGES = {'voltages':(('ampfactor',), ()),
+			  'field':(('thickness', 'correct_Ebias'), ('voltages',)),
+			  'current':(('rref', 'freq', 'cap', 'tand', 'correct_LossI', 'custom_curr_offs'), ('voltages',)),
+			  'polarization':(('area',), ('field', 'current')),
+			  'error':(('vreferr', 'rreferr', 'areaerr', 'rref', 'area'), ('polarization',)),
+			  'result':(('amp', 'freq', 'thickness', 'area', 'areaerr'), ('polarization',)),
+			  'periods':((), ('error', 'result'))}
+	COLUMNS = {'Vset':'voltages', 'Vref':'voltages', 'Vdiff':'field', 'E':'field', 'I':'current', 
+			   'I_Loss':'current', 'Q':'polarization', 'P':'polarization', 'P_error':'error'}
+	PREAMBLE_KEYS = ('yinc', 'yorig', 'yref', 'xinc', 'xorig')
+	
+	def __init__(self, vset_codes, vref_codes, vset_preamble, vref_preamble, ms, masks=(None, None)):
+		from numpy import asarray, uint8
+		self.codes = {'Vset':asarray(vset_codes, dtype=uint8), 'Vref':asarray(vref_codes, dtype=uint8)}
+		self.preambles = {'Vset':dict((key, vset_preamble[key]) for key in self.PREAMBLE_KEYS),
+						  'Vref':dict((key, vref_preamble[key]) for key in self.PREAMBLE_KEYS)}
+		self.masks = {'Vset':masks[0], 'Vref':masks[1]}
+		self.ms = dict(ms)
+		self._cache = {}
+	
+	@classmethod
+	def from_capture(cls, block, ms, vset='CHAN1', vref='CHAN2'):
+		"""
+		loop of a DS1054Z WaveformCapture (see DS1054Z.capture)
+		"""
+		return cls(block.codes(vset), block.codes(vref), block.preambles[vset], block.preambles[vref], 
+				   ms, (block.masks[vset], block.masks[vref]))
+	
+	@classmethod
+	def from_raw_capture(cls, capture, ms, vset='CHAN1', vref='CHAN2'):
+		"""
+		loop of a deep memory capture file (see OSOperations.open_raw_capture),
+		the codes stay memory-mapped
+		"""
+		return cls(capture.codes(vset), capture.codes(vref), capture.preambles[vset], capture.preambles[vref], ms)
+	
+	def __len__(self):
+		return len(self.codes['Vref'])
+	
+	def __getattr__(self, name):
+		if name in HysteresisLoop.COLUMNS:
+			return self._stage(HysteresisLoop.COLUMNS[name])[name][0]
+		raise AttributeError(name)
+	
+	@property
+	def time(self):
+		"""
+		DS1054Z TimeAxis of the samples
+		"""
+		from HESMCtrl.DS1054ZCtrl import TimeAxis
+		wp = self.preambles['Vref']
+		return TimeAxis(wp['xinc'], wp['xorig'], len(self))
+	
+	@property
+	def result(self):
+		"""
+		results like calculate_hysteresis (pandas Series)
+		"""
+		return self._stage('result')['result']
+	
+	@property
+	def periods(self):
+		"""
+		(results table, summary) of the periods (see evaluate_periods)
+		"""
+		periods = self._stage('periods')
+		return periods['table'], periods['summary']
+	
+	@property
+	def nbytes(self):
+		"""
+		memory of the raw codes + the quantities calculated so far
+		"""
+		nbytes = sum(codes.nbytes for codes in self.codes.values())
+		for values in self._cache.values():
+			nbytes += sum(getattr(value, 'nbytes', 0) for value in values.values())
+		return nbytes
+	
+	def configure(self, **settings):
+		"""
+		change settings (e.g. correct_Ebias=True), the quantities depending on them are recalculated
+		"""
+		changed = [key for key, value in settings.items() if self.ms.get(key) != value]
+		self.ms.update(settings)
+		stale = [stage for stage, (keys, upstream) in self.STAGES.items() if any(key in keys for key in changed)]
+		for stage in stale:
+			stale.extend(name for name, (keys, upstream) in self.STAGES.items() if stage in upstream and name not in stale)
+		for stage in stale:
+			self._cache.pop(stage, None)
+	
+	def clear_cache(self):
+		"""
+		drop all calculated quantities (keeps the raw codes)
+		"""
+		self._cache = {}
+	
+	def to_dataframe(self):
+		"""
+		DataFrame with the columns of calculate_hysteresis (time, Vset, Vref, Vdiff, I, E, I_Loss, Q, P, P_error)
+		"""
+		from pandas import DataFrame
+		data = DataFrame({'time':self.time.to_array(), 'Vset':self.Vset, 'Vref':self.Vref})
+		for key in ('Vdiff', 'I', 'E'):
+			data[key] = getattr(self, key)
+		if self.ms.get('correct_LossI') == True:
+			data['I_Loss'] = self.I_Loss
+		for key in ('Q', 'P', 'P_error'):
+			data[key] = getattr(self, key)
+		return data
+	
+	def _stage(self, name):
+		values = self._cache.get(name)
+		if values is None:
+			values = getattr(self, '_calc_' + name)(settings_vectors(self.ms, 1))
+			self._cache[name] = values
+		return values
+	
+	def _increment(self):
+		from numpy import array
+		return array([self.preambles['Vref']['xinc']])
+	
+	def _calc_voltages(self, sv):
+		from HESMCtrl.DS1054ZCtrl import DS1054Z
+		voltages = {}
+		for key in ('Vset', 'Vref'):
+			wp = self.preambles[key]
+			voltages[key] = DS1054Z.decode_waveform_bytes(self.codes[key], wp['yinc'], wp['yorig'], wp['yref'],
+														  mask_begin_num=self.masks[key])[None,:]
+		voltages['Vset'] *= self.ms.get('ampfactor', 1.0)
+		return voltages
+	
+	def _calc_field(self, sv):
+		voltages = self._stage('voltages')
+		Vdiff, E, E_bias = hysteresis_field(voltages['Vset'], voltages['Vref'], sv)
+		return {'Vdiff':Vdiff, 'E':E, 'E_bias':E_bias}
+	
+	def _calc_current(self, sv):
+		I, I_Loss, offset = hysteresis_current(self._stage('voltages')['Vref'], sv, self._increment())
+		return {'I':I, 'I_Loss':I_Loss, 'offset':offset}
+	
+	def _calc_polarization(self, sv):
+		Q, P, PNull, near_E = hysteresis_polarization(self._stage('current')['I'], self._stage('field')['E'], 
+													  sv, dt=self._increment())
+		return {'Q':Q, 'P':P, 'PNull':PNull, 'near_E':near_E}
+	
+	def _calc_error(self, sv):
+		return {'P_error':polarization_error(self._stage('polarization')['P'], self._stage('voltages')['Vref'], sv)}
+	
+	def _calc_result(self, sv):
+		field, polarization = self._stage('field'), self._stage('polarization')
+		result = hysteresis_results(field['E'], polarization['P'], self._stage('voltages')['Vset'], sv,
+									field['E_bias'], polarization['PNull'], polarization['near_E'])
+		return {'result':result.iloc[0].copy()}
+	
+	def _calc_periods(self, sv):
+		voltages = self._stage('voltages')
+		table, summary = evaluate_periods(self.time.to_array(), voltages['Vset'][0], voltages['Vref'][0], self.ms,
+										  dt=self.preambles['Vref']['xinc'])
+		return {'table':table, 'summary':summary}
+	
+def calculate_hysteresis_samples(data,ms,filename,time_axis=None,verbose=True,periods=False):
+	"""
+	calculate_hysteresis for every sample of a measurement with 
+	additional samples on CHAN3/CHAN4 (see Measurement.sample_settings)
+	returns {channel: (data, result)}
+	"""
+	from HESMCtrl.Measurement import sample_settings, sample_data
+	
+	samples = {}
+	for channel in ms.get('vref_channels', ['CHAN2']):
+		msc = sample_settings(ms, channel)
+		if verbose:
+			print('--------------------------')
+			print('Sample %s (%s)' % (msc['electrkey'], channel))
+		samples[channel] = calculate_hysteresis(sample_data(data, channel), msc, filename, time_axis, verbose, periods)
+	return samples
+
+def plot_data(data,ms,filename,figname='Raw Data'):
 	use_science_style = False
 	
 	if use_science_style == True:
@@ -149,7 +742,7 @@ def plot_data(data,ms,filename):
 	red = (181/255.0, 18/255.0, 62/255.0)
 	green = (25/255.0, 150/255.0, 43/255.0) 
 	
-	f = plt.figure('Raw Data',figsize=(12,6))
+	f = plt.figure(figname,figsize=(12,6))
 	
 	# plot raw data
 	axVset = f.add_subplot(121)
@@ -169,17 +762,21 @@ def plot_data(data,ms,filename):
 		axVset.set_ylabel('Vset (V)',color=green)
 
 	if data.I.max() * 1e3 > 1 and data.I.max() * 1e3 < 1000:
-		Iref = data.I * 1e3
+		Ifactor = 1e3
 		axIref.set_ylabel('I (mA)',color=red)
 	elif data.I.max() * 1e6 > 1 and data.I.max() * 1e6 < 1000:
-		Iref = data.I * 1e6
+		Ifactor = 1e6
 		axIref.set_ylabel(r'I ($\mu$A)',color=red) 
 	else:
-		Iref = data.I
+		Ifactor = 1
 		axIref.set_ylabel('I (A)',color=red)
+	Iref = data.I * Ifactor
 	
 	axVset.plot(data.time,Vset,color=green,linestyle='-')
 	axIref.plot(data.time,Iref,color=red,linestyle='-')
+	# min/max of the bins of high resolution data
+	if 'I_min' in data:
+		axIref.fill_between(data.time,data.I_min*Ifactor,data.I_max*Ifactor,color=red,alpha=0.3,linewidth=0)
 
 	f.tight_layout()
 
@@ -1,35 +1,126 @@
+from time import perf_counter
+
 class HP33120A():
 	#Constructor
 	def __init__(self):
 		self.GBIPchannel = 22		#standart GBIP channel
+		self.metrics = None			#InstrumentMetrics (see Metrics.py) or None
+		self.invalidate_state()
 		
 # GENERAL
 
-	def connect_to_instrument(self, GPIBchannel):
-		import visa
+	def write(self, cmd):
+		try:
+			if self.metrics is None:
+				self.instrument.write(cmd)
+			else:
+				t_start = perf_counter()
+				self.instrument.write(cmd)
+				self.metrics.record(cmd, perf_counter() - t_start, len(cmd), 0)
+		except Exception:
+			# the instrument state is unknown after a failed transaction
+			self.invalidate_state()
+			raise
+
+	def ask(self, cmd):
+		try:
+			if self.metrics is None:
+				return self.instrument.ask(cmd)
+			t_start = perf_counter()
+			answer = self.instrument.ask(cmd)
+			self.metrics.record(cmd, perf_counter() - t_start, len(cmd), len(answer))
+			return answer
+		except Exception:
+			self.invalidate_state()
+			raise
+
+# SHADOW STATE
+# last values sent to the instrument, None = unknown
+# setters skip writes of unchanged values, configure() collapses several changes into one APPLy
+
+	STATE_KEYS = ('shape', 'frequency', 'amplitude', 'offset', 'burst_count', 'burst_status', 'trigger_source')
+
+	def invalidate_state(self):
+		self.state = dict.fromkeys(self.STATE_KEYS)
+
+	def _same(self, key, value):
+		old = self.state[key]
+		if old is None:
+			return False
+		if key in ('frequency', 'amplitude', 'offset'):
+			return '%f' % old == '%f' % value
+		if key == 'burst_count':
+			return int(old) == int(value)
+		return old == value
+
+	def _set(self, key, value, cmd):
+		if self._same(key, value):
+			return False
+		self.write(cmd)
+		self.state[key] = value
+		return True
+
+	def configure(self, shape, freq, amp, offs, burst_count=None, burst_status=None):
+		"""
+		set waveform (and burst) sending only the changed parameters,
+		two or more changed waveform parameters are sent as one APPLy command
+		burst_status: {ON, OFF} or None (= keep the current status)
+		"""
+		shape = shape.upper()
+		wanted = {'shape':shape, 'frequency':freq, 'amplitude':amp, 'offset':offs}
+		changed = [key for key, value in wanted.items() if not self._same(key, value)]
+		if len(changed) > 1:
+			# APPLy switches burst modulation off
+			if burst_status is None and self.state['burst_status'] != 'OFF':
+				burst_status = self.state['burst_status']
+			self.write('APPLy:%s %f, %f, %f' % (shape, freq, amp, offs))
+			self.state.update(wanted)
+			self.state['burst_status'] = 'OFF'
+		elif changed:
+			{'shape':self.set_shape, 'frequency':self.set_frequency, 'amplitude':self.set_amplitude,
+			 'offset':self.set_offset}[changed[0]](wanted[changed[0]])
+		if burst_count is not None:
+			self.set_burst_count(burst_count)
+		if burst_status is not None:
+			self.set_burst_status(burst_status)
+
+	def connect_to_instrument(self, GPIBchannel, rm=None):
+		"""
+		rm = VISA resource manager to use (e.g. Simulation.SimulatedResourceManager),
+		None = visa.ResourceManager()
+		"""
 		self.GPIBchannel = GPIBchannel
 		self.GPIBaddress = 'GPIB0::'+str(self.GPIBchannel)+'::INSTR'
 		
-		self.rm = visa.ResourceManager()
+		if rm is None:
+			import visa
+			rm = visa.ResourceManager()
+		self.rm = rm
 		self.instrument = self.rm.open_resource(self.GPIBaddress)
 		
 		self.off()
 		
 	def reset(self):
-		self.instrument.write('*RST')
+		self.write('*RST')
+		self.invalidate_state()
 
 	def error(self):
-		self.instrument.ask('SYS:ERR?')
+		err = self.ask('SYS:ERR?')
+		if not err.strip().startswith('+0'):
+			self.invalidate_state()
+		return err
 	
 	def identification(self):
-		return self.instrument.ask('*IDN?')
+		return self.ask('*IDN?')
 
 	def off(self):
 		"""
 		set output off
 		https://www.keysight.com/main/editorial.jspx?ckey=1000001212:epsg:faq&id=1000001212:epsg:faq&nid=-11143.0.00&lc=eng&cc=CA
 		"""
-		self.instrument.write(' APPLy:DC DEFault, DEFault, 0')
+		self.write(' APPLy:DC DEFault, DEFault, 0')
+		# the next configure() sends the complete setup again
+		self.invalidate_state()
 	
 # SHAPES
 
@@ -37,10 +128,10 @@ class HP33120A():
 		'''
 		shape : { SIN, SQU, TRI, RAMP, NOIS, DC, USER }
 		'''
-		self.instrument.write('SOUR:FUNC:SHAP %s' % shape)
+		self._set('shape', shape.upper(), 'SOUR:FUNC:SHAP %s' % shape)
 
 	def get_shape(self):
-		shape = self.instrument.ask('SOUR:FUNC:SHAP?')
+		shape = self.ask('SOUR:FUNC:SHAP?')
 		if "SIN" in shape:
 			print('Shape: Sine')
 		if "SQU" in shape:
@@ -59,63 +150,63 @@ class HP33120A():
 # PARAMETERS
 
 	def set_frequency(self, freq):
-		self.instrument.write('SOUR:FREQ %f' % freq)
+		self._set('frequency', freq, 'SOUR:FREQ %f' % freq)
 
 	def get_frequency(self):
-		self.freq = self.instrument.ask('SOUR:FREQ?')
+		self.freq = self.ask('SOUR:FREQ?')
 		#print('Frequency:'+self.freq)
 		return float(self.freq)
 
 		
 	def set_amplitude(self, amp):
-		self.instrument.write('SOUR:VOLT %f' % amp)
+		self._set('amplitude', amp, 'SOUR:VOLT %f' % amp)
 
 	def get_amplitude(self):
-		self.amp = self.instrument.ask('SOUR:VOLT?')
+		self.amp = self.ask('SOUR:VOLT?')
 		#print('Amplitude:'+self.amp)
 		return float(self.amp)
 		
 
 	def set_offset(self, freq):
-		self.instrument.write('SOUR:VOLT:OFFS %f' % freq)
+		self._set('offset', freq, 'SOUR:VOLT:OFFS %f' % freq)
 
 	def get_offset(self):
-		self.offs = self.instrument.ask('SOUR:VOLT:OFFS?')
+		self.offs = self.ask('SOUR:VOLT:OFFS?')
 		#print('Offset:'+self.offs)
 		return float(self.offs)
 		
 # BURST
 
 	def set_burst_count(self, cnt):
-		self.instrument.write('BM:NCYC %d' % cnt)
+		self._set('burst_count', cnt, 'BM:NCYC %d' % cnt)
 
 	def get_burst_count(self):
-		return float(self.instrument.ask('BM:NCYC?'))
+		return float(self.ask('BM:NCYC?'))
 
 	def set_burst_status(self, stat):
 		"""
 		stat: {ON, OFF}
 		"""
-		self.instrument.write('BM:STAT %s' % stat)
+		self._set('burst_status', stat.upper(), 'BM:STAT %s' % stat)
 
 	def get_burst_status(self):
-		return self.instrument.ask('BM:STAT?')
+		return self.ask('BM:STAT?')
 
 # TRIGGER
 
 	def set_trigger_continuous(self):
-		self.instrument.write('TRIG:SOUR IMM')
+		self._set('trigger_source', 'IMM', 'TRIG:SOUR IMM')
 
 	def set_trigger_external(self):
-		self.instrument.write('TRIG:SOUR EXT')
+		self._set('trigger_source', 'EXT', 'TRIG:SOUR EXT')
 
 	def set_trigger_gpib(self):
-		self.instrument.write('TRIG:SOUR BUS')
+		self._set('trigger_source', 'BUS', 'TRIG:SOUR BUS')
 		
 	def  get_trigger_status(self):
-		return self.instrument.ask('TRIG:SOUR?')
+		return self.ask('TRIG:SOUR?')
 		
 	def send_trigger(self):
-		self.instrument.write('*TRG')
+		self.write('*TRG')
 		
 		
@@ -41,6 +41,69 @@ def create_filename(date_time,meas_sett_dict):
 		   meas_sett_dict['electrkey'],meas_sett_dict['amp']*meas_sett_dict['ampfactor'],meas_sett_dict['freq'],meas_sett_dict['offs'])
 	return name
 
+def sample_filename(date_time, ms, channel, repeat=None):
+	"""
+	file name of the sample measured with channel (see create_filename and sample_settings),
+	_R<repeat> for campaign points, the additional samples (CHAN3/CHAN4) always get 
+	the suffix _<channel> (they may have the ElectrKey of the main sample)
+	"""
+	name = create_filename(date_time, sample_settings(ms, channel))
+	if repeat is not None:
+		name += '_R%i' % repeat
+	if channel != 'CHAN2':
+		name += '_' + channel
+	return name
+
+SAMPLE_CHANNELS = ('CHAN2', 'CHAN3', 'CHAN4')
+AUTO_SCALE_START = 10.		# first scale of Vref channels with ScaleDivider AUTO (V)
+
+def parse_sample_setting(line):
+	"""
+	(key, value) of a setting of an additional sample, e.g. 'CHAN3.Rref: 150e3' 
+	without the channel prefix, None if the line is no sample setting
+	"""
+	value = line.split(':',1)[1].strip()
+	if 'ElectrKey' in line:
+		return 'electrkey', value
+	elif 'ScaleDivider' in line:
+		return 'scale_divider', value if value == 'AUTO' else float(value)
+	for name, key in (('Area','area'), ('AErr','areaerr'), ('thickness','thickness'), ('capacity','cap'), 
+					  ('tand','tand'), ('VrefErr','vreferr'), ('Rref','rref'), ('RErr','rreferr')):
+		if name in line:
+			return key, float(value)
+	return None
+
+def sample_settings(ms, channel):
+	"""
+	measurement settings of the sample measured with channel (Vref), 
+	CHAN2 = the sample of the main settings
+	"""
+	if channel == 'CHAN2':
+		return ms
+	msc = dict(ms)
+	msc.update(ms['samples'][channel])
+	msc['scale_divider_CHAN2'] = msc.pop('scale_divider', ms['scale_divider_CHAN2'])
+	return msc
+
+def vref_column(channel):
+	"""
+	data column of the Vref channel (CHAN2 = 'Vref', CHAN3 = 'Vref_CHAN3', ...)
+	"""
+	return 'Vref' if channel == 'CHAN2' else 'Vref_' + channel
+
+def sample_data(data, channel):
+	"""
+	time, Vset and Vref (+ Vref_err, Vref_min, Vref_max) of the sample measured with channel
+	"""
+	column = vref_column(channel)
+	sample = data[[col for col in ('time','Vset','Vset_min','Vset_max') if col in data]].copy()
+	sample['Vref'] = data[column]
+	for suffix in ('_err', '_min', '_max'):
+		if column+suffix in data:
+			sample['Vref'+suffix] = data[column+suffix]
+	sample.attrs = dict(data.attrs)
+	return sample
+
 def get_measurement_settings(msfile='meas_settings.txt'):
 	"""
 	read meausrement setting for devices from measurement settings file
@@ -58,9 +121,18 @@ def get_measurement_settings(msfile='meas_settings.txt'):
 	- BurstCount = how many cycles in one burst (float)
 	- VrefErr = error of the voltage measurement at Rref (float)
 	- ScopeCyclAver = how many average cycles are set on the scope? -- 0.5 = 1 cycle (float)
+	- TargetPRError = stop external averaging when the standard error of PR is below (float) - yC/cm2 - optional
+	- MaxCycles = max. number of cycles of the adaptive averaging (float) - optional
+	- TimeBudget = max. acquisition time of the adaptive averaging (float) - s - optional
+	- HighResBins = read the deep memory (RAW) binned into this number of points 
+	  instead of the 1200 screen points (int), only with scope internal averaging - optional
+	- MemoryDepth = memory depth of the scope for HighResBins (float, e.g. 12e6) - optional
+	- CyclePeriods = cycle resolved evaluation, number and scatter of the full periods 
+	  of the trace in the results (ON/OFF) - optional
 	- Amplification = factor if voltage amplifier (e.g. Matsusada 5kV = 500) is used, if not 1 (float)
 	- ScaleDivider_CHAN1 = Divider for y-Scale on scope's channel1 (AUTO!)
-	- ScaleDivider_CHAN2 = Divider for y-Scale on scope's channel2 (float)
+	- ScaleDivider_CHAN2 = Divider for y-Scale on scope's channel2 (float or AUTO)
+	  AUTO = set by a pre-shot before the measurement (see DS1054Z.autorange)
 	- correct_Ebias = aligning the hysteresis around E = 0 (ON/OFF)
 	- correct_LossI = loss current correction from capacity and tand (ON/OFF)
 	- custom_curr_offs = use a custom current offset .. no automatic (float)
@@ -68,13 +140,38 @@ def get_measurement_settings(msfile='meas_settings.txt'):
 	- RErr = error of the reference resistance (float) - Ohm
 	- Temperature = sample temperature (float) - K
 	- Notes = notes from the user (string)
+	- CHAN3.<setting>, CHAN4.<setting> = additional samples measured at the same time, 
+	  Vref on CHAN3/CHAN4 (ElectrKey, Area, AErr, thickness, capacity, tand, VrefErr, 
+	  Rref, RErr, ScaleDivider), missing settings are taken from the main sample - optional
 	"""
 	
 	f = open(msfile,'r')
-	meas_settings  = {}
+	meas_settings  = {'samples':{}}
 	
 	for line in f:
-		if 'Name' in line:
+		# additional samples (checked first, the settings contain the keys of the main sample)
+		if line.startswith('CHAN3.') or line.startswith('CHAN4.'):
+			setting = parse_sample_setting(line)
+			if setting == ('scale_divider', 'AUTO'):
+				meas_settings.setdefault('autorange', []).append(line[:5])
+				setting = ('scale_divider', AUTO_SCALE_START)
+			if setting is not None:
+				meas_settings['samples'].setdefault(line[:5], {}).update([setting])
+			continue
+		# adaptive averaging (checked first, 'TargetPRError' contains 'RErr')
+		if 'TargetPRError' in line:
+			meas_settings.update({'target_prerr':float(line.split(':')[1].strip())/100})
+		elif 'MaxCycles' in line:
+			meas_settings.update({'max_cycles':float(line.split(':')[1].strip())})
+		elif 'TimeBudget' in line:
+			meas_settings.update({'time_budget':float(line.split(':')[1].strip())})
+		elif 'HighResBins' in line:
+			meas_settings.update({'bins':int(float(line.split(':')[1].strip()))})
+		elif 'MemoryDepth' in line:
+			meas_settings.update({'memory_depth':float(line.split(':')[1].strip())})
+		elif 'CyclePeriods' in line:
+			meas_settings.update({'periods':line.split(':')[1].strip() == 'ON'})
+		elif 'Name' in line:
 			name = line.split(':')[1].strip()
 			meas_settings.update({'name':name})
 		elif 'ElectrKey' in line:
@@ -134,13 +231,18 @@ def get_measurement_settings(msfile='meas_settings.txt'):
 		elif 'ScaleDivider_CHAN1' in line: 
 			divCH1 = line.split(':')[1].strip()
 			if divCH1 == 'AUTO':
-				meas_settings.update({'scale_divider_CHAN1':amp/3.})
-				#110% of full amp (devided by 3 scale units on scope)
+				meas_settings.update({'scale_divider_CHAN1':amp/3., 'auto_scale_CHAN1':True})
+				#110% of full amp (devided by 3 scale units on scope), start of the autorange
+				meas_settings.setdefault('autorange', []).append('CHAN1')
 			else:
 				meas_settings.update({'scale_divider_CHAN1':divCH1})
 		elif 'ScaleDivider_CHAN2' in line: 
-			divCH1 = float(line.split(':')[1].strip())
-			meas_settings.update({'scale_divider_CHAN2':divCH1})
+			divCH1 = line.split(':')[1].strip()
+			if divCH1 == 'AUTO':
+				meas_settings.update({'scale_divider_CHAN2':AUTO_SCALE_START})
+				meas_settings.setdefault('autorange', []).append('CHAN2')
+			else:
+				meas_settings.update({'scale_divider_CHAN2':float(divCH1)})
 		elif 'correct_Ebias' in line:
 			Ebias = line.split(':')[1].strip()
 			if Ebias == 'ON':
@@ -176,55 +278,447 @@ def get_measurement_settings(msfile='meas_settings.txt'):
 		meas_settings.update({'ampfactor':1.0})
 	if meas_settings['average'] == 0.0:
 		meas_settings['average'] = 1.0
+	# no adaptive averaging, if not found
+	meas_settings.setdefault('target_prerr', 0.0)
+	meas_settings.setdefault('max_cycles', meas_settings['average'])
+	meas_settings.setdefault('time_budget', 0.0)
+	# screen data (1200 points), if not found
+	meas_settings.setdefault('bins', 0)
+	# no cycle resolved evaluation, if not found
+	meas_settings.setdefault('periods', False)
+	# Vref channels: main sample on CHAN2
+	meas_settings['vref_channels'] = ['CHAN2'] + sorted(meas_settings['samples'])
 	return meas_settings
 
 
-def average(data_sets_list):
-	from numpy import mean
-	from pandas import DataFrame
+class MeasurementCancelled(Exception):
+	"""
+	raised by measure_hysteresis when its cancel flag was set (see Orchestration)
+	"""
+
+def check_cancel(cancel):
+	if cancel is not None and cancel.is_set():
+		raise MeasurementCancelled('measurement cancelled')
+
+class CycleAccumulator():
+	"""
+	running mean and variance per sample (Welford) of the columns of 
+	equally long cycles, memory does not grow with the number of cycles
+	NaN samples (e.g. masked by mask_begin_num) are not counted
+	>>> acc = CycleAccumulator()
+	>>> acc.add(cycle_data)		# DataFrame or dict of arrays
+	>>> data = acc.to_dataframe()
+	"""
+	def __init__(self, columns=('time','Vset','Vref')):
+		self.columns = tuple(columns)
+		self.n_cycles = 0
+		self.count = None
+		self.mean = None
+		self.m2 = None
 	
-	list_length = len(data_sets_list)
+	def add(self, cycle_data):
+		"""
+		fold one cycle into the mean and variance
+		"""
+		from numpy import asarray, isnan, zeros
+		for col in self.columns:
+			x = asarray(cycle_data[col], dtype=float)
+			if self.mean is None:
+				self.count = dict((c, zeros(len(x), dtype=int)) for c in self.columns)
+				self.mean = dict((c, zeros(len(x))) for c in self.columns)
+				self.m2 = dict((c, zeros(len(x))) for c in self.columns)
+			elif len(x) != len(self.mean[col]):
+				raise ValueError('cycle has %i samples, expected %i' % (len(x), len(self.mean[col])))
+			valid = ~isnan(x)
+			x = x[valid]
+			n = self.count[col][valid] + 1
+			mean = self.mean[col][valid]
+			delta = x - mean
+			mean += delta / n
+			self.m2[col][valid] += delta * (x - mean)
+			self.mean[col][valid] = mean
+			self.count[col][valid] = n
+		self.n_cycles += 1
 	
-	temp_time = []
-	temp_Vset = []
-	temp_Vref = []
+	def variance(self, col):
+		"""
+		sample variance per sample (NaN where less than 2 values)
+		"""
+		from numpy import nan, errstate, where
+		n = self.count[col]
+		with errstate(divide='ignore', invalid='ignore'):
+			return where(n > 1, self.m2[col] / (n - 1), nan)
 	
-	for i in range(list_length):
-		
-		temp_time.append(data_sets_list[i].time)
-		temp_Vset.append(data_sets_list[i].Vset) 
-		temp_Vref.append(data_sets_list[i].Vref)
+	def sem(self, col):
+		"""
+		standard error of the mean per sample (NaN where less than 2 values)
+		"""
+		from numpy import sqrt
+		return sqrt(self.variance(col) / self.count[col].clip(1))
+	
+	def to_dataframe(self, min_count=1):
+		"""
+		means and standard errors (columns <col>_err) of all samples 
+		with at least min_count values in every column
+		"""
+		from numpy import nan, where
+		from pandas import DataFrame
+		data = DataFrame()
+		for col in self.columns:
+			data[col] = where(self.count[col] > 0, self.mean[col], nan)
+		for col in self.columns:
+			data[col+'_err'] = self.sem(col)
+		keep = self.count[self.columns[0]] >= min_count
+		for col in self.columns[1:]:
+			keep &= self.count[col] >= min_count
+		return data[keep].reset_index(drop=True)
+
+class ConvergenceMonitor():
+	"""
+	adaptive averaging: evaluates PR of every cycle and folds it into the running 
+	mean and standard error of the cycle PRs (Welford, see CycleAccumulator),
+	done when the standard error is below target (C/m2),
+	after max_cycles or when time_budget (s, 0 = none) is exceeded
+	trace = [{'cycle', 'elapsed', 'PR', 'PR_sem'}, ...]
+	"""
+	def __init__(self, ms, target, max_cycles, time_budget=0, min_cycles=3):
+		from time import perf_counter
+		self.clock = perf_counter
+		self.ms = ms
+		self.target = target
+		self.max_cycles = int(max_cycles)
+		self.time_budget = time_budget
+		self.min_cycles = min_cycles
+		self.t_start = perf_counter()
+		self.prs = CycleAccumulator(columns=('PR',))
+		self.trace = []
+		self.done = False
+	
+	def add(self, cycle_data):
+		"""
+		evaluate the PR of cycle_data (dict of arrays time, Vset, Vref),
+		only this cycle is evaluated, the average is not
+		"""
+		from numpy import asarray, isnan
+		from HESMCtrl.Evaluation import evaluate_hysteresis
 		
-	data = DataFrame({'time':mean(temp_time,axis=0),'Vset':mean(temp_Vset,axis=0),'Vref':mean(temp_Vref,axis=0)})
+		time, Vset, Vref = (asarray(cycle_data[col], dtype=float) for col in ('time', 'Vset', 'Vref'))
+		valid = ~(isnan(time) | isnan(Vset) | isnan(Vref))
+		result = evaluate_hysteresis(time[valid], Vset[valid], Vref[valid], self.ms)[1]
+		self.prs.add({'PR':[abs(result['PR'].iloc[0])]})
+		n = self.prs.n_cycles
+		PR = self.prs.mean['PR'][0]
+		PR_sem = self.prs.sem('PR')[0] if n > 1 else float('nan')
+		elapsed = self.clock() - self.t_start
+		self.trace.append({'cycle':n, 'elapsed':elapsed, 'PR':PR, 'PR_sem':PR_sem})
+		self.done = self.done or (n >= self.max_cycles or (self.time_budget > 0 and elapsed >= self.time_budget) or
+								  (n >= self.min_cycles and PR_sem <= self.target))
+		return self.done
+
+def cycle_shifts(cycles, reference, max_shift=None):
+	"""
+	delay (samples, sub-sample resolution) of every row of cycles (n_cycles, n_samples) 
+	against reference (n_samples) from the peak of their FFT cross-correlation
+	max_shift = largest delay searched (samples), default = half the samples
+	NaN samples are treated as 0 (after removing the mean)
+	"""
+	from numpy import (asarray, atleast_2d, nan_to_num, nanmean, arange, abs, where, zeros, 
+					   concatenate, cumsum, sqrt, errstate)
+	from numpy.fft import rfft, irfft
+	
+	cycles = atleast_2d(asarray(cycles, dtype=float))
+	reference = asarray(reference, dtype=float)
+	n = cycles.shape[1]
+	if max_shift is None:
+		max_shift = n // 2
+	max_shift = int(min(max_shift, n - 2))
 	
-	data = data.drop(data.index[[1198,1199]])
-	return data
+	# zero padded (= not circular) correlation c[k] = sum(ref[t] * x[t+k])
+	x = nan_to_num(cycles - nanmean(cycles, axis=1)[:,None])
+	ref = nan_to_num(reference - nanmean(reference))
+	nfft = 2 * n
+	corr = irfft(rfft(ref, nfft).conj() * rfft(x, nfft, axis=1), nfft, axis=1)
+	lags = arange(nfft)
+	lags = where(lags < n, lags, lags - nfft)
+	corr[:, abs(lags) > max_shift] = -float('inf')
+	peak = corr.argmax(axis=1)
 	
-def measure_hysteresis(filename,ms):
+	# the shrinking overlap biases the peak towards 0, climb to the nearest maximum
+	# of the correlation normalized by the energies of the overlapping parts
+	e_ref = concatenate(([0.], cumsum(ref**2)))
+	e_x = concatenate((zeros((len(x),1)), cumsum(x**2, axis=1)), axis=1)
+	k = abs(lags)
+	pos = lags >= 0
+	energy_ref = where(pos, e_ref[n-k.clip(0,n)], e_ref[n] - e_ref[k.clip(0,n)])
+	energy_x = where(pos, e_x[:,[n]] - e_x[:,k.clip(0,n)], e_x[:,n-k.clip(0,n)])
+	with errstate(divide='ignore', invalid='ignore'):
+		corr = nan_to_num(corr / sqrt(energy_ref * energy_x), nan=-1.)
+	rows = arange(len(corr))
+	for i in range(max_shift):
+		left, right = (peak - 1) % nfft, (peak + 1) % nfft
+		step = where(corr[rows, right] > corr[rows, peak], 1, where(corr[rows, left] > corr[rows, peak], -1, 0))
+		if not step.any():
+			break
+		peak = (peak + step) % nfft
+	
+	# parabolic interpolation of the peak
+	y0 = corr[rows, peak]
+	ym = corr[rows, (peak - 1) % nfft]
+	yp = corr[rows, (peak + 1) % nfft]
+	denom = ym - 2*y0 + yp
+	ok = (abs(lags[peak]) < max_shift) & (denom < 0)
+	delta = zeros(len(corr))
+	delta[ok] = 0.5 * (ym[ok] - yp[ok]) / denom[ok]
+	return lags[peak] + delta
+
+def shift_cycles(cycles, shifts):
 	"""
-	Measures ferroelectric hysteresis (Shunt Method) with a HP33120A 
-	Frequency Generator and a RIGOL DS1054Z Scope
-	ms = measurement settings (dict)
+	moves every row of cycles (n_cycles, n_samples) by -shifts samples 
+	(linear interpolation), samples shifted in from outside are NaN
 	"""
+	from numpy import asarray, atleast_2d, arange, floor, nan, where
 	
-	# load device functions
-	from HESMCtrl.DS1054ZCtrl import DS1054Z
-	from HESMCtrl.HP33120ACtrl import HP33120A
-	from time import clock, sleep
-	import sys
-	from numpy import array
+	cycles = atleast_2d(asarray(cycles, dtype=float))
+	n = cycles.shape[1]
+	positions = arange(n)[None,:] + asarray(shifts, dtype=float).reshape(-1,1)
+	i0 = floor(positions).astype(int)
+	frac = positions - i0
+	valid = (i0 >= 0) & ((i0 < n-1) | ((i0 == n-1) & (frac == 0)))
+	i0 = i0.clip(0, n-2)
+	i1 = i0 + 1
+	frac = where(valid, positions - i0, 0)
+	rows = arange(len(cycles))[:,None]
+	shifted = cycles[rows, i0] * (1 - frac) + cycles[rows, i1] * frac
+	return where(valid, shifted, nan)
+
+def align_cycles(cycles, reference=None, ref_column='Vset', columns=('Vset','Vref'), max_shift=None):
+	"""
+	registers the cycles (dict of (n_cycles, n_samples) arrays) by the cross-correlation 
+	of ref_column against reference (default: the first cycle), 
+	all columns are shifted by the same delay (the time column is kept)
+	returns (aligned dict, shifts in samples)
+	"""
+	from numpy import atleast_2d, asarray
+	ref_cycles = atleast_2d(asarray(cycles[ref_column], dtype=float))
+	if reference is None:
+		reference = ref_cycles[0]
+	shifts = cycle_shifts(ref_cycles, reference, max_shift)
+	aligned = dict(cycles)
+	for col in columns:
+		aligned[col] = shift_cycles(cycles[col], shifts)
+	return aligned, shifts
+
+def average(data_sets_list):
+	"""
+	mean (and standard error) of the cycles in data_sets_list (see CycleAccumulator)
+	"""
+	accumulator = CycleAccumulator()
+	for data_set in data_sets_list:
+		accumulator.add(data_set)
+	return accumulator.to_dataframe()
+	
+class CycleTimeline():
+	"""
+	start/end time (s since creation) of every phase of every averaging cycle
+	and the thread it ran in
+	>>> timeline.run(i, 'readout', SCOPE.capture, ['CHAN1','CHAN2'])
+	"""
+	def __init__(self):
+		from time import perf_counter
+		self.clock = perf_counter
+		self.t0 = perf_counter()
+		self.entries = []
+	
+	def run(self, cycle, phase, func, *args, **kwargs):
+		"""
+		call func(*args, **kwargs) and record its duration as phase of cycle
+		"""
+		import threading
+		t_begin = self.clock()
+		try:
+			return func(*args, **kwargs)
+		finally:
+			self.entries.append((cycle, phase, threading.current_thread().name, 
+								 t_begin - self.t0, self.clock() - self.t0))
+	
+	def to_dataframe(self):
+		from pandas import DataFrame
+		return DataFrame(self.entries, columns=['cycle','phase','thread','start','end']).sort_values('start')
+	
+	def print_summary(self, acquisition_phase='acquisition'):
+		"""
+		total time of every phase and the share of the run the scope spent acquiring
+		"""
+		df = self.to_dataframe()
+		if len(df) == 0:
+			return
+		df['duration'] = df.end - df.start
+		total = df.end.max() - df.start.min()
+		for phase, duration in df.groupby('phase', sort=False).duration.sum().items():
+			print('... %-12s %6.2f s' % (phase, duration))
+		acquiring = df.duration[df.phase == acquisition_phase].sum()
+		print('... scope acquiring %.1f %% of %.2f s' % (100*acquiring/total, total))
+
+def measure_cycles_pipelined(FG, SCOPE, ms, on_cycle=None, timeline=None, align=True, monitor=None, cancel=None):
+	"""
+	external averaging over ms['average'] single acquisitions (low frequencies)
+	the instruments only arm, acquire and read out in the calling thread,
+	- switching off the frequency generator (GPIB) runs in parallel to the scope readout (LAN)
+	- decoding and averaging (CycleAccumulator) of cycle i runs on a worker thread while cycle i+1 is acquired
+	on_cycle(i, cycle_data) = optional evaluation of every cycle (called on the worker thread)
+	align = register every cycle to the first one before averaging (see align_cycles)
+	only one evaluation is in flight: cycle i is armed when the evaluation of cycle i-2 has finished
+	(its exceptions are raised then)
+	monitor = ConvergenceMonitor deciding whether to continue (instead of ms['average'] cycles),
+	it evaluates on the worker thread too: the next cycle is armed with the decision 
+	of the evaluations finished by then, so at most one cycle more than needed is measured
+	cancel = threading.Event, checked before every cycle: MeasurementCancelled is raised 
+	(with the FG off and the scope stopped) when it is set
+	returns (averaged data, CycleTimeline)
+	"""
+	from concurrent.futures import ThreadPoolExecutor
 	from pandas import DataFrame
+	import sys
+	
+	if timeline is None:
+		timeline = CycleTimeline()
+	vref_channels = ms.get('vref_channels', ['CHAN2'])
+	vref_columns = [vref_column(channel) for channel in vref_channels]
+	accumulator = CycleAccumulator(columns=['time','Vset'] + vref_columns)
+	shifts, reference = [], []
+	
+	def process(i, block):
+		# decode the raw bytes (the scope is not accessed), align and fold them into the average
+		cycle_data = {'time':block.time.to_array(),'Vset':block['CHAN1'] * ms['ampfactor']}
+		for channel, column in zip(vref_channels, vref_columns):
+			cycle_data[column] = block[channel]
+		if align:
+			if i == 0:
+				shifts.append(0.)
+				reference.append(cycle_data['Vset'])
+			else:
+				aligned, shift = align_cycles(cycle_data, reference[0], columns=['Vset'] + vref_columns)
+				cycle_data = dict((column, values if column == 'time' else aligned[column][0]) 
+								  for column, values in cycle_data.items())
+				shifts.append(shift[0])
+		accumulator.add(cycle_data)
+		if monitor is not None:
+			monitor.add(cycle_data)
+		if on_cycle is not None:
+			on_cycle(i, DataFrame(cycle_data))
+	
+	with ThreadPoolExecutor(1, thread_name_prefix='GPIB') as gpib, ThreadPoolExecutor(1, thread_name_prefix='worker') as worker:
+		fg_off = None
+		tasks = []
+		n_cycles = int(ms['average']) if monitor is None else monitor.max_cycles
+		for i in range(n_cycles):
+			
+			# at most one evaluation in flight (the one of the last cycle)
+			if len(tasks) >= 2:
+				tasks[-2].result()
+			
+			# adaptive averaging: decided by the evaluations finished so far
+			if monitor is not None and monitor.done:
+				break
+			if monitor is not None and monitor.trace:
+				entry = monitor.trace[-1]
+				sys.stdout.write('\r... acquisition cycle %i; PR: %f +- %f yC/cm2 '%(
+								 i+1, entry['PR']*100, entry['PR_sem']*100))
+				sys.stdout.flush()
+			else:
+				# Shell Informations
+				sys.stdout.write('\r... acquisition cycle %i/%i'%(i+1,n_cycles))
+				sys.stdout.flush()
+			
+			# FG has to be off before the excitation is started again
+			if fg_off is not None:
+				fg_off.result()
+			check_cancel(cancel)
+			
+			# setting frequency generator (only changed parameters are sent)
+			timeline.run(i, 'configure', configure_generator, FG, ms)
+			
+			# single acquisition, forced trigger, wait until scope has all data
+			timeline.run(i, 'arm', SCOPE.single)
+			timeline.run(i, 'arm', SCOPE.tforce)
+			timeline.run(i, 'acquisition', SCOPE.wait_for_acquisition)
+			
+			# switch off the FG while the data is read from the scope
+			fg_off = gpib.submit(timeline.run, i, 'fg_off', FG.off)
+			block = timeline.run(i, 'readout', SCOPE.capture, ['CHAN1'] + vref_channels, mode='NORM')
+			timeline.run(i, 'stop', SCOPE.stop)
+			
+			tasks.append(worker.submit(timeline.run, i, 'decode', process, i, block))
+		
+		if fg_off is not None:
+			fg_off.result()
+		for task in tasks:
+			task.result()
+		data = worker.submit(timeline.run, i, 'average', accumulator.to_dataframe).result()
+	if align and len(shifts) > 1:
+		print('\n... cycles aligned; shifts: %s samples' % ', '.join('%+.1f' % shift for shift in shifts[1:]))
+	return data, timeline
+
+def configure_generator(FG, ms):
+	"""
+	triangle excitation (+ burst) of the measurement settings,
+	only changed parameters are sent (see HP33120A.configure)
+	"""
+	if ms['burst_status'] == True:
+		FG.configure('TRI', ms['freq'], ms['amp'], ms['offs'], burst_count=ms['burst_count'], burst_status='ON')
+	else:
+		FG.configure('TRI', ms['freq'], ms['amp'], ms['offs'])
+
+def connect_instruments(FG=None, SCOPE=None):
+	"""
+	connects to the HP33120A (GPIB) and the DS1054Z (Ethernet) given in Comm.conf
+	FG, SCOPE = already connected drivers, only the missing ones are connected
+	returns (FG, SCOPE)
+	"""
+	if FG is not None and SCOPE is not None:
+		return FG, SCOPE
 	
 	# get IP and GPIB channel from config file
 	SCOPEIP, FGGPIBchannel = get_config()
 		
 	# connect and init HP33120A Frequency Generator via GPIB
-	FG = HP33120A()
-	FG.connect_to_instrument(int(FGGPIBchannel))
-	FG.off()
+	if FG is None:
+		from HESMCtrl.HP33120ACtrl import HP33120A
+		FG = HP33120A()
+		FG.connect_to_instrument(int(FGGPIBchannel))
 
 	# connect to the DS1054Z via Ehternet (replace IP Adress if needed!)
-	SCOPE = DS1054Z(SCOPEIP)
+	if SCOPE is None:
+		from HESMCtrl.DS1054ZCtrl import DS1054Z
+		SCOPE = DS1054Z(SCOPEIP)
+	return FG, SCOPE
+
+def measure_hysteresis(filename,ms,metrics_file=None,FG=None,SCOPE=None,cancel=None):
+	"""
+	Measures ferroelectric hysteresis (Shunt Method) with a HP33120A 
+	Frequency Generator and a RIGOL DS1054Z Scope
+	ms = measurement settings (dict)
+	metrics_file = write per-command latency statistics of both instruments 
+	to this JSON file (see Metrics.py), None = no instrumentation
+	FG, SCOPE = connected HP33120A and DS1054Z drivers (e.g. from 
+	Simulation.connect_simulated_instruments), None = connect via Comm.conf
+	(only the missing one is connected)
+	cancel = threading.Event stopping the measurement between two acquisitions 
+	(MeasurementCancelled is raised), None = no cancellation
+	"""
+	
+	from time import perf_counter as clock
+	import sys, os
+	from pandas import DataFrame
+	
+	FG, SCOPE = connect_instruments(FG, SCOPE)
+	FG.off()
+	
+	# record latencies of all instrument commands
+	if metrics_file is not None:
+		from HESMCtrl.Metrics import InstrumentMetrics
+		FG.metrics = InstrumentMetrics('HP33120A')
+		SCOPE.metrics = InstrumentMetrics('DS1054Z')
 
 	# Show Instruments
 	print_line()
@@ -243,27 +737,49 @@ def measure_hysteresis(filename,ms):
 	# check frequency to determine wheter scope internal averaging or external avaraging has to be used
 	if ms['freq'] <= 1.0:
 		print('... external averaging used')
+		if ms.get('target_prerr', 0) > 0:
+			print('... adaptive averaging: PR error < %.3f yC/cm2, max. %i cycles' % (
+				  ms['target_prerr']*100, ms['max_cycles']))
 		low_f_flag = True
 		# when using low frequencies, internal averaging of the scope is not possible
 		# has to be done manually!!! --> using single trigger measurements (SCOPE.single()) over given average cycles
 	else:
 		print('... scope internal avaraging used')
 		print('... averaging cycles: %i' % ms['average'])
+		if ms.get('bins', 0) > 0:
+			print('... high resolution: deep memory binned into %i points' % ms['bins'])
 		low_f_flag = False
 	
 	# is burst enabled?
 	if ms['burst_status'] == True:
 			print('... burst enabled')
 
-	# activate Scope's Channel1 and Channel2 if necessary
-	if 'CHAN1' not in SCOPE.displayed_channels or 'CHAN2' not in SCOPE.displayed_channels:
-		SCOPE.display_channel('CHAN1')		#Vset
-		SCOPE.display_channel('CHAN2')		#Vref
+	# Vref channels of all samples (CHAN2 + optional CHAN3/CHAN4)
+	vref_channels = ms.get('vref_channels', ['CHAN2'])
+	if len(vref_channels) > 1:
+		print('... samples: %s' % ', '.join('%s (%s)' % (sample_settings(ms, channel)['electrkey'], channel)
+											for channel in vref_channels))
+
+	# activate Scope's Channel1 (Vset) and the Vref channels if necessary
+	displayed_channels = SCOPE.displayed_channels
+	for channel in ['CHAN1'] + vref_channels:
+		if channel not in displayed_channels:
+			SCOPE.display_channel(channel)
 
 	# setting scale depending on input signal
 	SCOPE.timebase_scale = 1./(ms['freq'])/5		# setting strange ... but deviding by 5 gives approx 3 periods in display
 	SCOPE.set_channel_scale('CHAN1',ms['scale_divider_CHAN1'])		
-	SCOPE.set_channel_scale('CHAN2',ms['scale_divider_CHAN2'])
+	for channel in vref_channels:
+		SCOPE.set_channel_scale(channel,sample_settings(ms, channel)['scale_divider_CHAN2'])
+	
+	# autorange pre-shot for the channels with ScaleDivider AUTO (before the averaging)
+	if ms.get('autorange'):
+		t_autorange = clock()
+		configure_generator(FG, ms)
+		scales = SCOPE.autorange(ms['autorange'])
+		FG.off()
+		print('... autorange (%.2f s): %s' % (clock()-t_autorange, 
+			  ', '.join('%s %g V/div' % (channel, scale) for channel, scale in scales.items())))
 
 	# start aquisition with scope
 	print_line()
@@ -274,89 +790,79 @@ def measure_hysteresis(filename,ms):
 	# set for 3 periods as provided by the timescale (see above)	
 	acquisition_time = 1/ms['freq'] * 3.5	
 	
+	# time spent waiting for the scope compared to the former fixed sleeps
+	t_waited = 0.
 	if low_f_flag == True:
-		# init list of all cyclesets
-		cycle_data_sets = []
-		
-		for i in range(int(ms['average'])):
-			
-			# Shell Informations
-			sys.stdout.write('\r... acquisition cycle %i/%i'%(i+1,ms['average']))
-			sys.stdout.flush()
-		
-			# setting frequency generator
-			if ms['burst_status'] == True:
-				FG.set_burst_count(ms['burst_count'])
-				FG.set_burst_status('ON')
-			FG.set_shape('TRI')
-			FG.set_frequency(ms['freq'])
-			FG.set_amplitude(ms['amp']) 
-			FG.set_offset(ms['offs'])
-			
-			# set scope to single aquisition mode
-			SCOPE.single()
-			
-			# Force Trigger!
-			SCOPE.tforce()
-			
-			# wat until scope has all data
-			sleep(acquisition_time)
-			
-			# save data
-			Vset = array(SCOPE.get_waveform_samples('CHAN1',mode='NORM')) * ms['ampfactor']
-			Vref = array(SCOPE.get_waveform_samples('CHAN2',mode='NORM')) 
-			time = array(SCOPE.waveform_time_values)
-			
-			# combine data in DataFrame
-			cycle_data = DataFrame({'time':time,'Vset':Vset,'Vref':Vref})
-			cycle_data_sets.append(cycle_data)
-			
-			# stop scope (if not already done) and frequency generator
-			SCOPE.stop()
-			FG.off()
-			
-			# wait 2 seconds before start again
-			sleep(2)	
+		t_fixed_schedule = int(ms['average']) * (acquisition_time + 2)
+	else:
+		t_fixed_schedule = 2 + 1 + ms['average']*acquisition_time
+	
+	if low_f_flag == True:
+		# pipelined single acquisitions, see measure_cycles_pipelined
+		monitor = None
+		if ms.get('target_prerr', 0) > 0:
+			monitor = ConvergenceMonitor(ms, ms['target_prerr'], ms['max_cycles'], ms['time_budget'])
+		data, timeline = measure_cycles_pipelined(FG, SCOPE, ms, monitor=monitor, cancel=cancel)
+		if monitor is not None:
+			data.attrs['convergence'] = monitor.trace
+		t_waited += timeline.to_dataframe().query("phase == 'acquisition'").eval('end - start').sum()
 
 		# stop time measurement
 		t_end = clock()
 		print('\n... finished acquisition; time: %.2f s' % (t_end-t_start))
-		
-		# average data after loop
-		print('... averaging ...')
-		data = average(cycle_data_sets)
+		print('... waiting for scope: %.2f s (fixed schedule: %.2f s, saved: %.2f s)' % (
+			  t_waited, t_fixed_schedule, t_fixed_schedule-t_waited))
+		timeline.print_summary()
+		if metrics_file is not None:
+			timeline.to_dataframe().to_csv(os.path.splitext(metrics_file)[0] + '_timeline.csv', index=False)
 		
 	else:
+		check_cancel(cancel)
 		SCOPE.run()
-		sleep(2)	#wait until scope is ready
+		if ms.get('bins', 0) > 0 and ms.get('memory_depth'):
+			SCOPE.memory_depth = ms['memory_depth']
 
 		# settings for FG
-		if ms['burst_status'] == True:
-			FG.set_burst_count(ms['burst_count'])
-			FG.set_burst_status('ON')
-		FG.set_shape('TRI')
-		FG.set_frequency(ms['freq'])
-		FG.set_amplitude(ms['amp']) 
-		FG.set_offset(ms['offs'])
-
-		# wait until scope has all the data (dpending on frequency)
-		
-		sleep(1 + ms['average']*acquisition_time)
+		configure_generator(FG, ms)
 
-		Vset = array(SCOPE.get_waveform_samples('CHAN1',mode='NORM')) * ms['ampfactor']
-		Vref = array(SCOPE.get_waveform_samples('CHAN2',mode='NORM')) 
-		time = array(SCOPE.waveform_time_values)
-		#t = t-time_offset
-		
-		# stop acquisition and switch off Freq.Gen.
+		# wait until scope has all the data (dpending on frequency), stop freezes the averaged data
+		t_waited += SCOPE.wait_for_acquisition(screens=int(ms['average']))
 		SCOPE.stop()
-		FG.off()
 
-		data = DataFrame({'time':time,'Vset':Vset,'Vref':Vref})
+		if ms.get('bins', 0) > 0:
+			# deep memory binned chunk by chunk (mean, min, max per bin)
+			from HESMCtrl.Evaluation import get_binned_capture_data
+			t_readout = clock()
+			block = SCOPE.capture_binned(['CHAN1'] + vref_channels, bins=ms['bins'])
+			print('... deep memory: %i samples in %i bins of %i (%.2f s)' % (
+				  len(block)*block.bin_size, len(block), block.bin_size, clock()-t_readout))
+			FG.off()
+			data = get_binned_capture_data(block, ms, vrefs=vref_channels)
+		else:
+			block = SCOPE.capture(['CHAN1'] + vref_channels,mode='NORM')
+			Vset = block['CHAN1'] * ms['ampfactor']
+			time = block.time.to_array()
+			#t = t-time_offset
+			
+			# switch off Freq.Gen.
+			FG.off()
+
+			data = DataFrame({'time':time,'Vset':Vset})
+			for channel in vref_channels:
+				data[vref_column(channel)] = block[channel]
 
 		# stop time measurement
 		t_end = clock()
 		print('... finished acquisition; time: %.2f s' % (t_end-t_start))
+		print('... waiting for scope: %.2f s (fixed schedule: %.2f s, saved: %.2f s)' % (
+			  t_waited, t_fixed_schedule, t_fixed_schedule-t_waited))
 		print_line()
 	
+	if metrics_file is not None:
+		from HESMCtrl.Metrics import save_metrics_json
+		FG.metrics.print_summary()
+		SCOPE.metrics.print_summary()
+		save_metrics_json(metrics_file, [FG.metrics, SCOPE.metrics])
+		print('... instrument metrics saved to %s' % metrics_file)
+	
 	return data
\ No newline at end of file
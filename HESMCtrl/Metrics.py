@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Latency and throughput statistics of the instrument communication
+"""
+
+from bisect import bisect_left
+from time import perf_counter
+
+# upper bounds of the latency histogram bins: 10 us * 2^k (up to ~170 s)
+LATENCY_BINS = tuple(1e-5 * 2**k for k in range(25))
+
+def command_key(message):
+	"""
+	SCPI message without arguments, e.g.
+	':WAVeform:STARt 1;:WAVeform:DATA?' -> ':WAVeform:STARt;:WAVeform:DATA?'
+	"""
+	if isinstance(message, (bytes, bytearray)):
+		message = message.decode('utf-8', 'replace')
+	return ';'.join(part.strip().split(' ')[0] for part in message.strip().split(';'))
+
+class CommandStats():
+	"""
+	statistics of one SCPI command:
+	count, total/min/max latency (s), bytes sent/received and latency histogram
+	"""
+	def __init__(self):
+		self.count = 0
+		self.seconds = 0.0
+		self.min = None
+		self.max = 0.0
+		self.bytes_sent = 0
+		self.bytes_received = 0
+		self.histogram = [0] * (len(LATENCY_BINS) + 1)
+
+	def add(self, seconds, bytes_sent, bytes_received):
+		self.count += 1
+		self.seconds += seconds
+		if self.min is None or seconds < self.min:
+			self.min = seconds
+		if seconds > self.max:
+			self.max = seconds
+		self.bytes_sent += bytes_sent
+		self.bytes_received += bytes_received
+		self.histogram[bisect_left(LATENCY_BINS, seconds)] += 1
+
+	def to_dict(self):
+		labels = ['<=%gs' % bound for bound in LATENCY_BINS] + ['>%gs' % LATENCY_BINS[-1]]
+		histogram = dict((label, n) for label, n in zip(labels, self.histogram) if n)
+		return {'count':self.count, 'seconds':self.seconds,
+				'mean_ms':self.seconds / self.count * 1e3 if self.count else 0.0,
+				'min_ms':(self.min or 0.0) * 1e3, 'max_ms':self.max * 1e3,
+				'bytes_sent':self.bytes_sent, 'bytes_received':self.bytes_received,
+				'histogram':histogram}
+
+class InstrumentMetrics():
+	"""
+	collects CommandStats per SCPI command of one instrument
+	a query is counted from its write until its answer has been read,
+	a command (without '?') by its write alone
+	>>> scope.metrics = InstrumentMetrics('DS1054Z')
+	"""
+	def __init__(self, name=''):
+		self.name = name
+		self.commands = {}
+		self.t_created = perf_counter()
+		self._pending = None
+
+	def _stats(self, key):
+		stats = self.commands.get(key)
+		if stats is None:
+			stats = self.commands[key] = CommandStats()
+		return stats
+
+	def record(self, message, seconds, bytes_sent=0, bytes_received=0):
+		"""
+		add one complete exchange (e.g. write + read of a query)
+		"""
+		self._stats(command_key(message)).add(seconds, bytes_sent, bytes_received)
+
+	def record_write(self, message, seconds):
+		"""
+		add a write, queries are completed by record_read()
+		"""
+		key = command_key(message)
+		if key.endswith('?'):
+			self._pending = (key, seconds, len(message))
+		else:
+			self._pending = None
+			self._stats(key).add(seconds, len(message), 0)
+
+	def record_read(self, nbytes, seconds):
+		"""
+		add the read completing the last query
+		"""
+		if self._pending is None:
+			key, write_seconds, nsent = '<read>', 0.0, 0
+		else:
+			key, write_seconds, nsent = self._pending
+			self._pending = None
+		self._stats(key).add(write_seconds + seconds, nsent, nbytes)
+
+	def reset(self):
+		self.commands = {}
+		self.t_created = perf_counter()
+		self._pending = None
+
+	def summary(self):
+		"""
+		dict of all commands (most time consuming first) and totals
+		"""
+		commands = sorted(self.commands.items(), key=lambda item: -item[1].seconds)
+		return {'instrument':self.name,
+				'elapsed_s':perf_counter() - self.t_created,
+				'io_seconds':sum(stats.seconds for stats in self.commands.values()),
+				'round_trips':sum(stats.count for stats in self.commands.values()),
+				'bytes_received':sum(stats.bytes_received for stats in self.commands.values()),
+				'commands':dict((key, stats.to_dict()) for key, stats in commands)}
+
+	def print_summary(self, top=5):
+		summary = self.summary()
+		print('... %s: %i round trips, %.2f s I/O in %.2f s' % (self.name, summary['round_trips'],
+			  summary['io_seconds'], summary['elapsed_s']))
+		for key, stats in list(summary['commands'].items())[:top]:
+			print('...   %6.2f s  %5ix  %s' % (stats['seconds'], stats['count'], key))
+
+def save_metrics_json(filename, metrics_list):
+	"""
+	write the summaries of several InstrumentMetrics to a JSON file
+	"""
+	import json
+	with open(filename, 'w') as f:
+		json.dump([metrics.summary() for metrics in metrics_list], f, indent=1)
@@ -39,4 +39,98 @@ def save_all(data, result, figure, filename, mode='measure'):
 	data.to_pickle(filepath+filename+'_data.pd')
 	result.to_csv(filepath+filename+'_results.txt')
 
-	print('... saving finished!')
\ No newline at end of file
+	print('... saving finished!')
+
+class RawCaptureFile():
+	"""
+	deep memory capture of several scope channels on disk
+	- <path>.npy = waveform bytes as (channels, points) uint8 array (memory-mapped)
+	- <path>.json = channel names, scope preambles and completion flag
+	create with create_raw_capture(), open with open_raw_capture()
+	"""
+	def __init__(self, path, array, metadata):
+		self.path = path
+		self.array = array
+		self.metadata = metadata
+		self.channels = metadata['channels']
+		self.preambles = metadata['preambles']
+
+	def __len__(self):
+		return self.array.shape[1]
+
+	@property
+	def complete(self):
+		return self.metadata['complete']
+
+	def codes(self, channel):
+		"""
+		memory-mapped waveform bytes of a channel (uint8 array)
+		"""
+		return self.array[self.channels.index(channel)]
+
+	def voltages(self, channel, start=0, stop=None, step=1, dtype='float64'):
+		"""
+		voltages of a channel (only the requested range is read from disk)
+		"""
+		from numpy import asarray
+		wp = self.preambles[channel]
+		samples = asarray(self.codes(channel)[start:stop:step], dtype=dtype)
+		samples -= wp['yorig'] + wp['yref']
+		samples *= wp['yinc']
+		return samples
+
+	def time(self, start=0, stop=None, step=1):
+		"""
+		sample timestamps (s) of the given range
+		"""
+		from numpy import arange
+		wp = self.preambles[self.channels[0]]
+		if stop is None:
+			stop = len(self)
+		return wp['xinc'] * arange(start, stop, step) + wp['xorig']
+
+	def iter_chunks(self, channel, chunk_size=1000000, dtype='float64'):
+		"""
+		yields (start index, voltages) for consecutive chunks of a channel
+		"""
+		for start in range(0, len(self), chunk_size):
+			yield start, self.voltages(channel, start, start+chunk_size, dtype=dtype)
+
+	def flush(self, complete=None):
+		"""
+		writes the data and the metadata to disk
+		"""
+		import json
+		if complete is not None:
+			self.metadata['complete'] = complete
+		if hasattr(self.array, 'flush'):
+			self.array.flush()
+		with open(self.path+'.json', 'w') as f:
+			json.dump(self.metadata, f, indent=1)
+
+def create_raw_capture(path, channels, preambles):
+	"""
+	creates the files of a RawCaptureFile for the given channels
+	preambles = {channel: preamble dict of DS1054Z}, all with the same number of points
+	"""
+	from numpy import uint8
+	from numpy.lib.format import open_memmap
+	
+	channels = list(channels)
+	pnts = preambles[channels[0]]['pnts']
+	array = open_memmap(path+'.npy', mode='w+', dtype=uint8, shape=(len(channels), pnts))
+	metadata = {'channels':channels, 'preambles':dict((ch, preambles[ch]) for ch in channels), 'complete':False}
+	capture = RawCaptureFile(path, array, metadata)
+	capture.flush()
+	return capture
+
+def open_raw_capture(path):
+	"""
+	opens a RawCaptureFile read-only without loading the data into memory
+	"""
+	import json
+	from numpy import load
+	
+	with open(path+'.json', 'r') as f:
+		metadata = json.load(f)
+	return RawCaptureFile(path, load(path+'.npy', mmap_mode='r'), metadata)
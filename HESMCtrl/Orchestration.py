@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Drive several measurement stations (HP33120A + DS1054Z pairs) concurrently
+from one process with asyncio: campaign points are measured by whichever
+station is free, the blocking instrument I/O of every station runs in its own thread
+"""
+
+import asyncio
+
+class Station():
+	"""
+	one HP33120A / DS1054Z pair
+	the drivers are not thread safe, all their calls run in the single thread of the station
+	- settle_timeout = max. time (s) a cancelled measurement may take to stop,
+	  a station not stopping in time is stuck and not used any more
+	"""
+	def __init__(self, name, FG, SCOPE, settle_timeout=60.):
+		from concurrent.futures import ThreadPoolExecutor
+		import threading
+		self.name = name
+		self.FG = FG
+		self.SCOPE = SCOPE
+		self.settle_timeout = settle_timeout
+		self.executor = ThreadPoolExecutor(1, thread_name_prefix=name)
+		self.cancel_event = threading.Event()	# stops the blocking measurement between two acquisitions
+		self.task = None		# asyncio task of the current point
+		self.busy = None		# executor future of the current point
+		self.stuck = False
+		self.measured = 0
+
+	async def run(self, func, *args, **kwargs):
+		"""
+		run func(*args, **kwargs) in the thread of the station
+		(the executor future is shielded, see settle)
+		"""
+		from functools import partial
+		self.cancel_event.clear()
+		self.busy = asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+		return await asyncio.shield(self.busy)
+
+	async def settle(self):
+		"""
+		stop a cancelled or timed out call (cancel_event), wait until it has returned
+		and switch the FG off, both for at most settle_timeout
+		returns False if the station is stuck
+		"""
+		loop = asyncio.get_running_loop()
+		self.cancel_event.set()
+		if self.busy is not None:
+			done, pending = await asyncio.wait([self.busy], timeout=self.settle_timeout)
+			if pending:
+				self.stuck = True
+			else:
+				# usually MeasurementCancelled, the error of the point is reported by the caller
+				self.busy.exception()
+		if not self.stuck:
+			off = loop.run_in_executor(self.executor, self.FG.off)
+			done, pending = await asyncio.wait([off], timeout=self.settle_timeout)
+			if pending:
+				self.stuck = True
+			else:
+				off.result()
+		if self.stuck:
+			print('... %s: not stopped within %g s, station not used any more' % (self.name, self.settle_timeout))
+		return not self.stuck
+
+	def close(self):
+		self.executor.shutdown(wait=not self.stuck)
+		self.SCOPE.close()
+
+def connect_station(name, ip, gpib_channel, rm=None):
+	"""
+	Station of a DS1054Z at ip and a HP33120A at gpib_channel
+	"""
+	from HESMCtrl.DS1054ZCtrl import DS1054Z
+	from HESMCtrl.HP33120ACtrl import HP33120A
+	FG = HP33120A()
+	FG.connect_to_instrument(int(gpib_channel), rm=rm)
+	return Station(name, FG, DS1054Z(ip))
+
+def measure_point(station, ms, point, save=None):
+	"""
+	blocking measurement and evaluation of one campaign point on a station
+	save(data, result, msp, filename) = optional output (e.g. save_all),
+	the measurement stops between two acquisitions when station.cancel_event is set,
+	returns the journal entry
+	"""
+	from time import perf_counter
+	from HESMCtrl.Measurement import measure_hysteresis, get_date_time, sample_settings, sample_filename
+	from HESMCtrl.Evaluation import calculate_hysteresis_samples
+	from HESMCtrl.Campaign import point_key, point_settings
+
+	t_start = perf_counter()
+	msp = point_settings(ms, point)
+	date_time = get_date_time()
+	filename = sample_filename(date_time, msp, 'CHAN2', point['repeat'])
+	data = measure_hysteresis(filename, msp, FG=station.FG, SCOPE=station.SCOPE, cancel=station.cancel_event)
+	samples = calculate_hysteresis_samples(data, msp, filename, verbose=False, periods=msp.get('periods', False))
+	if save is not None:
+		for channel, (sample, result) in samples.items():
+			save(sample, result, sample_settings(msp, channel), sample_filename(date_time, msp, channel, point['repeat']))
+	result = samples['CHAN2'][1]
+	entry = {'key':point_key(point), 'filename':filename, 'station':station.name,
+			 'PR':float(result['PR']), 'EC':float(result['EC']), 'seconds':perf_counter() - t_start}
+	if len(samples) > 1:
+		entry['samples'] = dict((channel, {'PR':float(result['PR']), 'EC':float(result['EC'])})
+								for channel, (sample, result) in samples.items())
+	return entry
+
+class Orchestrator():
+	"""
+	measures campaign points on all stations, each point on the next free station
+	- timeout = max. time of one point (s), None = no limit
+	  a timed out point is given to the queue again (up to retries times)
+	- cancel(name) = stop a station (its current point is given to the others, 
+	  without other stations it is in failed),
+	  cancelling run() stops all stations and is raised after they have settled
+	- journal = file of the finished points (see Campaign.read_journal)
+	- save(data, result, msp, filename) is serialized in one thread (pyplot is not thread safe)
+	>>> results = asyncio.run(Orchestrator(stations, ms).run(points))
+	"""
+	def __init__(self, stations, ms, timeout=None, retries=1, journal=None, save=None):
+		from concurrent.futures import ThreadPoolExecutor
+		self.stations = dict((station.name, station) for station in stations)
+		self.ms = ms
+		self.timeout = timeout
+		self.retries = retries
+		self.journal = journal
+		self.save = save
+		self.saver = ThreadPoolExecutor(1, thread_name_prefix='save')
+		self.results = []
+		self.failed = []			# (key, station name or None, error) of the points not measured
+		self.cancelled = set()
+		self.active = set()
+
+	def _save(self, data, result, msp, filename):
+		self.saver.submit(self.save, data, result, msp, filename).result()
+
+	def cancel(self, name):
+		"""
+		stop station name after (or during) its current point
+		"""
+		self.cancelled.add(name)
+		task = self.stations[name].task
+		if task is not None:
+			task.cancel()
+
+	async def _worker(self, station, queue):
+		"""
+		measures the points of the queue on station until the sentinel (None) comes,
+		a cancelled or stuck station gives its point back and leaves
+		"""
+		from HESMCtrl.Campaign import append_journal, point_key
+		save = None if self.save is None else self._save
+		try:
+			while station.name not in self.cancelled and not station.stuck:
+				item = await queue.get()
+				if item is None:
+					queue.task_done()
+					return
+				point, attempt = item
+				if station.name in self.cancelled:
+					# cancelled while waiting
+					queue.put_nowait(item)
+					queue.task_done()
+					break
+				station.task = asyncio.ensure_future(asyncio.wait_for(
+					station.run(measure_point, station, self.ms, point, save), self.timeout))
+				try:
+					entry = await station.task
+				except asyncio.CancelledError:
+					await station.settle()
+					queue.put_nowait((point, attempt))
+					if station.name in self.cancelled:
+						# station cancelled, another station measures the point
+						break
+					# the orchestrator itself is cancelled
+					raise
+				except Exception as err:
+					await station.settle()
+					if attempt < self.retries:
+						queue.put_nowait((point, attempt+1))
+					else:
+						self.failed.append((point_key(point), station.name, repr(err)))
+					print('... %s: point %s failed: %r' % (station.name, point_key(point), err))
+					continue
+				finally:
+					station.task = None
+					queue.task_done()
+				station.measured += 1
+				self.results.append(entry)
+				if self.journal is not None:
+					append_journal(self.journal, entry)
+		except asyncio.CancelledError:
+			raise
+		except Exception:
+			self._leave(station, queue)
+			raise
+		self._leave(station, queue)
+	
+	def _leave(self, station, queue):
+		"""
+		station does not take points any more, 
+		without stations left the points of the queue fail
+		"""
+		self.active.discard(station.name)
+		if not self.active:
+			self._drain(queue)
+	
+	def _drain(self, queue):
+		from HESMCtrl.Campaign import point_key
+		while not queue.empty():
+			item = queue.get_nowait()
+			queue.task_done()
+			if item is not None:
+				self.failed.append((point_key(item[0]), None, 'no station left (cancelled or stuck)'))
+
+	async def run(self, points):
+		"""
+		measure all points, returns the journal entries
+		(points nobody could measure are in failed)
+		"""
+		from time import perf_counter
+		queue = asyncio.Queue()
+		for point in points:
+			queue.put_nowait((point, 0))
+		t_start = perf_counter()
+		stations = [station for station in self.stations.values() if station.name not in self.cancelled and not station.stuck]
+		self.active = set(station.name for station in stations)
+		if not stations:
+			self._drain(queue)
+		workers = [asyncio.ensure_future(self._worker(station, queue)) for station in stations]
+		try:
+			# the workers keep waiting for points given back by the others until all are done
+			await queue.join()
+		except asyncio.CancelledError:
+			for worker in workers:
+				worker.cancel()
+			await asyncio.gather(*workers, return_exceptions=True)
+			raise
+		for worker in workers:
+			queue.put_nowait(None)
+		await asyncio.gather(*workers)
+		elapsed = perf_counter() - t_start
+		print('... %i points on %i stations in %.1f s (%.1f measurements/h)' % (len(self.results),
+			  len(self.stations), elapsed, len(self.results)/elapsed*3600 if elapsed else 0))
+		for station in self.stations.values():
+			print('...   %s: %i points' % (station.name, station.measured))
+		if self.failed:
+			print('... %i points failed or not measured' % len(self.failed))
+		return self.results
+
+def run_campaign_parallel(cs, ms, stations, timeout=None, save=None):
+	"""
+	measures the points of the campaign cs (see Campaign.get_campaign_settings),
+	which are not in its journal yet, on all stations
+	"""
+	from HESMCtrl.Campaign import campaign_points, read_journal, point_key
+	done = read_journal(cs['journal'])
+	points = [point for point in campaign_points(cs, ms) if point_key(point) not in done]
+	orchestrator = Orchestrator(stations, ms, timeout=timeout, journal=cs['journal'], save=save)
+	return asyncio.run(orchestrator.run(points))
@@ -0,0 +1,879 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Local stand-ins for the measurement instruments (offline runs and benchmarks)
+"""
+
+import re
+import socket
+import socketserver
+import threading
+import time
+from collections import deque
+
+import vxi11
+
+from HESMCtrl.DS1054ZCtrl import DS1054Z, SocketTransport
+
+def scpi_short_form(node):
+	"""
+	returns the short form of a SCPI mnemonic, e.g.
+	WAVeform -> WAV, PREamble -> PRE, SOURce -> SOUR, CHANnel2 -> CHAN2
+	"""
+	match = re.match(r'^([A-Za-z*]+)(\d*)$', node)
+	if match is None:
+		return node.upper()
+	letters, number = match.group(1).upper(), match.group(2)
+	if len(letters) > 4:
+		letters = letters[:4]
+		if letters[3] in 'AEIOU':
+			letters = letters[:3]
+	return letters + number
+
+def ieee_block(data):
+	"""
+	packs bytes into a IEEE binary data block (#9<length><data>\\n)
+	"""
+	return b'#9' + ('%09d' % len(data)).encode('ascii') + bytes(data) + b'\n'
+
+class ScopeStandIn():
+	"""
+	SCPI command interpreter acting like a stopped RIGOL DS1054Z
+	with a fixed waveform memory (bytes) for every channel
+	- memory = {'CHAN1':bytes, ...}
+	- latency = time per round trip (s)
+	- bandwidth = transfer rate (bytes/s), 0 = unlimited
+	"""
+	IDN = 'RIGOL TECHNOLOGIES,DS1054Z,DS1ZA000000000,00.04.04.SP3'
+
+	def __init__(self, memory=None, latency=0.0, bandwidth=0):
+		if memory is None:
+			memory = {}
+		self.memory = memory
+		self.latency = latency
+		self.bandwidth = bandwidth
+		self.trigger_status = 'STOP'
+		self.settings = {'WAV:SOUR':'CHAN1', 'WAV:MODE':'NORM', 'WAV:FORM':'BYTE',
+						'WAV:STAR':'1', 'WAV:STOP':'1200', 'ACQ:MDEP':'AUTO',
+						'TIM:MAIN:SCAL':'1e-3', 'TIM:MAIN:OFFS':'0'}
+		self.commands = deque(maxlen=1000)
+		self.responses = []
+
+	def set_memory(self, channel, data):
+		self.memory[channel] = data
+
+	def channel_bytes(self, channel, screen):
+		"""
+		waveform bytes of a channel: 
+		screen = True -> screen content (1200 points), False -> deep memory
+		"""
+		data = self.memory.get(channel, b'')
+		if screen and len(data) > DS1054Z.SAMPLES_ON_DISPLAY:
+			# screen content = memory decimated to 1200 points
+			step = len(data) // DS1054Z.SAMPLES_ON_DISPLAY
+			data = data[:step*DS1054Z.SAMPLES_ON_DISPLAY:step]
+		return data
+
+	def y_scaling(self, channel):
+		"""
+		(yinc, yorig, yref) of a channel
+		"""
+		return 4e-2, -75, 127
+
+	def current_bytes(self):
+		"""
+		waveform bytes of the current waveform source and mode
+		"""
+		return self.channel_bytes(self.settings['WAV:SOUR'], self.settings['WAV:MODE'].startswith('NOR'))
+
+	def preamble(self):
+		pnts = len(self.current_bytes())
+		xinc = float(self.settings['TIM:MAIN:SCAL']) * DS1054Z.H_GRID / max(pnts, DS1054Z.SAMPLES_ON_DISPLAY)
+		xorig = float(self.settings['TIM:MAIN:OFFS']) - float(self.settings['TIM:MAIN:SCAL']) * DS1054Z.H_GRID / 2
+		typ = {'NOR':0, 'MAX':1, 'RAW':2}[self.settings['WAV:MODE'][:3]]
+		yinc, yorig, yref = self.y_scaling(self.settings['WAV:SOUR'])
+		return '0,%d,%d,1,%e,%e,0,%e,%d,%d' % (typ, pnts, xinc, xorig, yinc, yorig, yref)
+
+	def waveform_data(self):
+		data = self.current_bytes()
+		start = int(self.settings['WAV:STAR'])
+		stop = int(self.settings['WAV:STOP'])
+		return ieee_block(memoryview(data)[start-1:stop])
+
+	def query(self, header, argument):
+		"""
+		answer of a single query (header in short form without '?')
+		"""
+		if header == '*IDN':
+			return self.IDN
+		elif header == 'WAV:PRE':
+			return self.preamble()
+		elif header == 'WAV:DATA':
+			return self.waveform_data()
+		elif header == 'TRIG:STAT':
+			return self.trigger_status
+		return self.settings.get(header, '0')
+
+	def command(self, header, argument):
+		"""
+		execute a single command (header in short form)
+		"""
+		if header == 'RUN':
+			self.trigger_status = 'RUN'
+		elif header == 'STOP':
+			self.trigger_status = 'STOP'
+		elif header == 'SING':
+			self.trigger_status = 'WAIT'
+		elif header == 'TFOR':
+			if self.trigger_status == 'WAIT':
+				self.trigger_status = 'STOP'
+		else:
+			self.settings[header] = argument
+
+	def handle(self, message):
+		"""
+		interprets a message (several commands joined by ';' allowed)
+		and queues the answers of the contained queries
+		"""
+		if isinstance(message, (bytes, bytearray)):
+			message = message.decode('utf-8')
+		self.commands.append(message)
+		answers = []
+		for part in message.strip().split(';'):
+			part = part.strip()
+			if not part:
+				continue
+			header, _, argument = part.partition(' ')
+			is_query = header.endswith('?')
+			nodes = header.rstrip('?').lstrip(':').split(':')
+			header = ':'.join(scpi_short_form(node) for node in nodes)
+			if is_query:
+				answer = self.query(header, argument.strip())
+				if not isinstance(answer, bytes):
+					answer = str(answer).encode('utf-8')
+				answers.append(answer)
+			else:
+				self.command(header, argument.strip())
+		if answers:
+			if answers[-1].startswith(b'#'):
+				self.responses.append(b';'.join(answers))
+			else:
+				self.responses.append(b';'.join(answers) + b'\n')
+
+	def respond(self):
+		"""
+		returns the next queued answer (waiting for latency and bandwidth)
+		"""
+		answer = self.responses.pop(0) if self.responses else b''
+		delay = self.latency
+		if self.bandwidth:
+			delay += len(answer) / float(self.bandwidth)
+		if delay:
+			time.sleep(delay)
+		return answer
+
+class StandInLink(vxi11.Instrument):
+	"""
+	Replaces the VXI-11 link below DS1054Z by a ScopeStandIn in the same process,
+	use it via StandInDS1054Z
+	"""
+	def __init__(self, host, *args, **kwargs):
+		self.engine = kwargs.pop('engine', None) or ScopeStandIn()
+		super(StandInLink, self).__init__(host, *args, **kwargs)
+
+	def write_raw(self, data):
+		self.engine.handle(data)
+
+	def read_raw(self, num=-1):
+		return self.engine.respond()
+
+	def clear(self):
+		del self.engine.responses[:]
+
+class StandInDS1054Z(DS1054Z, StandInLink):
+	"""
+	DS1054Z driver talking to a ScopeStandIn instead of a scope
+	>>> scope = StandInDS1054Z('localhost', engine=ScopeStandIn({'CHAN1':data}))
+	"""
+	pass
+
+class _ScpiRequestHandler(socketserver.StreamRequestHandler):
+	"""
+	passes every received line to the engine and sends back its answers
+	"""
+	def handle(self):
+		self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		engine = self.server.engine
+		for line in self.rfile:
+			with self.server.lock:
+				engine.handle(line)
+				while engine.responses:
+					self.wfile.write(engine.respond())
+
+class _Vxi11RequestHandler(socketserver.BaseRequestHandler):
+	"""
+	answers the ONC-RPC calls of the VXI-11 core channel 
+	(create/destroy link, device write/read/clear) with the engine of the server
+	"""
+	def handle(self):
+		from vxi11 import rpc
+		from vxi11.vxi11 import (Packer, Unpacker, CREATE_LINK, DESTROY_LINK, DEVICE_WRITE, DEVICE_READ,
+								 DEVICE_CLEAR, OP_FLAG_END, RX_END, ERR_IO_TIMEOUT, ERR_OPERATION_NOT_SUPPORTED)
+		self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		engine = self.server.engine
+		packer, unpacker = Packer(), Unpacker(b'')
+		received = b''
+		pending, position = b'', 0
+		while True:
+			try:
+				call = rpc.recvrecord(self.request)
+			except (EOFError, OSError):
+				return
+			unpacker.reset(call)
+			xid, prog, vers, proc, cred, verf = unpacker.unpack_callheader()
+			packer.reset()
+			packer.pack_replyheader(xid, verf)
+			if proc == CREATE_LINK:
+				unpacker.unpack_create_link_parms()
+				packer.pack_create_link_resp((0, 1, 0, self.server.max_recv_size))
+			elif proc == DEVICE_WRITE:
+				link, timeout, lock_timeout, flags, data = unpacker.unpack_device_write_parms()
+				received += data
+				if flags & OP_FLAG_END:
+					with self.server.lock:
+						engine.handle(received)
+						answers = [pending[position:]]
+						while engine.responses:
+							answers.append(engine.respond())
+					received = b''
+					pending, position = b''.join(answers), 0
+				packer.pack_device_write_resp((0, len(data)))
+			elif proc == DEVICE_READ:
+				link, request_size, timeout, lock_timeout, flags, term_char = unpacker.unpack_device_read_parms()
+				if position >= len(pending):
+					packer.pack_device_read_resp((ERR_IO_TIMEOUT, 0, b''))
+				else:
+					data = pending[position:position+request_size]
+					position += len(data)
+					packer.pack_device_read_resp((0, RX_END if position >= len(pending) else 0, data))
+			elif proc == DEVICE_CLEAR:
+				unpacker.unpack_device_generic_parms()
+				received = b''
+				pending, position = b'', 0
+				packer.pack_device_error(0)
+			elif proc == DESTROY_LINK:
+				unpacker.unpack_device_link()
+				packer.pack_device_error(0)
+			else:
+				packer.pack_device_error(ERR_OPERATION_NOT_SUPPORTED)
+			rpc.sendrecord(self.request, packer.get_buf())
+
+class ScpiSocketServer(socketserver.ThreadingTCPServer):
+	"""
+	serves a ScopeStandIn as raw SCPI over TCP on localhost (like port 5555 of the DS1000Z)
+	>>> server = ScpiSocketServer(ScopeStandIn()).start()
+	>>> scope = DS1054Z('127.0.0.1', transport=SocketTransport('127.0.0.1', server.port))
+	>>> server.stop()
+	"""
+	allow_reuse_address = True
+	daemon_threads = True
+	handler = _ScpiRequestHandler
+
+	def __init__(self, engine=None, host='127.0.0.1', port=0):
+		socketserver.ThreadingTCPServer.__init__(self, (host, port), self.handler)
+		self.engine = engine or ScopeStandIn()
+		self.lock = threading.Lock()
+		self.thread = None
+
+	@property
+	def port(self):
+		return self.server_address[1]
+
+	def start(self):
+		self.thread = threading.Thread(target=self.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+		self.thread.join()
+
+class Vxi11Server(ScpiSocketServer):
+	"""
+	serves a ScopeStandIn over VXI-11 (core channel only, no portmapper) on localhost,
+	connect to it with Vxi11ServerDS1054Z
+	"""
+	handler = _Vxi11RequestHandler
+	max_recv_size = 1024*1024
+
+class Vxi11ServerDS1054Z(DS1054Z):
+	"""
+	DS1054Z driver using its VXI-11 link to a local Vxi11Server,
+	the server is stopped when close() is called
+	>>> scope = Vxi11ServerDS1054Z(Vxi11Server(ScopeStandIn()).start())
+	"""
+	def __init__(self, server, *args, **kwargs):
+		self.server = server
+		DS1054Z.__init__(self, '127.0.0.1', *args, **kwargs)
+
+	def open(self):
+		# the port is known, the portmapper is not asked
+		if self.client is None:
+			self.client = vxi11.vxi11.CoreClient(self.host, self.server.port)
+		DS1054Z.open(self)
+
+	def close(self):
+		DS1054Z.close(self)
+		if self.server is not None:
+			self.server.stop()
+			self.server = None
+
+class SimulatedHP33120A():
+	"""
+	VISA-like resource (write/ask/query/read) acting like a HP33120A
+	function generator, the output settings are kept in the dict state
+	- latency = time per GPIB transaction (s)
+	"""
+	IDN = 'HEWLETT-PACKARD,33120A,0,8.0-5.0-1.0'
+	DEFAULTS = {'shape':'SIN', 'frequency':1e3, 'amplitude':0.1, 'offset':0.0}
+
+	def __init__(self, latency=0.0):
+		self.latency = latency
+		self.commands = deque(maxlen=1000)
+		self.errors = []
+		self.answer = ''
+		self.reset()
+
+	def reset(self):
+		self.state = dict(self.DEFAULTS)
+		self.state.update({'burst_count':1, 'burst_status':'OFF', 'trigger_source':'IMM'})
+
+	def _value(self, argument, key):
+		argument = argument.strip()
+		if argument.upper().startswith('DEF'):
+			return self.DEFAULTS[key]
+		return float(argument)
+
+	def _apply(self, shape, argument):
+		"""
+		APPLy:<shape> [freq [,amp [,offs]]] - burst modulation is switched off
+		"""
+		values = [value for value in argument.split(',') if value.strip()]
+		self.state['shape'] = shape
+		for key, value in zip(('frequency', 'amplitude', 'offset'), values):
+			self.state[key] = self._value(value, key)
+		self.state['burst_status'] = 'OFF'
+
+	def _handle(self, message):
+		time.sleep(self.latency)
+		self.commands.append(message)
+		header, _, argument = message.strip().partition(' ')
+		is_query = header.endswith('?')
+		header = ':'.join(scpi_short_form(node) for node in header.rstrip('?').lstrip(':').split(':'))
+		if header.startswith('SOUR:'):
+			header = header[5:]
+		keys = {'FUNC:SHAP':'shape', 'FREQ':'frequency', 'VOLT':'amplitude', 'VOLT:OFFS':'offset',
+				'BM:NCYC':'burst_count', 'BM:STAT':'burst_status', 'TRIG:SOUR':'trigger_source'}
+		if is_query:
+			if header == '*IDN':
+				return self.IDN
+			elif header in ('SYST:ERR', 'SYS:ERR'):
+				return self.errors.pop(0) if self.errors else '+0,"No error"'
+			elif header in keys:
+				value = self.state[keys[header]]
+				return value if isinstance(value, str) else '%+.8E' % value
+		elif header == '*RST':
+			self.reset()
+			return None
+		elif header == '*TRG':
+			return None
+		elif header.startswith('APPL:'):
+			self._apply(header[5:], argument)
+			return None
+		elif header in keys:
+			key = keys[header]
+			if key in ('shape', 'burst_status', 'trigger_source'):
+				self.state[key] = scpi_short_form(argument.strip())
+			else:
+				self.state[key] = self._value(argument, key)
+			return None
+		self.errors.append('-113,"Undefined header"')
+		return ''
+
+	def write(self, message):
+		self._handle(message)
+
+	def read(self):
+		answer, self.answer = self.answer, ''
+		return answer
+
+	def query(self, message):
+		answer = self._handle(message)
+		return '' if answer is None else answer + '\n'
+
+	ask = query
+
+	def output(self, t):
+		"""
+		generator output voltage at the times t (s, numpy array)
+		triangle/sine/square starting rising through the offset at t = 0
+		"""
+		from numpy import arcsin, sin, sign, pi, zeros_like
+		state = self.state
+		phase = 2*pi*state['frequency']*t
+		if state['shape'] == 'TRI':
+			wave = 2/pi * arcsin(sin(phase))
+		elif state['shape'] == 'SIN':
+			wave = sin(phase)
+		elif state['shape'] == 'SQU':
+			wave = sign(sin(phase))
+		else:
+			wave = zeros_like(t)
+		return state['offset'] + state['amplitude']/2. * wave
+
+class SimulatedResourceManager():
+	"""
+	stands in for visa.ResourceManager, resources = {address: resource}
+	>>> FG.connect_to_instrument(22, rm=SimulatedResourceManager({'GPIB0::22::INSTR':SimulatedHP33120A()}))
+	"""
+	def __init__(self, resources=None):
+		self.resources = resources or {}
+
+	def list_resources(self):
+		return tuple(self.resources.keys())
+
+	def open_resource(self, address):
+		try:
+			return self.resources[address]
+		except KeyError:
+			raise ValueError('no simulated resource at %s' % address)
+
+class FerroelectricSample():
+	"""
+	ferroelectric capacitor with tanh shaped hysteresis branches
+	- Ps, Pr = saturation and remanent polarization (C/m2)
+	- Ec = coercive field (V per thickness unit, as E in Evaluation)
+	- area, thickness = electrode area (m2) and sample thickness (as in the settings file)
+	- cap = linear (dielectric) capacitance (F)
+	- leakage = parallel resistance (Ohm), 0 = no leakage
+	"""
+	def __init__(self, Ps=0.30, Pr=0.25, Ec=400., area=1.86e-4, thickness=532e-3, cap=2e-10, leakage=0):
+		from numpy import arctanh
+		self.Ps = Ps
+		self.Pr = Pr
+		self.Ec = Ec
+		self.area = area
+		self.thickness = thickness
+		self.cap = cap
+		self.leakage = leakage
+		self.width = Ec / arctanh(Pr / Ps)
+
+	def polarization(self, E, rising):
+		"""
+		polarization on the rising (rising = True) or falling branch
+		"""
+		from numpy import tanh, where
+		return self.Ps * tanh((E - where(rising, self.Ec, -self.Ec)) / self.width)
+
+	def current(self, t, V):
+		"""
+		current through the sample (A) for the voltages V at the times t
+		"""
+		from numpy import gradient
+		dVdt = gradient(V, t)
+		P = self.polarization(V / self.thickness, dVdt >= 0)
+		current = self.area * gradient(P, t) + self.cap * dVdt
+		if self.leakage:
+			current = current + V / self.leakage
+		return current
+
+class ScopeSimulator(ScopeStandIn):
+	"""
+	SCPI interpreter acting like a DS1054Z measuring a hysteresis setup:
+	- CHAN1 = generator output (Vset before the amplifier)
+	- samples = {'CHAN2':(FerroelectricSample, Rref), ...} = voltage over the shunt
+	  of every sample, driven by the generator output times ampfactor
+	- noise = gaussian noise of every channel (V)
+	- trigger_jitter = std. deviation of the trigger position of :TFORce (s)
+	- time_scale = wall time of an acquisition relative to the screen time (0 = instant)
+	a single acquisition is triggered by :TFORce or by the generator signal (any shape but DC),
+	a running scope without it reports WAIT,
+	single / forced acquisitions take the generator state at the trigger,
+	running acquisitions the state at the time they are read
+	"""
+	AUTO_MEMORY_DEPTH = 12000
+
+	def __init__(self, generator, samples=None, ampfactor=1.0, noise=1e-3, trigger_jitter=0.0,
+				 time_scale=1.0, latency=0.0, bandwidth=0, seed=None):
+		from numpy.random import default_rng
+		ScopeStandIn.__init__(self, latency=latency, bandwidth=bandwidth)
+		self.generator = generator
+		if samples is None:
+			samples = {'CHAN2':(FerroelectricSample(), 150e3)}
+		self.samples = samples
+		self.ampfactor = ampfactor
+		self.noise = noise
+		self.trigger_jitter = trigger_jitter
+		self.time_scale = time_scale
+		self.rng = default_rng(seed)
+		for channel in ('CHAN1', 'CHAN2', 'CHAN3', 'CHAN4'):
+			self.settings.update({channel+':SCAL':'1', channel+':OFFS':'0', channel+':PROB':'1',
+								  channel+':DISP':'1' if channel in ('CHAN1', 'CHAN2') else '0'})
+		self.t_trigger = None
+		self.acquisition = None
+
+	def screen_time(self):
+		return float(self.settings['TIM:MAIN:SCAL']) * DS1054Z.H_GRID
+
+	def memory_depth(self):
+		mdep = self.settings['ACQ:MDEP']
+		return self.AUTO_MEMORY_DEPTH if mdep == 'AUTO' else int(float(mdep))
+
+	def _trigger(self):
+		self.t_trigger = time.perf_counter()
+		self.acquisition = {'generator':dict(self.generator.state), 'shift':self.rng.normal(0, self.trigger_jitter) if self.trigger_jitter else 0.0}
+
+	def command(self, header, argument):
+		if header in ('RUN', 'SING'):
+			self.trigger_status = 'RUN' if header == 'RUN' else 'WAIT'
+			self.acquisition = None
+		elif header == 'TFOR':
+			if self.trigger_status == 'WAIT':
+				self.trigger_status = 'TD'
+				self._trigger()
+		elif header == 'STOP':
+			if self.trigger_status in ('RUN', 'TD') and self.acquisition is None:
+				self._trigger()
+			self.trigger_status = 'STOP'
+		else:
+			ScopeStandIn.command(self, header, argument)
+			if self.acquisition is not None:
+				if header.startswith('CHAN'):
+					# stopped data is shown with the new vertical settings
+					self.acquisition['bytes'] = {}
+				elif (header.startswith('TIM') or header.startswith('ACQ')) and self.trigger_status != 'STOP':
+					self.acquisition = None
+
+	def query(self, header, argument):
+		if header == 'TRIG:STAT':
+			if self.trigger_status == 'WAIT' and self.generator.state['shape'] != 'DC':
+				# edge trigger on the generator signal
+				self.trigger_status = 'TD'
+				self._trigger()
+			if self.trigger_status == 'TD' and time.perf_counter() - self.t_trigger >= self.screen_time()*self.time_scale:
+				self.trigger_status = 'STOP'
+			if self.trigger_status == 'RUN' and self.generator.state['shape'] == 'DC':
+				# running without a trigger signal
+				return 'WAIT'
+			return self.trigger_status
+		elif header == 'ACQ:SRAT':
+			return '%e' % (self.memory_depth() / self.screen_time())
+		return ScopeStandIn.query(self, header, argument)
+
+	def y_scaling(self, channel):
+		yinc = float(self.settings.get(channel+':SCAL', '1')) / 25.
+		yorig = int(round(float(self.settings.get(channel+':OFFS', '0')) / yinc))
+		return yinc, yorig, 127
+
+	def _acquire(self):
+		"""
+		synthesizes the voltages of all channels for the current acquisition
+		"""
+		from numpy import arange
+		if self.trigger_status == 'RUN' and (self.acquisition is None or 
+				time.perf_counter() - self.t_trigger >= self.screen_time()*self.time_scale):
+			self._trigger()
+		if self.acquisition is None:
+			self._trigger()
+		acquisition = self.acquisition
+		if 'volts' not in acquisition:
+			generator = SimulatedHP33120A()
+			generator.state = acquisition['generator']
+			pnts = self.memory_depth()
+			xinc = self.screen_time() / pnts
+			xorig = float(self.settings['TIM:MAIN:OFFS']) - self.screen_time()/2
+			# one period ahead of the screen to settle the derivatives
+			period = 1. / generator.state['frequency']
+			n_ahead = int(period / xinc) + 1
+			t = xorig + xinc * arange(-n_ahead, pnts) + acquisition['shift']
+			vset = generator.output(t)
+			volts = {'CHAN1':vset}
+			for channel, (sample, rref) in self.samples.items():
+				volts[channel] = sample.current(t, vset * self.ampfactor) * rref
+			for channel in volts:
+				volts[channel] = volts[channel][n_ahead:]
+				if self.noise:
+					volts[channel] = volts[channel] + self.rng.normal(0, self.noise, pnts)
+			acquisition['volts'] = volts
+		if 'bytes' not in acquisition:
+			acquisition['bytes'] = {}
+		return acquisition
+
+	def channel_bytes(self, channel, screen):
+		from numpy import rint, clip, uint8, zeros
+		acquisition = self._acquire()
+		key = (channel, screen)
+		if key not in acquisition['bytes']:
+			volts = acquisition['volts'].get(channel)
+			if volts is None:
+				volts = zeros(self.memory_depth())
+			if screen:
+				step = max(1, len(volts) // DS1054Z.SAMPLES_ON_DISPLAY)
+				volts = volts[:step*DS1054Z.SAMPLES_ON_DISPLAY:step]
+			yinc, yorig, yref = self.y_scaling(channel)
+			acquisition['bytes'][key] = clip(rint(volts / yinc + yorig + yref), 0, 255).astype(uint8).tobytes()
+		return acquisition['bytes'][key]
+
+def connect_simulated_instruments(ms=None, sample=None, latency=0.0, time_scale=1.0, noise=1e-3,
+								  trigger_jitter=0.0, transport=None, seed=None):
+	"""
+	returns (FG, SCOPE) = HP33120A and DS1054Z drivers connected to simulated instruments
+	- ms = measurement settings (dict) for area, thickness, Rref and amplification
+	- sample = FerroelectricSample (default: built from ms), 
+	  the additional samples of ms (CHAN3/CHAN4) are built from their settings
+	- latency = link latency of both instruments (s)
+	- transport = None (in-process link), 'socket' (local ScpiSocketServer) 
+	  or 'vxi11' (local Vxi11Server), the server is stopped when SCOPE.close() is called
+	"""
+	from HESMCtrl.HP33120ACtrl import HP33120A
+
+	if ms is None:
+		ms = {}
+	if sample is None:
+		sample = FerroelectricSample(area=ms.get('area', 1.86e-4), thickness=ms.get('thickness', 532e-3))
+	generator = SimulatedHP33120A(latency=latency)
+	FG = HP33120A()
+	FG.connect_to_instrument(22, rm=SimulatedResourceManager({'GPIB0::22::INSTR':generator}))
+	samples = {'CHAN2':(sample, ms.get('rref', 150e3))}
+	for channel, settings in ms.get('samples', {}).items():
+		settings = dict(ms, **settings)
+		samples[channel] = (FerroelectricSample(area=settings.get('area', 1.86e-4), thickness=settings.get('thickness', 532e-3)),
+							settings.get('rref', 150e3))
+	engine = ScopeSimulator(generator, samples=samples,
+							ampfactor=ms.get('ampfactor', 1.0), noise=noise, trigger_jitter=trigger_jitter,
+							time_scale=time_scale, latency=latency, seed=seed)
+	if transport == 'socket':
+		server = ScpiSocketServer(engine).start()
+		SCOPE = DS1054Z('127.0.0.1', transport=_ServerSocketTransport(server))
+	elif transport == 'vxi11':
+		SCOPE = Vxi11ServerDS1054Z(Vxi11Server(engine).start())
+	else:
+		SCOPE = StandInDS1054Z('localhost', engine=engine)
+	return FG, SCOPE
+
+class _ServerSocketTransport(SocketTransport):
+	"""
+	SocketTransport to a local ScpiSocketServer, stopping the server on close()
+	"""
+	def __init__(self, server):
+		SocketTransport.__init__(self, '127.0.0.1', server.port)
+		self.server = server
+
+	def close(self):
+		SocketTransport.close(self)
+		if self.server is not None:
+			self.server.stop()
+			self.server = None
+
+def _concatenating_readout(scope, channel, mode='RAW'):
+	"""
+	deep memory readout as done before ChunkedReadout
+	(bytes concatenation of 250 kB chunks), reference for benchmark_readout
+	"""
+	scope.write(":WAVeform:SOURce " + channel)
+	scope.write(":WAVeform:FORMat BYTE")
+	scope.write(":WAVeform:MODE " + mode)
+	pnts = scope.waveform_preamble_dict['pnts']
+	buff = b""
+	max_byte_len = 250000
+	pos = 1
+	while len(buff) < pnts:
+		scope.write(":WAVeform:STARt {0}".format(pos))
+		end_pos = min(pnts, pos+max_byte_len-1)
+		scope.write(":WAVeform:STOP {0}".format(end_pos))
+		tmp_buff = scope.query_raw(":WAVeform:DATA?")
+		buff += DS1054Z.decode_ieee_block(tmp_buff)
+		pos += max_byte_len
+	return buff
+
+def benchmark_readout(memory_depth=24000000, latency=0.0, bandwidth=0, repeats=1):
+	"""
+	compares the deep memory readout of the former concatenating loop
+	with ChunkedReadout against a ScopeStandIn
+	(transfer rate in MB/s and peak of allocated memory in MB)
+	"""
+	import tracemalloc
+
+	pattern = bytes(bytearray(range(256)))
+	data = (pattern * (memory_depth // len(pattern) + 1))[:memory_depth]
+	engine = ScopeStandIn({'CHAN1':data}, latency=latency, bandwidth=bandwidth)
+	scope = StandInDS1054Z('localhost', engine=engine)
+
+	readouts = [('concatenating loop', lambda: _concatenating_readout(scope, 'CHAN1')),
+				('ChunkedReadout', lambda: scope.get_waveform_bytes('CHAN1', mode='RAW'))]
+	results = {}
+	for name, readout in readouts:
+		durations = []
+		peak = 0
+		for i in range(repeats):
+			scope.invalidate_acquisition_state()
+			tracemalloc.start()
+			t_start = time.perf_counter()
+			buff = readout()
+			durations.append(time.perf_counter() - t_start)
+			peak = max(peak, tracemalloc.get_traced_memory()[1])
+			tracemalloc.stop()
+			assert bytes(buff) == data
+			del buff
+		duration = min(durations)
+		results[name] = {'seconds':duration, 'MB/s':memory_depth/duration/1e6, 'peak MB':peak/1e6}
+		print('%-20s %8.3f s %9.1f MB/s %9.1f MB peak' % (name, duration, memory_depth/duration/1e6, peak/1e6))
+	return results
+
+def benchmark_transports(host=None, n_queries=500, memory_depth=2400000):
+	"""
+	compares the SCPI transports of DS1054Z: 
+	mean query latency (*IDN?) and block throughput (RAW readout)
+	- host = None: VXI-11 and socket transport against a local Vxi11Server and
+	  ScpiSocketServer, the in-process stand-in is listed as reference without any link
+	- host = IP of a scope: VXI-11 and socket transport of the real scope
+	  (the scope will be stopped for the RAW readout!)
+	"""
+	server = None
+	if host is None:
+		pattern = bytes(bytearray(range(256)))
+		data = (pattern * (memory_depth // len(pattern) + 1))[:memory_depth]
+		engine = ScopeStandIn({'CHAN1':data})
+		server = ScpiSocketServer(engine).start()
+		scopes = [('in-process', lambda: StandInDS1054Z('localhost', engine=engine)),
+				  ('vxi11', lambda: Vxi11ServerDS1054Z(Vxi11Server(engine).start())),
+				  ('socket', lambda: DS1054Z('127.0.0.1', transport=SocketTransport('127.0.0.1', server.port)))]
+	else:
+		scopes = [('vxi11', lambda: DS1054Z(host)),
+				  ('socket', lambda: DS1054Z(host, transport='socket'))]
+	
+	results = {}
+	try:
+		for name, create_scope in scopes:
+			scope = create_scope()
+			t_start = time.perf_counter()
+			for i in range(n_queries):
+				scope.query('*IDN?')
+			latency = (time.perf_counter() - t_start) / n_queries
+			scope.invalidate_acquisition_state()
+			t_start = time.perf_counter()
+			buff = scope.get_waveform_bytes('CHAN1', mode='RAW')
+			duration = time.perf_counter() - t_start
+			scope.close()
+			results[name] = {'latency ms':latency*1e3, 'MB/s':len(buff)/duration/1e6}
+			print('%-12s %8.3f ms/query %9.1f MB/s' % (name, latency*1e3, len(buff)/duration/1e6))
+	finally:
+		if server is not None:
+			server.stop()
+	return results
+
+def benchmark_dead_time(ms, latency=0.0, time_scale=1.0, noise=1e-3):
+	"""
+	runs measure_hysteresis against simulated instruments and reports
+	the wall time, the instrument I/O time and the dead time 
+	(= wall time - time the scope needs to record the averaged screens,
+	scaled by time_scale like the simulated acquisitions)
+	ms = measurement settings (dict), e.g. from get_measurement_settings()
+	"""
+	from HESMCtrl.Measurement import measure_hysteresis
+	from HESMCtrl.Metrics import InstrumentMetrics
+
+	FG, SCOPE = connect_simulated_instruments(ms, latency=latency, time_scale=time_scale, noise=noise)
+	FG.metrics = InstrumentMetrics('HP33120A')
+	SCOPE.metrics = InstrumentMetrics('DS1054Z')
+	t_start = time.perf_counter()
+	data = measure_hysteresis('benchmark', ms, FG=FG, SCOPE=SCOPE)
+	wall_time = time.perf_counter() - t_start
+	SCOPE.close()
+	
+	screen_time = DS1054Z.H_GRID / ms['freq'] / 5 * time_scale
+	required = int(ms['average']) * screen_time
+	io_time = FG.metrics.summary()['io_seconds'] + SCOPE.metrics.summary()['io_seconds']
+	results = {'wall_s':wall_time, 'required_s':required, 'io_s':io_time, 'dead_s':wall_time - required}
+	print('wall time %.2f s, required %.2f s, instrument I/O %.3f s, dead time %.2f s' % (
+		  wall_time, required, io_time, wall_time - required))
+	return results, data
+
+def benchmark_stations(ms, n_stations=(1, 2, 4), points_per_station=2, latency=0.0, time_scale=1.0):
+	"""
+	measures points_per_station points on 1, 2, 4, ... simulated stations 
+	concurrently (see Orchestration) and reports the speedup against one station
+	"""
+	import asyncio
+	from HESMCtrl.Orchestration import Station, Orchestrator
+	from HESMCtrl.Campaign import point_key
+
+	results = {}
+	# first run without timing (imports, caches)
+	stations_run = False
+	for n in (1,) + tuple(n_stations):
+		stations = []
+		for i in range(n):
+			FG, SCOPE = connect_simulated_instruments(ms, latency=latency, time_scale=time_scale, seed=i)
+			stations.append(Station('station%i' % (i+1), FG, SCOPE))
+		points = [{'name':ms['name'], 'electrkey':ms['electrkey'], 'amp':ms['amp'], 'freq':ms['freq'], 'offs':ms['offs'], 
+				   'repeat':r+1} for r in range(n * points_per_station)]
+		t_start = time.perf_counter()
+		asyncio.run(Orchestrator(stations, ms).run(points))
+		seconds = time.perf_counter() - t_start
+		for station in stations:
+			station.close()
+		if stations_run:
+			results[n] = seconds
+		stations_run = True
+	for n, seconds in results.items():
+		print('%i stations: %i points in %.2f s, %.1f measurements/h, speedup %.2f (ideal %i)' % (
+			  n, n * points_per_station, seconds, n * points_per_station / seconds * 3600,
+			  n * results[n_stations[0]] / n_stations[0] / seconds, n))
+	return results
+
+def benchmark_cumulative_trapezoid(n_rows=(1, 100, 2000), n_samples=1200, repeats=5):
+	"""
+	cumulative_trapezoid vs. scipy.integrate.cumulative_trapezoid (cumtrapz in old SciPy)
+	on stacked random data (n_rows, n_samples): time per call and exact equality of the results
+	returns a list of dicts (rows, seconds numpy, seconds scipy, equal)
+	"""
+	from numpy import array_equal
+	from numpy.random import default_rng
+	from HESMCtrl.Evaluation import cumulative_trapezoid
+	try:
+		from scipy.integrate import cumulative_trapezoid as scipy_integrate
+	except ImportError:
+		from scipy.integrate import cumtrapz as scipy_integrate
+	
+	def best(func):
+		times = []
+		for i in range(repeats):
+			t_start = time.perf_counter()
+			result = func()
+			times.append(time.perf_counter() - t_start)
+		return min(times), result
+	
+	rng = default_rng(0)
+	results = []
+	for rows in n_rows:
+		y = rng.normal(size=(rows, n_samples))
+		x = (rng.uniform(0.5, 1.5, (rows, n_samples)) * 2e-5).cumsum(axis=1)
+		dx = rng.uniform(1e-5, 1e-4, (rows, 1))
+		out = y * 0.
+		cases = {'dx':(lambda: cumulative_trapezoid(y, dx=dx, axis=1, initial=0, out=out),
+					   lambda: scipy_integrate(y, dx=dx, axis=1, initial=0)),
+				 'x':(lambda: cumulative_trapezoid(y, x, axis=1, initial=0),
+					  lambda: scipy_integrate(y, x, axis=1, initial=0)),
+				 'no initial':(lambda: cumulative_trapezoid(y, dx=2e-5, axis=-1),
+							   lambda: scipy_integrate(y, dx=2e-5, axis=-1))}
+		for case, (numpy_func, scipy_func) in cases.items():
+			t_numpy, result = best(numpy_func)
+			t_scipy, expected = best(scipy_func)
+			equal = array_equal(result, expected)
+			results.append({'rows':rows, 'case':case, 'numpy_s':t_numpy, 'scipy_s':t_scipy, 'equal':equal})
+			print('... %5i x %i (%s): %8.3f ms  scipy %8.3f ms  %s' % (rows, n_samples, case, t_numpy*1e3, 
+				  t_scipy*1e3, 'identical' if equal else 'DIFFERENT'))
+	return results
@@ -8,9 +8,10 @@
 from HESMCtrl.Measurement import *
 from HESMCtrl.Evaluation import *
 from HESMCtrl.OSOperations import save_all
+from HESMCtrl.Campaign import get_campaign_settings, run_campaign, prompt_electrode
 
 import sys
-MODE = 'plot'  		# measure, plot
+MODE = 'plot'  		# measure, plot, campaign
 python_version = int(sys.version[0])
 
 if MODE == 'measure':
@@ -19,9 +20,15 @@ if MODE == 'measure':
 	filename = create_filename(date_time,ms)
 	
 	data = measure_hysteresis(filename,ms)
-	data, result = calculate_hysteresis(data,ms,filename)
 	
-	fig = plot_data(data,ms,filename)
+	# one evaluation per sample (CHAN2 + optional CHAN3/CHAN4)
+	samples = calculate_hysteresis_samples(data,ms,filename,periods=ms['periods'])
+	outputs = []
+	for channel, (sample, result) in samples.items():
+		msc = sample_settings(ms,channel)
+		samplename = sample_filename(date_time,ms,channel)
+		fig = plot_data(sample,msc,samplename,figname='Raw Data %s'%channel)
+		outputs.append((sample, result, fig, samplename))
 		
 	if python_version==2:
 		answer = raw_input('... Save? [y/n]')
@@ -29,10 +36,17 @@ if MODE == 'measure':
 		answer = input('... Save? [y/n]')
 	
 	if answer == 'y' or answer == 'yes':
-		save_all(data, result, fig, filename, mode=MODE)
+		for sample, result, fig, samplename in outputs:
+			save_all(sample, result, fig, samplename, mode=MODE)
 	else:
 		pass
 	
+elif MODE == 'campaign':
+	# sweep from campaign_settings.txt, other settings from meas_settings.txt
+	ms = get_measurement_settings()
+	cs = get_campaign_settings()
+	run_campaign(cs, ms, on_electrode=prompt_electrode if len(cs['electrkeys']) > 1 else None)
+	
 elif MODE == 'plot':
 	import pandas as pd
 	from glob import glob
@@ -45,7 +59,7 @@ elif MODE == 'plot':
 		data = pd.read_pickle(datafile)
 		filename = datafile.strip('_data.pd')
 	
-		data, result = calculate_hysteresis(data,ms,filename)
+		data, result = calculate_hysteresis(data,ms,filename,periods=ms['periods'])
 		fig = plot_data(data,ms,filename)
 		
 		save_all(data, result, fig, filename, mode=MODE)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+campaign runner against the simulated instruments (HESMCtrl.Simulation)
+"""
+
+import json
+import os
+import shutil
+
+import matplotlib
+matplotlib.use('Agg')
+import pytest
+
+import HESMCtrl.Measurement
+from HESMCtrl.Campaign import campaign_points, point_key, read_journal, append_journal, run_campaign
+from HESMCtrl.Measurement import get_measurement_settings
+from HESMCtrl.Simulation import connect_simulated_instruments
+
+SETTINGS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'meas_settings.txt')
+
+def campaign(tmp_path, **changes):
+	ms = get_measurement_settings(SETTINGS)
+	ms.update({'freq':10., 'average':1, 'scale_divider_CHAN1':1., 'rref':10., 'burst_status':False})
+	ms.update(changes)
+	cs = {'amps':[1.0, 2.0], 'freqs':[10.], 'repeats':2, 'electrkeys':['01', '02'],
+		  'journal':str(tmp_path / 'journal.txt')}
+	return cs, ms
+
+def test_point_keys_of_samples_differ(tmp_path):
+	cs, ms = campaign(tmp_path)
+	keys = [point_key(point) for point in campaign_points(cs, ms)]
+	assert len(set(keys)) == len(keys) == 8
+	other = [point_key(point) for point in campaign_points(cs, dict(ms, name='other'))]
+	assert not set(keys) & set(other)
+	# a finished point of one sample does not skip the other
+	append_journal(cs['journal'], {'key':keys[0]})
+	append_journal(cs['journal'], {'key':other[1], 'error':'ValueError()'})
+	assert list(read_journal(cs['journal'])) == [keys[0]]
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+	shutil.copy(SETTINGS, str(tmp_path))
+	os.mkdir(str(tmp_path / 'Data'))
+	monkeypatch.chdir(tmp_path)
+	monkeypatch.setattr('builtins.input', lambda *args: pytest.fail('campaign asked for input'))
+	return tmp_path
+
+def failing_measurement(failures):
+	"""
+	measure_hysteresis raising failures[n] at the n-th call (if any)
+	"""
+	measure = HESMCtrl.Measurement.measure_hysteresis
+	calls = []
+	def measure_hysteresis(*args, **kwargs):
+		calls.append(args[0])
+		if len(calls) in failures:
+			raise failures[len(calls)]
+		return measure(*args, **kwargs)
+	return measure_hysteresis
+
+def test_campaign_journals_failed_points(workdir, monkeypatch):
+	cs, ms = campaign(workdir, electrkey='01')
+	cs['electrkeys'] = []
+	monkeypatch.setattr(HESMCtrl.Measurement, 'measure_hysteresis', failing_measurement({2:ValueError('no loop')}))
+	FG, SCOPE = connect_simulated_instruments(ms, time_scale=0., seed=0)
+	entries = run_campaign(cs, ms, FG=FG, SCOPE=SCOPE)
+	assert len(entries) == 3
+	lines = [json.loads(line) for line in open(cs['journal'])]
+	failed = [entry for entry in lines if 'error' in entry]
+	assert len(failed) == 1 and 'ValueError' in failed[0]['traceback']
+	assert failed[0]['key'] not in read_journal(cs['journal'])
+	# resumed: only the failed point is measured again
+	monkeypatch.setattr(HESMCtrl.Measurement, 'measure_hysteresis', failing_measurement({}))
+	entries = run_campaign(cs, ms, FG=FG, SCOPE=SCOPE)
+	assert [entry['key'] for entry in entries] == [failed[0]['key']]
+	assert len(read_journal(cs['journal'])) == 4
+	SCOPE.close()
+
+def test_campaign_aborts_on_lost_link(workdir, monkeypatch):
+	cs, ms = campaign(workdir)
+	monkeypatch.setattr(HESMCtrl.Measurement, 'measure_hysteresis', failing_measurement({2:EOFError('link lost')}))
+	FG, SCOPE = connect_simulated_instruments(ms, time_scale=0., seed=0)
+	with pytest.raises(EOFError):
+		run_campaign(cs, ms, FG=FG, SCOPE=SCOPE)
+	lines = [json.loads(line) for line in open(cs['journal'])]
+	assert len(lines) == 2 and 'EOFError' in lines[1]['error']
+	SCOPE.close()
+
+def test_samples_without_electrkey_are_saved_apart(workdir):
+	from HESMCtrl.Orchestration import Station, measure_point
+	# the CHAN3 sample has the ElectrKey of the main sample
+	with open('meas_settings.txt', 'a') as settings:
+		settings.write('\nCHAN3.Rref:\t10\nCHAN3.Area:\t2e-4\n')
+	ms = get_measurement_settings('meas_settings.txt')
+	ms.update({'freq':10., 'average':1, 'scale_divider_CHAN1':1., 'rref':10., 'burst_status':False})
+	assert ms['vref_channels'] == ['CHAN2', 'CHAN3'] and 'electrkey' not in ms['samples']['CHAN3']
+	cs = {'amps':[1.0], 'freqs':[10.], 'repeats':1, 'electrkeys':[], 'journal':str(workdir / 'journal.txt')}
+	FG, SCOPE = connect_simulated_instruments(ms, time_scale=0., seed=0)
+	entries = run_campaign(cs, ms, FG=FG, SCOPE=SCOPE)
+	assert len(entries) == 1 and 'error' not in entries[0]
+	saved = sorted(os.listdir('Data'))
+	assert len(saved) == 2 and saved[1] == saved[0] + '_CHAN3'
+	for name in saved:
+		assert os.path.isfile(os.path.join('Data', name, name + '_data.txt'))
+	# the orchestrated measurement names the files the same way
+	names = []
+	point = campaign_points(cs, ms)[0]
+	entry = measure_point(Station('station1', FG, SCOPE), ms, point, save=lambda sample, result, msc, filename: names.append(filename))
+	SCOPE.close()
+	assert names == [entry['filename'], entry['filename'] + '_CHAN3']
+
+def test_cycle_periods_are_saved(workdir):
+	assert get_measurement_settings('meas_settings.txt')['periods'] is False
+	with open('meas_settings.txt', 'a') as settings:
+		settings.write('\nCyclePeriods:\tON\n')
+	ms = get_measurement_settings('meas_settings.txt')
+	assert ms['periods'] is True
+	ms.update({'freq':10., 'average':1, 'scale_divider_CHAN1':1., 'rref':10., 'burst_status':False})
+	cs = {'amps':[1.0], 'freqs':[10.], 'repeats':1, 'electrkeys':[], 'journal':str(workdir / 'journal.txt')}
+	FG, SCOPE = connect_simulated_instruments(ms, time_scale=0., seed=0)
+	entries = run_campaign(cs, ms, FG=FG, SCOPE=SCOPE)
+	SCOPE.close()
+	assert len(entries) == 1 and 'error' not in entries[0]
+	name, = os.listdir('Data')
+	with open(os.path.join('Data', name, name + '_results.txt')) as results:
+		keys = [line.split(',')[0] for line in results]
+	assert 'periods' in keys and 'PR_periods_std' in keys
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+hysteresis evaluation against the baseline formulas, on 8 bit data of the simulated scope (HESMCtrl.Simulation)
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from HESMCtrl.Evaluation import nearest_to_zero, get_PR, get_EC, calculate_hysteresis, cumulative_trapezoid
+from HESMCtrl.Measurement import get_measurement_settings, measure_hysteresis
+from HESMCtrl.Simulation import connect_simulated_instruments
+
+try:
+	from scipy.integrate import cumulative_trapezoid as scipy_cumulative_trapezoid
+except ImportError:
+	from scipy.integrate import cumtrapz as scipy_cumulative_trapezoid
+
+SETTINGS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'meas_settings.txt')
+
+def quantised_data(seed, rref=1e3, scale_divider=1.):
+	"""
+	one 5 Hz screen of the simulated scope, Vset and Vref have repeated (8 bit) values
+	"""
+	ms = get_measurement_settings(SETTINGS)
+	ms.update({'freq':5., 'average':1, 'scale_divider_CHAN1':1., 'rref':rref, 'scale_divider_CHAN2':scale_divider})
+	FG, SCOPE = connect_simulated_instruments(ms, time_scale=0., seed=seed)
+	data = measure_hysteresis('test', ms, FG=FG, SCOPE=SCOPE)
+	SCOPE.close()
+	return data, ms
+
+def baseline_PR(data):
+	# get_PR / get_EC of the baseline, the ties in the order of the samples (stable sort)
+	PRs = abs(data.iloc[(data['E']-0).abs().argsort(kind='stable')[:20]].P)
+	return np.mean(PRs), np.std(PRs)
+
+def baseline_EC(data):
+	return np.mean(abs(data.iloc[(data['P']-0).abs().argsort(kind='stable')[:20]].E))
+
+def test_nearest_to_zero_takes_ties_in_sample_order():
+	x = np.array([3., -1., 2., 1., -1., 0., 1., np.nan, 2.])
+	positions = nearest_to_zero(x, (1, 3, 4, 9))
+	for count in (1, 3, 4, 9):
+		assert list(positions[count]) == list(np.argsort(abs(x), kind='stable')[:count])
+	stacked = np.array([x, x[::-1], np.full(9, 1.)])
+	for row, positions in zip(stacked, nearest_to_zero(stacked, (4,))[4]):
+		assert list(positions) == list(np.argsort(abs(row), kind='stable')[:4])
+
+@pytest.mark.parametrize('seed, rref, scale_divider', [(0, 1e3, 1.), (1, 1e3, 10.), (2, 150e3, 1.), (3, 1e4, 3.)])
+def test_PR_and_EC_equal_the_baseline(seed, rref, scale_divider):
+	data, ms = quantised_data(seed, rref, scale_divider)
+	data, result = calculate_hysteresis(data, ms, 'test', verbose=False)
+	PR, PRerr = baseline_PR(data)
+	EC = baseline_EC(data)
+	assert np.allclose(get_PR(data), (PR, PRerr), rtol=1e-12, atol=0)
+	assert np.isclose(get_EC(data), EC, rtol=1e-12, atol=0)
+	assert np.allclose(result[['PR', 'PRerr', 'EC']].astype(float), (PR, PRerr, EC), rtol=1e-12, atol=0)
+
+@pytest.mark.parametrize('corrections', [False, True])
+def test_batch_equals_single_traces(corrections):
+	from HESMCtrl.Evaluation import evaluate_hysteresis
+	traces = [quantised_data(seed) for seed in range(6)]
+	ms = dict(traces[0][1], correct_Ebias=corrections, correct_LossI=corrections)
+	traces = [data for data, _ in traces]
+	arrays, results = evaluate_hysteresis(np.array([data.time for data in traces]), np.array([data.Vset for data in traces]),
+										  np.array([data.Vref for data in traces]), ms)
+	assert len(results) == len(traces)
+	for i, data in enumerate(traces):
+		data, result = calculate_hysteresis(data.copy(), ms, 'test', verbose=False)
+		for key, values in arrays.items():
+			if key in data:
+				assert np.allclose(values[i], data[key], rtol=1e-12, atol=0, equal_nan=True), key
+		for key in results.columns:
+			assert np.isclose(results[key][i], result[key], rtol=1e-12, atol=0, equal_nan=True), key
+		assert np.isclose(results['PR'][i], baseline_PR(data)[0], rtol=1e-12, atol=0)
+		assert np.isclose(results['EC'][i], baseline_EC(data), rtol=1e-12, atol=0)
+
+@pytest.mark.parametrize('shape', [(1200,), (7, 1200)])
+@pytest.mark.parametrize('initial', [None, 0])
+def test_cumulative_trapezoid_equals_scipy(shape, initial):
+	rng = np.random.default_rng(0)
+	y = rng.normal(size=shape)
+	# non-uniform sample points, constant spacing and one spacing per row
+	x = (rng.uniform(0.5, 1.5, shape) * 2e-5).cumsum(axis=-1)
+	dx = rng.uniform(1e-5, 1e-4, shape[:-1] + (1,))
+	for kwargs in ({'x':x}, {'dx':2e-5}, {'dx':dx}):
+		expected = scipy_cumulative_trapezoid(y, initial=initial, axis=-1, **kwargs)
+		assert np.array_equal(cumulative_trapezoid(y, initial=initial, **kwargs), expected)
+	# along the first axis
+	expected = scipy_cumulative_trapezoid(y.T, x.T, axis=0, initial=initial)
+	assert np.array_equal(cumulative_trapezoid(y.T, x.T, axis=0, initial=initial), expected)
+	# into y itself
+	expected = scipy_cumulative_trapezoid(y, dx=2e-5, initial=initial)
+	out = y if initial is not None else y[...,1:]
+	assert cumulative_trapezoid(y, dx=2e-5, initial=initial, out=out) is out
+	assert np.array_equal(out, expected)
+
+def test_cumulative_trapezoid_goes_on_after_nan_gaps():
+	y = np.arange(10.)
+	y[[4, 5]] = np.nan
+	result = cumulative_trapezoid(y, initial=0)
+	assert np.array_equal(result[:4], scipy_cumulative_trapezoid(y[:4], initial=0))
+	assert np.isnan(result[4:6]).all()
+	# the intervals next to the gap add 0
+	assert np.array_equal(result[6:] - result[3], scipy_cumulative_trapezoid(y[6:], initial=0))
+
+def test_periods_only_on_request():
+	from HESMCtrl.Evaluation import evaluate_periods
+	data, ms = quantised_data(0)
+	_, result = calculate_hysteresis(data.copy(), ms, 'test', verbose=False)
+	assert not [key for key in result.index if 'periods' in key]
+	_, with_periods = calculate_hysteresis(data.copy(), ms, 'test', verbose=False, periods=True)
+	table, summary = evaluate_periods(data.time, data.Vset, data.Vref, ms)
+	assert with_periods['periods'] == summary['periods'] == len(table) >= 1
+	assert with_periods['PR_periods'] == summary['PR'] and with_periods['EC_periods_std'] == summary['EC_std']
+	assert np.allclose(with_periods[result.index].astype(float), result.astype(float), rtol=0, atol=0, equal_nan=True)
+
+def test_loop_periods_are_lazy():
+	from HESMCtrl.Evaluation import HysteresisLoop, evaluate_periods
+	from HESMCtrl.Measurement import configure_generator
+	ms = get_measurement_settings(SETTINGS)
+	ms.update({'freq':10., 'amp':10., 'rref':10., 'scale_divider_CHAN2':10., 'ampfactor':1.})
+	FG, SCOPE = connect_simulated_instruments(ms, time_scale=0., seed=1)
+	SCOPE.timebase_scale = 1./ms['freq']/5
+	configure_generator(FG, ms)
+	SCOPE.single()
+	SCOPE.tforce()
+	SCOPE.wait_for_acquisition()
+	block = SCOPE.capture(['CHAN1', 'CHAN2'])
+	SCOPE.close()
+	loop = HysteresisLoop.from_capture(block, ms)
+	loop.result
+	assert 'periods' not in loop._cache
+	table, summary = loop.periods
+	expected_table, expected = evaluate_periods(block.time.to_array(), block['CHAN1'], block['CHAN2'], ms, 
+												dt=block.time.increment)
+	assert summary['periods'] >= 1
+	assert summary.equals(expected) and table.equals(expected_table)
+	assert loop.periods[0] is table
+	# the periods depend on every setting of the evaluation
+	loop.configure(correct_LossI=True)
+	assert 'periods' not in loop._cache
+
+def test_period_bounds_of_full_periods():
+	from HESMCtrl.Evaluation import period_bounds
+	# 3 periods on the screen, the maxima at 100, 500, 900 enclose 2 full periods
+	Vset = np.sin(2*np.pi*np.arange(1200.)/400)
+	assert [(int(start), int(end)) for start, end in period_bounds(Vset)] == [(100, 500), (500, 900)]
+	# burst mode: the period across the gap between two bursts is dropped
+	burst = np.concatenate([Vset[:1000], np.zeros(400), Vset[:800]])
+	assert [(int(start), int(end)) for start, end in period_bounds(burst)] == [(100, 500), (500, 900), (1500, 1900)]
+	assert period_bounds(Vset[:500]) == []
+
+def test_stack_periods_pads_with_nan():
+	from HESMCtrl.Evaluation import stack_periods
+	time, Vset = stack_periods([(0, 3), (3, 5)], np.arange(10.), np.arange(10.)*2)
+	# every period includes its end point
+	assert np.array_equal(time, [[0., 1., 2., 3.], [3., 4., 5., np.nan]], equal_nan=True)
+	assert np.array_equal(Vset, time*2, equal_nan=True)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+HP33120A driver against the simulated generator (HESMCtrl.Simulation)
+"""
+
+import pytest
+
+from HESMCtrl.HP33120ACtrl import HP33120A
+from HESMCtrl.Simulation import SimulatedHP33120A, SimulatedResourceManager
+
+class FailingHP33120A(SimulatedHP33120A):
+	"""
+	SimulatedHP33120A raising a link error on the next transaction if fail is set
+	"""
+	fail = False
+
+	def _handle(self, message):
+		if self.fail:
+			self.fail = False
+			raise IOError('GPIB timeout')
+		return SimulatedHP33120A._handle(self, message)
+
+def connect(generator):
+	FG = HP33120A()
+	FG.connect_to_instrument(22, rm=SimulatedResourceManager({'GPIB0::22::INSTR':generator}))
+	return FG
+
+def test_configure_skips_unchanged_parameters():
+	generator = SimulatedHP33120A()
+	FG = connect(generator)
+	FG.configure('TRI', 0.1, 2.0, 0.0, burst_count=20, burst_status='ON')
+	n_commands = len(generator.commands)
+	FG.configure('TRI', 0.1, 2.0, 0.0, burst_count=20, burst_status='ON')
+	assert len(generator.commands) == n_commands
+	FG.configure('TRI', 0.1, 3.0, 0.0, burst_count=20, burst_status='ON')
+	assert list(generator.commands)[n_commands:] == ['SOUR:VOLT 3.000000']
+
+def test_off_invalidates_state():
+	generator = SimulatedHP33120A()
+	FG = connect(generator)
+	FG.configure('TRI', 0.1, 2.0, 0.0, burst_count=20, burst_status='ON')
+	FG.off()
+	assert all(value is None for value in FG.state.values())
+	FG.configure('TRI', 0.1, 2.0, 0.0, burst_count=20, burst_status='ON')
+	assert generator.state == {'shape':'TRI', 'frequency':0.1, 'amplitude':2.0, 'offset':0.0,
+							   'burst_count':20, 'burst_status':'ON', 'trigger_source':'IMM'}
+
+@pytest.mark.parametrize('method', ['write', 'ask'])
+def test_failed_transaction_invalidates_state(method):
+	generator = FailingHP33120A()
+	FG = connect(generator)
+	FG.configure('TRI', 0.1, 2.0, 0.0, burst_count=20, burst_status='ON')
+	generator.fail = True
+	with pytest.raises(IOError):
+		if method == 'write':
+			FG.set_amplitude(3.0)
+		else:
+			FG.get_amplitude()
+	assert all(value is None for value in FG.state.values())
+	# e.g. the generator has been reset meanwhile, nothing is skipped
+	generator.reset()
+	FG.configure('TRI', 0.1, 2.0, 0.0, burst_count=20, burst_status='ON')
+	assert generator.state['shape'] == 'TRI' and generator.state['burst_status'] == 'ON'
+	assert generator.state['amplitude'] == 2.0 and generator.state['burst_count'] == 20
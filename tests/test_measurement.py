@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+measure_hysteresis and its helpers against the simulated instruments (HESMCtrl.Simulation)
+"""
+
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import HESMCtrl.DS1054ZCtrl
+import HESMCtrl.Measurement
+from HESMCtrl.Measurement import connect_instruments, get_measurement_settings, measure_cycles_pipelined
+from HESMCtrl.Simulation import connect_simulated_instruments
+
+# upper limit of waiting for another thread (s), only reached if the test fails
+WAIT = 30.
+
+SETTINGS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'meas_settings.txt')
+
+def low_frequency_setup(time_scale=0.02, **changes):
+	"""
+	settings file with a 0.5 Hz excitation and simulated instruments,
+	an acquisition takes time_scale times the screen time (4.8 s)
+	"""
+	ms = get_measurement_settings(SETTINGS)
+	ms.update({'freq':0.5, 'average':4, 'scale_divider_CHAN1':1., 'rref':10.})
+	ms.update(changes)
+	FG, SCOPE = connect_simulated_instruments(ms, time_scale=time_scale, latency=0.002, seed=1)
+	SCOPE.timebase_scale = 1./ms['freq']/5
+	return ms, FG, SCOPE
+
+def signal_readouts(SCOPE, n_cycles):
+	"""
+	events set when the readout of each cycle starts (the acquisition is complete then)
+	"""
+	readouts = [threading.Event() for i in range(n_cycles + 1)]
+	capture = SCOPE.capture
+	def signalling_capture(*args, **kwargs):
+		readouts[sum(event.is_set() for event in readouts)].set()
+		return capture(*args, **kwargs)
+	SCOPE.capture = signalling_capture
+	return readouts
+
+def phases(timeline, phase):
+	df = timeline.to_dataframe()
+	return df[df.phase == phase].set_index('cycle')
+
+def test_connect_instruments_keeps_given_drivers(monkeypatch):
+	FG, SCOPE = connect_simulated_instruments()
+	assert connect_instruments(FG, SCOPE) == (FG, SCOPE)
+	# only the missing scope is connected (to the address of get_config)
+	hosts = []
+	def DS1054Z(host):
+		hosts.append(host)
+		return SCOPE
+	with monkeypatch.context() as patch:
+		patch.setattr(HESMCtrl.DS1054ZCtrl, 'DS1054Z', DS1054Z)
+		patch.setattr(HESMCtrl.Measurement, 'get_config', lambda: ('192.168.1.10', '22'))
+		assert connect_instruments(FG, None) == (FG, SCOPE)
+	assert len(hosts) == 1
+	SCOPE.close()
+
+def test_pipelined_cycles_overlap_evaluation_and_acquisition():
+	ms, FG, SCOPE = low_frequency_setup()
+	readouts = signal_readouts(SCOPE, int(ms['average']))
+	waited = []
+	def on_cycle(i, cycle):
+		# the evaluation of cycle i only ends when cycle i+1 has been acquired
+		if i + 1 < int(ms['average']):
+			waited.append(readouts[i+1].wait(WAIT))
+	data, timeline = measure_cycles_pipelined(FG, SCOPE, ms, on_cycle=on_cycle)
+	SCOPE.close()
+	assert len(data) == SCOPE.SAMPLES_ON_DISPLAY
+	acquisition, decode = phases(timeline, 'acquisition'), phases(timeline, 'decode')
+	assert list(acquisition.index) == list(range(4))
+	assert waited == [True] * 3
+	# cycle i is evaluated on the worker while cycle i+1 is acquired
+	for i in range(3):
+		assert decode.thread[i] != acquisition.thread[i+1]
+		assert acquisition.end[i] <= decode.start[i] and acquisition.end[i+1] < decode.end[i]
+
+def test_adaptive_averaging_keeps_the_pipeline():
+	from HESMCtrl.Evaluation import calculate_hysteresis
+	from HESMCtrl.Measurement import ConvergenceMonitor
+	ms, FG, SCOPE = low_frequency_setup()
+	monitor = ConvergenceMonitor(ms, target=1., max_cycles=8)
+	readouts = signal_readouts(SCOPE, monitor.max_cycles)
+	cycles, waited = [], []
+	def on_cycle(i, cycle):
+		cycles.append(cycle.dropna().reset_index(drop=True))
+		# until converged, cycle i+1 is acquired while cycle i is evaluated
+		t_end = time.perf_counter() + WAIT
+		while not (readouts[i+1].wait(0.01) or monitor.done) and time.perf_counter() < t_end:
+			pass
+		waited.append(readouts[i+1].is_set())
+	data, timeline = measure_cycles_pipelined(FG, SCOPE, ms, on_cycle=on_cycle, monitor=monitor)
+	SCOPE.close()
+	acquisition, decode = phases(timeline, 'acquisition'), phases(timeline, 'decode')
+	# converged after min_cycles, the decision may come one cycle late
+	assert monitor.done
+	assert monitor.min_cycles <= len(acquisition) <= monitor.min_cycles + 1
+	assert len(monitor.trace) == len(acquisition) == len(cycles)
+	# the monitor is not done before the evaluation of cycle min_cycles-1
+	assert waited[:monitor.min_cycles-1] == [True] * (monitor.min_cycles-1)
+	for i in range(monitor.min_cycles - 1):
+		assert acquisition.end[i+1] < decode.end[i]
+	# running mean and standard error of the cycle PRs
+	PRs = np.array([abs(calculate_hysteresis(cycle, ms, '', verbose=False)[1]['PR']) for cycle in cycles])
+	assert np.isclose(monitor.trace[-1]['PR'], PRs.mean(), rtol=1e-12)
+	assert np.isclose(monitor.trace[-1]['PR_sem'], PRs.std(ddof=1) / np.sqrt(len(PRs)), rtol=1e-9)
+
+def test_slow_evaluation_holds_back_the_next_cycle():
+	from HESMCtrl.Measurement import ConvergenceMonitor
+	ms, FG, SCOPE = low_frequency_setup()
+	monitor = ConvergenceMonitor(ms, target=1., max_cycles=8)
+	readouts = signal_readouts(SCOPE, monitor.max_cycles + 1)
+	overtaken = []
+	def on_cycle(i, cycle):
+		# an evaluation slower than an acquisition (0.1 s)
+		t_end = time.perf_counter() + WAIT
+		while not (readouts[i+1].wait(0.01) or monitor.done) and time.perf_counter() < t_end:
+			pass
+		overtaken.append(readouts[i+2].wait(0.3))
+	data, timeline = measure_cycles_pipelined(FG, SCOPE, ms, on_cycle=on_cycle, monitor=monitor)
+	SCOPE.close()
+	# cycle i+2 is not armed before cycle i is evaluated, the convergence ends the run in time
+	assert not any(overtaken)
+	assert monitor.done
+	assert monitor.min_cycles <= len(phases(timeline, 'acquisition')) <= monitor.min_cycles + 1
+
+def test_evaluation_error_stops_the_cycles():
+	ms, FG, SCOPE = low_frequency_setup(average=8)
+	readouts = signal_readouts(SCOPE, int(ms['average']))
+	def on_cycle(i, cycle):
+		raise ValueError('evaluation of cycle %i failed' % i)
+	with pytest.raises(ValueError):
+		measure_cycles_pipelined(FG, SCOPE, ms, on_cycle=on_cycle)
+	SCOPE.close()
+	# raised before cycle 2 is armed, with the generator off
+	assert sum(event.is_set() for event in readouts) == 2
+	assert FG.instrument.state['shape'] == 'DC'
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Orchestrator cancellation and timeouts against simulated stations (HESMCtrl.Simulation)
+"""
+
+import asyncio
+import os
+import threading
+
+import pytest
+
+from HESMCtrl.Measurement import MeasurementCancelled, get_measurement_settings
+from HESMCtrl.Orchestration import Station, Orchestrator
+from HESMCtrl.Simulation import connect_simulated_instruments
+
+# upper limit of waiting for another thread (s), only reached if the test fails
+WAIT = 30.
+
+SETTINGS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'meas_settings.txt')
+
+def slow_station(name='station1', cycles=20, time_scale=0.05, **kwargs):
+	"""
+	station measuring cycles 0.5 Hz cycles of 0.24 s (time_scale 0.05)
+	"""
+	ms = get_measurement_settings(SETTINGS)
+	ms.update({'freq':0.5, 'average':cycles, 'scale_divider_CHAN1':1., 'rref':10.})
+	FG, SCOPE = connect_simulated_instruments(ms, time_scale=time_scale, latency=0.002, seed=1)
+	point = {'name':ms['name'], 'electrkey':ms['electrkey'], 'amp':ms['amp'], 'freq':ms['freq'], 'offs':ms['offs'], 'repeat':1}
+	return Station(name, FG, SCOPE, **kwargs), ms, point
+
+def count_arms(SCOPE):
+	"""
+	list of the acquisitions armed on SCOPE and an event set at the first one
+	"""
+	arms, armed = [], threading.Event()
+	single = SCOPE.single
+	def counting_single():
+		arms.append(len(arms))
+		armed.set()
+		return single()
+	SCOPE.single = counting_single
+	return arms, armed
+
+def test_timeout_stops_the_measurement_between_cycles():
+	station, ms, point = slow_station()
+	arms, armed = count_arms(station.SCOPE)
+	orchestrator = Orchestrator([station], ms, timeout=0.5, retries=0)
+	assert asyncio.run(orchestrator.run([point])) == []
+	station.close()
+	# the measurement stops after the running cycle instead of measuring all of them
+	assert len(arms) < int(ms['average'])
+	assert station.busy.done() and isinstance(station.busy.exception(), MeasurementCancelled)
+	assert len(orchestrator.failed) == 1 and not station.stuck
+	assert station.FG.instrument.state['shape'] == 'DC'
+
+def test_cancelled_orchestrator_settles_and_raises():
+	station, ms, point = slow_station()
+	arms, armed = count_arms(station.SCOPE)
+	orchestrator = Orchestrator([station], ms)
+	async def cancel_run():
+		task = asyncio.ensure_future(orchestrator.run([point]))
+		# cancelled while the first cycle is measured
+		assert await asyncio.get_running_loop().run_in_executor(None, armed.wait, WAIT)
+		task.cancel()
+		await task
+	with pytest.raises(asyncio.CancelledError):
+		asyncio.run(cancel_run())
+	station.close()
+	assert len(arms) < int(ms['average'])
+	# the blocking measurement has returned before the cancellation was raised
+	assert station.busy.done() and isinstance(station.busy.exception(), MeasurementCancelled)
+	assert station.FG.instrument.state['shape'] == 'DC'
+
+def test_settle_is_bounded():
+	station, ms, point = slow_station(settle_timeout=0.2)
+	release = threading.Event()
+	async def hang():
+		# ignores the cancel_event
+		task = asyncio.ensure_future(station.run(release.wait, WAIT))
+		await asyncio.sleep(0)
+		task.cancel()
+		return await station.settle()
+	try:
+		assert not asyncio.run(hang())
+		# settle has given up on the call still running
+		assert station.stuck and not station.busy.done()
+	finally:
+		release.set()
+	station.close()
+
+def test_point_of_a_cancelled_station_goes_to_an_idle_one():
+	from HESMCtrl.Campaign import point_key
+	fast, ms, point = slow_station('fast', cycles=4, time_scale=0.001)
+	slow, ms, point = slow_station('slow', cycles=4)
+	arms, armed = count_arms(slow.SCOPE)
+	points = [dict(point, repeat=1), dict(point, repeat=2)]
+	orchestrator = Orchestrator([fast, slow], ms)
+	async def cancel_slow():
+		task = asyncio.ensure_future(orchestrator.run(points))
+		assert await asyncio.get_running_loop().run_in_executor(None, armed.wait, WAIT)
+		# the fast station has finished its point and waits
+		for i in range(int(WAIT * 100)):
+			if fast.measured:
+				break
+			await asyncio.sleep(0.01)
+		assert fast.measured == 1 and fast.task is None
+		orchestrator.cancel('slow')
+		return await task
+	results = asyncio.run(cancel_slow())
+	fast.close()
+	slow.close()
+	assert sorted(entry['key'] for entry in results) == sorted(point_key(point) for point in points)
+	assert fast.measured == 2 and slow.measured == 0
+	assert orchestrator.failed == []
+
+def test_points_without_stations_fail():
+	from HESMCtrl.Campaign import point_key
+	station, ms, point = slow_station()
+	arms, armed = count_arms(station.SCOPE)
+	points = [dict(point, repeat=1), dict(point, repeat=2)]
+	orchestrator = Orchestrator([station], ms)
+	async def cancel_station():
+		task = asyncio.ensure_future(orchestrator.run(points))
+		assert await asyncio.get_running_loop().run_in_executor(None, armed.wait, WAIT)
+		orchestrator.cancel(station.name)
+		return await task
+	assert asyncio.run(cancel_station()) == []
+	station.close()
+	assert sorted(key for key, name, error in orchestrator.failed) == sorted(point_key(point) for point in points)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+DS1054Z driver against the simulated scope (HESMCtrl.Simulation)
+"""
+
+import time
+
+import numpy as np
+import pytest
+
+from HESMCtrl.DS1054ZCtrl import DS1054Z, SocketTransport, ChunkedReadout, ReadoutError, AcquisitionTimeout
+from HESMCtrl.Simulation import (connect_simulated_instruments, ScopeStandIn, StandInDS1054Z,
+								 ScpiSocketServer, Vxi11Server, Vxi11ServerDS1054Z)
+
+# upper limit of waiting for the simulated scope (s), only reached if the test fails
+WAIT = 30.
+
+def test_single_shot_running_state():
+	FG, SCOPE = connect_simulated_instruments(noise=0, seed=0)
+	SCOPE.timebase_scale = 0.1
+	SCOPE.single()
+	SCOPE.tforce()
+	assert SCOPE._running_cached()
+	# the single shot stops by itself, the cached state is asked again until then
+	t_end = time.perf_counter() + WAIT
+	while SCOPE._running_cached() and time.perf_counter() < t_end:
+		time.sleep(0.01)
+	assert SCOPE.acquisition_state.running is False
+	SCOPE.run()
+	assert SCOPE._running_cached()
+	SCOPE.close()
+
+class FaultyStandIn(ScopeStandIn):
+	"""
+	ScopeStandIn breaking the :WAVeform:DATA? answers with the numbers in faults:
+	('truncate', n) = block of the n-th answer cut short, ('drop', n) = link error
+	"""
+	def __init__(self, memory, faults=()):
+		ScopeStandIn.__init__(self, memory)
+		self.faults = set(faults)
+		self.data_queries = 0
+		self.starts = []
+		self.drop = False
+
+	def query(self, header, argument):
+		if header != 'WAV:DATA':
+			return ScopeStandIn.query(self, header, argument)
+		self.data_queries += 1
+		self.starts.append(int(self.settings['WAV:STAR']))
+		block = ScopeStandIn.query(self, header, argument)
+		if ('truncate', self.data_queries) in self.faults:
+			return block[:len(block)//2]
+		if ('drop', self.data_queries) in self.faults:
+			self.drop = True
+		return block
+
+	def respond(self):
+		answer = ScopeStandIn.respond(self)
+		if self.drop:
+			self.drop = False
+			raise OSError('link lost')
+		return answer
+
+def memory_pattern(pnts, seed=1):
+	return np.random.default_rng(seed).integers(0, 256, pnts, dtype=np.uint8).tobytes()
+
+def test_chunked_readout_retries_failed_chunks():
+	data = memory_pattern(1234567)
+	engine = FaultyStandIn({'CHAN1':data}, faults=[('truncate', 2), ('drop', 4)])
+	SCOPE = StandInDS1054Z('localhost', engine=engine)
+	buff = SCOPE.get_waveform_bytes('CHAN1', mode='RAW')
+	assert bytes(buff) == data
+
+def test_chunked_readout_resumes_at_last_good_chunk():
+	data = memory_pattern(1000003)
+	engine = FaultyStandIn({'CHAN1':data}, faults=[('drop', 3)])
+	SCOPE = StandInDS1054Z('localhost', engine=engine)
+	SCOPE.write_batch(SCOPE._waveform_setup_commands(SOURce='CHAN1', FORMat='BYTE', MODE='RAW'))
+	readout = ChunkedReadout(SCOPE, len(data), retries=0)
+	readout.chunk_time = 1e9		# fixed chunk size
+	with pytest.raises(ReadoutError) as error:
+		readout.read()
+	assert error.value.readout is readout
+	assert readout.done == 2 * ChunkedReadout.MAX_CHUNK
+	buff = readout.read()
+	assert readout.finished
+	assert bytes(buff) == data
+	# continued with the failed chunk, the 2 good ones are not read again
+	chunk = ChunkedReadout.MAX_CHUNK
+	assert engine.starts[:4] == [1, chunk + 1, 2*chunk + 1, 2*chunk + 1]
+	assert sorted(engine.starts[3:]) == engine.starts[3:]
+
+def test_chunked_readout_preallocated_buffer_bounds():
+	pnts = 2 * ChunkedReadout.MAX_CHUNK + 17
+	data = memory_pattern(pnts)
+	engine = FaultyStandIn({'CHAN1':data}, faults=[('truncate', 1)])
+	SCOPE = StandInDS1054Z('localhost', engine=engine)
+	out = np.full(pnts + 64, 0xAA, dtype=np.uint8)
+	progress = []
+	SCOPE._get_waveform_bytes_internal('CHAN1', mode='RAW', out=out[:pnts],
+									   progress=lambda done, total: progress.append((done, total)))
+	assert out[:pnts].tobytes() == data
+	assert (out[pnts:] == 0xAA).all()
+	assert progress[-1] == (pnts, pnts)
+	assert all(done <= pnts for done, total in progress)
+
+def test_transports_give_identical_answers():
+	data = memory_pattern(600001)
+	engine = ScopeStandIn({'CHAN1':data, 'CHAN2':data[::-1]})
+	socket_server = ScpiSocketServer(engine).start()
+	scopes = {'in-process':StandInDS1054Z('localhost', engine=engine),
+			  'vxi11':Vxi11ServerDS1054Z(Vxi11Server(engine).start()),
+			  'socket':DS1054Z('127.0.0.1', transport=SocketTransport('127.0.0.1', socket_server.port))}
+	try:
+		answers = {}
+		for name, SCOPE in scopes.items():
+			# the engine is shared, same settings for every transport
+			SCOPE.write(':WAVeform:MODE NORM;:WAVeform:STARt 1;:WAVeform:STOP 1200')
+			replies = [SCOPE.query(message) for message in ('*IDN?', ':TRIGger:STATus?', ':WAVeform:SOURce CHAN2;:WAVeform:PREamble?')]
+			SCOPE.write(':WAVeform:MODE RAW;:WAVeform:STARt 1;:WAVeform:STOP 250000')
+			block = SCOPE.query_raw(':WAVeform:DATA?')
+			offset, length = DS1054Z.ieee_block_span(block)
+			SCOPE.invalidate_acquisition_state()
+			raw = [bytes(SCOPE.get_waveform_bytes(channel, mode='RAW')) for channel in ('CHAN1', 'CHAN2')]
+			answers[name] = (replies, bytes(block[:offset + length]), raw)
+		for name in ('vxi11', 'socket'):
+			assert answers[name] == answers['in-process']
+		assert answers['socket'][2] == [data, data[::-1]]
+	finally:
+		for SCOPE in scopes.values():
+			SCOPE.close()
+		socket_server.stop()
+
+def test_wait_for_acquisition_of_running_scope():
+	FG, SCOPE = connect_simulated_instruments(noise=0, seed=0)
+	SCOPE.timebase_scale = 2e-3
+	screen_time = SCOPE.timebase_scale * SCOPE.H_GRID
+	FG.configure('TRI', 100., 1., 0.)
+	SCOPE.run()
+	# running state unknown, the scope is asked
+	SCOPE.invalidate_acquisition_state()
+	SCOPE.engine.commands.clear()
+	waited = SCOPE.wait_for_acquisition(screens=3)
+	assert waited >= 3 * screen_time
+	# no side effects: the scope is only asked and keeps running (averaging)
+	assert SCOPE.engine.commands and all(command.rstrip().endswith('?') for command in SCOPE.engine.commands)
+	assert SCOPE.query(':TRIGger:STATus?') == 'RUN'
+	assert SCOPE._running_cached()
+	# stopped scope: nothing to wait for
+	SCOPE.stop()
+	SCOPE.engine.commands.clear()
+	SCOPE.wait_for_acquisition(screens=3)
+	assert SCOPE.engine.commands[-1] == ':TRIGger:STATus?'
+	assert all(command.rstrip().endswith('?') for command in SCOPE.engine.commands)
+	SCOPE.close()
+
+def test_wait_for_acquisition_without_trigger_times_out():
+	FG, SCOPE = connect_simulated_instruments(noise=0, seed=0)
+	SCOPE.timebase_scale = 1e-3
+	FG.off()
+	SCOPE.run()
+	with pytest.raises(AcquisitionTimeout):
+		SCOPE.wait_for_acquisition(timeout=0.1)
+	SCOPE.single()
+	SCOPE.tforce()
+	SCOPE.wait_for_acquisition(timeout=1.)
+	SCOPE.close()
+
+def test_memory_depth_only_while_running():
+	FG, SCOPE = connect_simulated_instruments(noise=0, seed=0)
+	SCOPE.stop()
+	with pytest.raises(RuntimeError):
+		SCOPE.memory_depth = 12e6
+	SCOPE.run()
+	SCOPE.memory_depth = 12e6
+	assert SCOPE.memory_depth == 12000000
+	# the running state after the change is asked from the scope, not assumed
+	commands = list(SCOPE.engine.commands)
+	write = max(i for i, command in enumerate(commands) if command.startswith(':ACQuire:MDEPth 12000000'))
+	assert any(command.startswith(':TRIGger:STATus?') for command in commands[write+1:])
+	assert SCOPE.acquisition_state.running is True
+	SCOPE.close()